@@ -0,0 +1,181 @@
+"""
+Search Index Benchmark
+
+Reports the size of the search index the search_index plugin built for a 
+site, and how long queries against it take, doing what search.js does: 
+fetch the manifest, then the documents and the shard for each word, 
+decompress and parse them, and score the matches.
+
+Run from the _build directory, after building a site:
+
+$ python benchmarks/search_index.py                       # the 1000 article 
+                                                           # synthetic corpus
+$ python benchmarks/search_index.py output/search         # any index
+$ python benchmarks/search_index.py cache/synthetic/10000/output/search
+
+Build the synthetic corpus with benchmarks/synthetic_corpus.py first.
+
+"cold" queries start with nothing loaded, like the first search after the 
+page loads. "warm" queries reuse the files already loaded, like the browser 
+does while the visitor types. Reading from disk stands in for the network, so
+the cold numbers are the best case.
+"""
+import os, sys
+import gzip
+import json
+import random
+import re
+import statistics
+import time
+
+DEFAULT_INDEX = os.path.abspath("cache/synthetic/1000/output/search")
+
+QUERIES = 200
+SEED = 42
+RESULTS = 20
+
+WORD = re.compile(r"[^\W_]+")
+
+class Index:
+    """
+    Loads the parts of an index as they're needed, and keeps them.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+        
+        with open(os.path.join(directory, "index.json")) as fp:
+            self.manifest = json.load(fp)
+    
+    def load(self, name):
+        if name not in self.files:
+            with open(os.path.join(self.directory, name), "rb") as fp:
+                self.files[name] = json.loads(gzip.decompress(fp.read()))
+        
+        return self.files[name]
+    
+    def words(self, query):
+        minimum = self.manifest["min_term_length"]
+        stopwords = self.manifest["stopwords"]
+        
+        return [word for word in WORD.findall(query.lower())
+                if len(word) >= minimum and word not in stopwords]
+    
+    def search(self, query):
+        """
+        Return the top RESULTS [document, score] for query, best first.
+        """
+        length = self.manifest["prefix_length"]
+        documents = self.load(self.manifest["documents"])
+        totals = None
+        
+        for word in self.words(query):
+            name = self.manifest["shards"].get(word[:length])
+            shard = self.load(name) if name else {}
+            scores = {}
+            
+            for term, postings in shard.items():
+                if term.startswith(word):
+                    for index in range(0, len(postings), 2):
+                        id = postings[index]
+                        scores[id] = scores.get(id, 0) + postings[index + 1]
+            
+            if totals is None:
+                totals = scores
+            else:
+                totals = {id: score + scores[id] for id, score in totals.items()
+                          if id in scores}
+        
+        ranked = sorted((totals or {}).items(), key=lambda item: -item[1])
+        
+        return [[documents[str(id)], score] for id, score in ranked[:RESULTS]]
+
+def index_size(directory):
+    """
+    Return (files, total bytes, largest file, its size, uncompressed bytes).
+    """
+    files = 0
+    total = 0
+    raw = 0
+    largest = (None, 0)
+    
+    for entry in os.scandir(directory):
+        if not entry.is_file():
+            continue
+        
+        size = entry.stat().st_size
+        files += 1
+        total += size
+        
+        if size > largest[1]:
+            largest = (entry.name, size)
+        
+        with open(entry.path, "rb") as fp:
+            data = fp.read()
+        
+        raw += len(gzip.decompress(data)) if entry.name.endswith(".gz") else size
+    
+    return files, total, largest[0], largest[1], raw
+
+def make_queries(index, count):
+    """
+    Pick count queries of one to three words (or the start of a word, like a
+    visitor typing) from the terms in the index.
+    """
+    rng = random.Random(SEED)
+    terms = []
+    
+    for name in index.manifest["shards"].values():
+        terms.extend(index.load(name))
+    
+    queries = []
+    
+    for _ in range(count):
+        words = [rng.choice(terms) for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.3:
+            words[-1] = words[-1][:max(index.manifest["min_term_length"], 3)]
+        queries.append(" ".join(words))
+    
+    return queries
+
+def time_queries(directory, queries, warm):
+    timings = []
+    index = Index(directory)
+    
+    for query in queries:
+        if not warm:
+            index = Index(directory)
+        
+        start = time.perf_counter()
+        index.search(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    
+    return timings
+
+def percentile(timings, percent):
+    return statistics.quantiles(timings, n=100)[percent - 1]
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_INDEX
+    
+    if not os.path.exists(os.path.join(directory, "index.json")):
+        sys.exit(f"No search index in {directory}, build the site first")
+    
+    index = Index(directory)
+    documents = index.load(index.manifest["documents"])
+    files, total, largest, largest_size, raw = index_size(directory)
+    
+    print(f"{len(documents)} documents, {len(index.manifest['shards'])} shards")
+    print(f"{files} files, {total/1024:.1f} KB compressed, "
+          f"{raw/1024:.1f} KB uncompressed")
+    print(f"largest file: {largest} ({largest_size/1024:.1f} KB)")
+    print()
+    
+    queries = make_queries(index, QUERIES)
+    
+    print(f"{'':<6} {'queries':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    
+    for name, warm in (("cold", False), ("warm", True)):
+        timings = time_queries(directory, queries, warm)
+        print(f"{name:<6} {len(timings):>8} {percentile(timings, 50):>8.2f} "
+              f"{percentile(timings, 95):>8.2f} {max(timings):>8.2f}")
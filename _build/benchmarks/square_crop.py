@@ -0,0 +1,68 @@
+"""
+Square Thumbnail Benchmark
+
+Times liquid rescale (seam carving) against the smart crop in imagetools for
+making square thumbnails of the largest images in the image tree, and saves
+both versions so they can be compared by eye.
+
+Liquid rescale needs ImageMagick built with lqr support, it's skipped if 
+that's not available.
+
+Run from the _build directory:
+
+$ python benchmarks/square_crop.py
+"""
+import os, sys
+import time
+
+sys.path.insert(0, os.path.abspath("."))
+
+import imagetools
+
+PATH = os.path.abspath("content/images")  # where to look for images
+DEST = os.path.abspath("cache/square_crop_benchmark")
+LARGEST = 5
+WIDTH = 400
+
+def largest_images(path, count):
+    found = []
+    
+    for entry in os.scandir(path):
+        if entry.is_file() and entry.name.lower().endswith((".jpg", ".jpeg", ".png")):
+            found.append((entry.stat().st_size, entry.path))
+    
+    return [path for size, path in sorted(found, reverse=True)[:count]]
+
+def liquid(image, width):
+    image.liquid_rescale(width, width)
+
+def timed(source, method, dest):
+    start = time.perf_counter()
+    
+    with imagetools.open_image(source, WIDTH) as image:
+        method(image, WIDTH)
+        image.format = "jpg"
+        image.save(filename=dest)
+    
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    if not os.path.exists(DEST):
+        os.makedirs(DEST)
+    
+    print(f"{'image':<50} {'liquid (s)':>12} {'smart (s)':>12}")
+    
+    for source in largest_images(PATH, LARGEST):
+        name, ext = os.path.splitext(os.path.basename(source))
+        
+        try:
+            liquid_time = f"{timed(source, liquid, os.path.join(DEST, f'{name}-liquid.jpg')):.3f}"
+        except Exception as e:
+            liquid_time = "n/a"
+            
+        smart_time = timed(source, imagetools.smart_square, os.path.join(DEST, f"{name}-smart.jpg"))
+        
+        print(f"{name:<50} {liquid_time:>12} {smart_time:>12.3f}")
+    
+    print()
+    print(f"Thumbnails saved to {DEST}")
@@ -0,0 +1,112 @@
+"""
+Summary Extraction Micro-Benchmark
+
+Times the summary plugin's scan against the old find/replace/regex
+implementation, using the bodies of the longest generated articles. The scan
+is timed both with and without its cache of stripped summaries.
+
+Note that the timings leave out pelican's link resolution (_update_content),
+which the old implementation ran over the whole article and the plugin now 
+only runs over the summary itself.
+
+Run from the _build directory, after a build:
+
+$ python benchmarks/summary_benchmark.py
+"""
+import os, sys
+import re
+import timeit
+
+sys.path.insert(0, os.path.abspath("plugins"))
+
+import summary
+
+PATH = os.path.abspath("../")  # where the generated articles live
+LONGEST = 5                    # how many of the longest articles to use
+NUMBER = 200                   # iterations per timing
+BEGIN_MARKER = '<!-- PELICAN_BEGIN_SUMMARY -->'
+END_MARKER = '<!-- PELICAN_END_SUMMARY -->'
+
+def legacy_extract(content, begin_marker, end_marker, use_first_paragraph):
+    """
+    The previous implementation of the summary extraction, minus the 
+    pelican-specific bits.
+    """
+    remove_markers = True
+    begin_summary = content.find(begin_marker)
+    end_summary = content.find(end_marker)
+
+    if begin_summary == -1 and end_summary == -1 and use_first_paragraph:
+        begin_marker, end_marker = '<p>', '</p>'
+        remove_markers = False
+        begin_summary = content.find(begin_marker)
+        end_summary = content.find(end_marker)
+
+    if begin_summary == -1 and end_summary == -1:
+        return None
+
+    if begin_summary == -1:
+        begin_summary = 0
+    else:
+        begin_summary = begin_summary + len(begin_marker)
+
+    if end_summary == -1:
+        end_summary = None
+
+    summary_text = content[begin_summary:end_summary]
+
+    if remove_markers:
+        if begin_summary:
+            content = content.replace(begin_marker, '', 1)
+        if end_summary:
+            content = content.replace(end_marker, '', 1)
+
+    summary_text = re.sub(r"<div.*>", "", summary_text)
+    summary_text = re.sub(r"</div>", "", summary_text)
+    
+    return summary_text, content
+
+def article_bodies(path):
+    """
+    Pull the entry-content out of every generated html page in path.
+    """
+    for entry in os.scandir(path):
+        if not entry.name.endswith(".html"):
+            continue
+        
+        with open(entry.path, encoding="utf-8") as fp:
+            html = fp.read()
+        
+        start = html.find('<div class="entry-content')
+        end = html.rfind('</div><!-- /.entry-content -->')
+        
+        if start == -1 or end == -1:
+            continue
+        
+        yield entry.name, html[html.find(">", start)+1:end]
+
+if __name__ == "__main__":
+    bodies = sorted(article_bodies(PATH), key=lambda x: len(x[1]), reverse=True)
+    
+    print(f"{'article':<50} {'bytes':>8} {'legacy (ms)':>12} {'scan (ms)':>12} {'cached (ms)':>12}")
+    
+    for name, body in bodies[:LONGEST]:
+        # put a summary block at the top, like our articles have
+        content = f"{BEGIN_MARKER}{body[:len(body)//10]}{END_MARKER}{body}"
+        
+        legacy = timeit.timeit(
+            lambda: legacy_extract(content, BEGIN_MARKER, END_MARKER, False), 
+            number=NUMBER)
+        
+        def uncached():
+            summary._stripped.clear()
+            summary.scan_summary(content, BEGIN_MARKER, END_MARKER, False)
+        
+        scan = timeit.timeit(uncached, number=NUMBER)
+        
+        cached = timeit.timeit(
+            lambda: summary.scan_summary(content, BEGIN_MARKER, END_MARKER, False),
+            number=NUMBER)
+        
+        print(f"{name:<50} {len(content):>8} "
+              f"{legacy/NUMBER*1000:>12.3f} {scan/NUMBER*1000:>12.3f} {cached/NUMBER*1000:>12.3f}")
@@ -0,0 +1,352 @@
+"""
+Synthetic Corpus Benchmark
+
+Generates sites of N made-up articles that use the same features as the real
+ones (the explanation and responsiveimage directives, the roles from
+roles.rst, the emoji substitutions from emojis.rst, code blocks, tags and
+images), then runs the full build on each: pelican, followed by every
+post-processing stage. Wall time, peak memory and the size of the output are
+recorded for each stage.
+
+Run from the _build directory:
+
+$ python benchmarks/synthetic_corpus.py              # 100, 1000 and 10000
+$ python benchmarks/synthetic_corpus.py 100 500      # other sizes
+
+Each site is built in its own directory under WORKSPACE, which is left in
+place afterwards so the output can be inspected. With PROFILE set to True
+the build profiler is on, and its summary for each size is printed too, to
+show which part of pelican (pagination, tag pages, feeds) is growing.
+
+Results are also saved to RESULTS_PATH as JSON.
+"""
+import os, sys
+import json
+import random
+import shutil
+import subprocess
+import time
+from datetime import datetime, timedelta
+
+BUILD_DIR = os.path.abspath(".")
+WORKSPACE = os.path.abspath("cache/synthetic")
+RESULTS_PATH = os.path.abspath("cache/synthetic_corpus.json")
+
+SIZES = (100, 1000, 10000)
+SEED = 42
+PROFILE = False
+
+TAGS = 60            # distinct tags across the corpus
+TAGS_PER_ARTICLE = 4
+CATEGORIES = ("tutorial", "opinion", "hardware", "notes")
+IMAGES = 6           # real images copied in and shared between articles
+
+# the images are taken from here, smallest first
+IMAGE_SOURCE = os.path.abspath("content/images")
+
+WORDS = """
+state event button pixel fade board loop timer python clojure boot build
+script server deploy value change queue color light sound sensor function
+closure macro symbol namespace request response test fixture branch commit
+""".split()
+
+ROLES = ("strike", "underline", "boldoblique", "boldcode")
+EMOJIS = ("grin", "thinking", "winking", "rainbow", "unicorn", "sparkleheart")
+
+CODE = '''
+def fade(start, end, steps):
+    """
+    Yield the colors between start and end.
+    """
+    for step in range(steps + 1):
+        yield tuple(
+            round(a + (b - a) * step / steps) for a, b in zip(start, end))
+'''
+
+# shell snippet that runs a post-processing stage against the site's output
+STAGE_SCRIPT = """
+import sys
+sys.path.insert(0, {build_dir!r})
+import {module} as stage
+output = {output!r}
+for name in ("PATH", "DOCUMENT_ROOT"):
+    if hasattr(stage, name):
+        setattr(stage, name, output)
+if hasattr(stage, "IGNORE_PATHS"):
+    stage.IGNORE_PATHS = []
+{body}
+"""
+
+STAGES = (
+    ("responsive_postprocess", "stage.apply_resource_limits()\n"
+                               "staging = stage.new_staging(output)\n"
+                               "stage.process_dir(output, staging)\n"
+                               "stage.get_manifest().save()\n"
+                               "stage.publish(staging, output)"),
+    ("strip_metadata", "stage.process_dir(output)"),
+    ("critical_css", "stage.process_dir(output)"),
+    ("minify", "stage.process_dir(output)"),
+    ("fingerprint", "stage.process_dir(output)"),
+    ("preload_manifest", "stage.process_dir(output)"),
+)
+
+CONF = """
+import sys
+sys.path.insert(0, {build_dir!r})
+from pelicanconf import *
+
+PATH = {content!r}
+PLUGIN_PATHS = [{plugins!r}, {pelican_plugins!r}]
+THEME = {theme!r}
+TEMPLATE_PAGES = {{}}
+
+# the real articles don't use it yet, but it's part of what's being measured
+PLUGINS = PLUGINS + ["responsiveimage"]
+"""
+
+def sentence(rng, words=12):
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+def paragraph(rng):
+    parts = [sentence(rng) for _ in range(rng.randint(3, 6))]
+
+    # sprinkle in the custom roles and emoji
+    role = rng.choice(ROLES)
+    parts.insert(1, f":{role}:`{rng.choice(WORDS)}`")
+    parts.append(f"|{rng.choice(EMOJIS)}|")
+
+    return " ".join(parts)
+
+def article(rng, number, date, images, tag_names):
+    """
+    Return the reStructuredText for one article.
+    """
+    title = f"Synthetic Article {number}: {sentence(rng, 4)[:-1]}"
+    tags = "; ".join(sorted({rng.choice(tag_names)
+                             for _ in range(TAGS_PER_ARTICLE)}))
+    image = rng.choice(images)
+    code = CODE.replace("\n", "\n    ")
+
+    sections = []
+    for section in range(rng.randint(2, 4)):
+        heading = sentence(rng, 3)[:-1]
+        sections.append(f"""
+{heading}
+{"=" * len(heading)}
+
+{paragraph(rng)}
+
+.. code-block:: python
+    {code}
+
+{paragraph(rng)}
+""")
+
+    return f"""{title}
+{"#" * len(title)}
+:date: {date:%Y-%m-%d %H:%M}
+:author: jjmojojjmojo
+:category: {rng.choice(CATEGORIES)}
+:tags: {tags};
+:slug: synthetic-{number}
+:status: published
+
+.. include:: ../extra.rst
+
+{paragraph(rng)}
+
+.. PELICAN_END_SUMMARY
+
+.. responsiveimage:: {{static}}/images/{image}
+   :width: 100%
+
+{paragraph(rng)}
+
+.. explanation:: How This Works
+
+    {paragraph(rng)}
+
+    .. code-block:: python
+        {CODE.replace(chr(10), chr(10) + "        ")}
+{"".join(sections)}
+
+.. figure:: {{static}}/images/{rng.choice(images)}
+   :width: 80%
+   :align: center
+
+   {sentence(rng, 6)}
+"""
+
+def pick_images(count):
+    """
+    Return the paths of the smallest count JPEGs and PNGs in IMAGE_SOURCE.
+    """
+    found = []
+
+    for entry in os.scandir(IMAGE_SOURCE):
+        if entry.is_file() and entry.name.lower().endswith((".jpg", ".png")):
+            found.append((entry.stat().st_size, entry.path))
+
+    return [path for size, path in sorted(found)[:count]]
+
+def generate(site, count):
+    """
+    Write a site of count articles to the site directory.
+    """
+    rng = random.Random(SEED)
+
+    content = os.path.join(site, "content")
+    images = os.path.join(content, "images")
+    os.makedirs(images)
+
+    for name in ("extra.rst", "emojis.rst", "roles.rst"):
+        shutil.copy(os.path.join(BUILD_DIR, name), site)
+
+    names = []
+    for path in pick_images(IMAGES):
+        shutil.copy(path, images)
+        names.append(os.path.basename(path))
+
+    # made of words, since a tag ending in a number can collide with another
+    # tag's paginated pages (tag1 page 2 is tag12.html)
+    tag_names = sorted({f"{rng.choice(WORDS)}-{rng.choice(WORDS)}"
+                        for _ in range(TAGS * 2)})[:TAGS]
+
+    start = datetime(2015, 1, 1)
+
+    for number in range(count):
+        date = start + timedelta(hours=number * 7)
+        with open(os.path.join(content, f"synthetic-{number}.rst"), "w") as fp:
+            fp.write(article(rng, number, date, names, tag_names))
+
+    conf = os.path.join(site, "conf.py")
+    with open(conf, "w") as fp:
+        fp.write(CONF.format(
+            build_dir=BUILD_DIR,
+            content=content,
+            plugins=os.path.join(BUILD_DIR, "plugins"),
+            pelican_plugins=os.path.join(BUILD_DIR, "pelican-plugins"),
+            theme=os.path.join(BUILD_DIR, "themes", "simple")))
+
+    return conf
+
+def output_size(path):
+    total = 0
+    files = 0
+
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            full_path = os.path.join(root, name)
+            if not os.path.islink(full_path):
+                total += os.path.getsize(full_path)
+                files += 1
+
+    return files, total
+
+def run_stage(command, cwd, env):
+    """
+    Run command, and return (succeeded, wall time, peak RSS in MB).
+
+    os.wait4() gives the resource usage of that one child (and whatever it
+    waited for, like pool workers), so each stage gets its own peak.
+    """
+    start = time.perf_counter()
+
+    process = subprocess.Popen(command, cwd=cwd, env=env,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    # read stderr before waiting, so a chatty stage can't fill the pipe
+    errors = process.stderr.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    peak = usage.ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak // 1024
+
+    if process.returncode:
+        lines = errors.decode("utf-8", "replace").strip().splitlines()
+        print(f"\t\tfailed: {lines[-1] if lines else process.returncode}")
+
+    return process.returncode == 0, elapsed, peak / 1024
+
+def benchmark(count):
+    site = os.path.join(WORKSPACE, str(count))
+
+    if os.path.exists(site):
+        shutil.rmtree(site)
+
+    print(f"{count} articles")
+
+    start = time.perf_counter()
+    conf = generate(site, count)
+    print(f"\tgenerated in {time.perf_counter() - start:.1f}s")
+
+    output = os.path.join(site, "output")
+    env = dict(os.environ)
+
+    if PROFILE:
+        env["BUILD_PROFILE"] = os.path.join(site, "profile")
+
+    results = []
+
+    commands = [("pelican", [sys.executable, "-m", "pelican",
+                             os.path.join(site, "content"), "-o", output,
+                             "-s", conf, "-q"])]
+
+    for module, body in STAGES:
+        script = STAGE_SCRIPT.format(build_dir=BUILD_DIR, module=module,
+                                     output=output, body=body)
+        commands.append((module, [sys.executable, "-c", script]))
+
+    for name, command in commands:
+        print(f"\t{name}...")
+        # stages are run from the site directory, so their caches go there
+        succeeded, elapsed, peak = run_stage(command, site, env)
+        files, size = output_size(output)
+
+        results.append({
+            "stage": name, "succeeded": succeeded, "seconds": elapsed,
+            "peak_mb": peak, "files": files, "bytes": size})
+
+        print(f"\t\t{elapsed:.1f}s, peak {peak:.0f} MB, "
+              f"{files} files, {size/1024/1024:.1f} MB")
+
+        if name == "pelican" and not succeeded:
+            break
+
+    if PROFILE:
+        subprocess.run([sys.executable, os.path.join(BUILD_DIR, "buildprofile.py"),
+                        env["BUILD_PROFILE"]])
+
+    return results
+
+def report(all_results):
+    print()
+    print(f"{'articles':>8} {'stage':<24} {'seconds':>9} {'s/article':>10} "
+          f"{'peak MB':>8} {'files':>8} {'output MB':>10}")
+
+    for count, results in all_results.items():
+        for result in results:
+            status = "" if result["succeeded"] else "  (failed)"
+            print(f"{count:>8} {result['stage']:<24} {result['seconds']:>9.1f} "
+                  f"{result['seconds']/count:>10.4f} {result['peak_mb']:>8.0f} "
+                  f"{result['files']:>8} {result['bytes']/1024/1024:>10.1f}{status}")
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+
+    all_results = {}
+
+    for count in sizes:
+        all_results[count] = benchmark(count)
+
+    report(all_results)
+
+    os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+    with open(RESULTS_PATH, "w") as fp:
+        json.dump(all_results, fp, indent=1)
@@ -0,0 +1,190 @@
+"""
+Template Rendering Benchmark
+
+Measures what the Jinja bytecode cache (JINJA_ENVIRONMENT in pelicanconf.py)
+and the memoized pluralize filter (my_plural) save:
+
+  - settings: how long importing pelicanconf takes, now that num2words is
+    only imported when the filter is first used, against importing it up
+    front like before
+  - pluralize: the filter's cost per call, with and without memoization
+  - compile: loading every template in the theme with no bytecode cache, and
+    with a warm one
+  - pelican: a full pelican run (what "make html" does, start-up included)
+    with no bytecode cache, an empty one and a warm one, with the time spent
+    compiling and rendering templates taken from the build profiler
+
+Run from the _build directory:
+
+$ python benchmarks/template_render.py                          # this site
+$ python benchmarks/template_render.py cache/synthetic/1000     # a synthetic
+                                                                # corpus
+
+A site directory needs a conf.py and a content directory, like the ones
+benchmarks/synthetic_corpus.py makes. Nothing outside WORKSPACE is written.
+"""
+import os, sys
+import shutil
+import statistics
+import subprocess
+import time
+import timeit
+
+BUILD_DIR = os.path.abspath(".")
+WORKSPACE = os.path.abspath("cache/template_render")
+TEMPLATES = os.path.join(BUILD_DIR, "themes", "simple", "templates")
+
+RUNS = 3 # of each pelican configuration, the median is reported
+
+sys.path.insert(0, BUILD_DIR)
+
+from buildprofile import load
+from pelicanconf import JINJA_FILTERS, my_plural
+
+CONF = """
+import os, sys
+sys.path.insert(0, {conf_dir!r})
+os.chdir({conf_dir!r})
+from {conf_module} import *
+from jinja2 import FileSystemBytecodeCache
+
+PATH = {content!r}
+THEME = os.path.abspath(THEME)
+PLUGIN_PATHS = [os.path.abspath(path) for path in PLUGIN_PATHS]
+CACHE_PATH = {cache_path!r}
+
+JINJA_ENVIRONMENT = dict(JINJA_ENVIRONMENT, bytecode_cache={bytecode_cache})
+"""
+
+def median_time(command, runs=5):
+    timings = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=BUILD_DIR, check=True)
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+def settings_import():
+    lazy = median_time([sys.executable, "-c", "import pelicanconf"])
+    eager = median_time([sys.executable, "-c", "import num2words, pelicanconf"])
+
+    print(f"import pelicanconf:       {lazy*1000:8.1f} ms "
+          f"({eager*1000:.1f} ms importing num2words up front)")
+
+def pluralize():
+    # the counts a build actually sees: tags, categories, pages
+    calls = [(count, "article", "articles") for count in range(1, 40)] * 100
+
+    plain = timeit.timeit(lambda: [my_plural.__wrapped__(*call) for call in calls],
+                          number=1)
+    my_plural.cache_clear()
+    cached = timeit.timeit(lambda: [my_plural(*call) for call in calls],
+                           number=1)
+
+    print(f"pluralize, per call:      {plain/len(calls)*1e6:8.2f} us "
+          f"uncached, {cached/len(calls)*1e6:.2f} us memoized")
+
+def compile_templates():
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+    names = [name for name in os.listdir(TEMPLATES) if name.endswith(".html")]
+    directory = os.path.join(WORKSPACE, "compile")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    def load_all(cache):
+        environment = Environment(loader=FileSystemLoader(TEMPLATES),
+                                  trim_blocks=True, lstrip_blocks=True,
+                                  bytecode_cache=cache)
+        environment.filters.update(JINJA_FILTERS)
+        start = time.perf_counter()
+        for name in names:
+            environment.get_template(name)
+        return time.perf_counter() - start
+
+    none = statistics.median(load_all(None) for _ in range(RUNS))
+    load_all(FileSystemBytecodeCache(directory))
+    warm = statistics.median(load_all(FileSystemBytecodeCache(directory))
+                             for _ in range(RUNS))
+
+    print(f"load {len(names)} templates:        {none*1000:8.1f} ms "
+          f"without a cache, {warm*1000:.1f} ms from the bytecode cache")
+
+def pelican_run(site, conf, output, profile):
+    shutil.rmtree(output, ignore_errors=True)
+    shutil.rmtree(profile, ignore_errors=True)
+
+    env = dict(os.environ, BUILD_PROFILE=profile)
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "pelican", os.path.join(site, "content"),
+                    "-o", output, "-s", conf, "-q"], cwd=site, env=env, check=True)
+    elapsed = time.perf_counter() - start
+
+    template = {"compile": [0, 0], "render": [0, 0]}
+
+    for event in load(profile):
+        if event.get("ph") == "X" and event["cat"] == "template":
+            template[event["name"]][0] += 1
+            template[event["name"]][1] += event["dur"] / 1e6
+
+    return elapsed, template
+
+def pelican(site):
+    if os.path.exists(os.path.join(site, "conf.py")):
+        conf_dir, conf_module = site, "conf"
+    else:
+        conf_dir, conf_module = BUILD_DIR, "pelicanconf"
+
+    work = os.path.join(WORKSPACE, "pelican")
+    bytecode = os.path.join(work, "bytecode")
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(bytecode)
+
+    configurations = (
+        ("no cache", "None", False),
+        ("empty cache", f"FileSystemBytecodeCache({bytecode!r})", True),
+        ("warm cache", f"FileSystemBytecodeCache({bytecode!r})", False),
+    )
+
+    print()
+    print(f"pelican on {site}")
+    print(f"{'':<12} {'wall s':>8} {'compiles':>9} {'compile s':>10} "
+          f"{'renders':>8} {'render s':>9}")
+
+    for name, cache, empty_first in configurations:
+        conf = os.path.join(work, f"conf_{name.replace(' ', '_')}.py")
+
+        with open(conf, "w") as fp:
+            fp.write(CONF.format(conf_dir=conf_dir, conf_module=conf_module,
+                                 content=os.path.join(site, "content"),
+                                 cache_path=os.path.join(work, "cache"),
+                                 bytecode_cache=cache))
+
+        results = []
+
+        for _ in range(RUNS):
+            if empty_first:
+                shutil.rmtree(bytecode)
+                os.makedirs(bytecode)
+
+            results.append(pelican_run(site, conf, os.path.join(work, "output"),
+                                       os.path.join(work, "profile")))
+
+        elapsed, template = sorted(results, key=lambda result: result[0])[len(results) // 2]
+
+        print(f"{name:<12} {elapsed:>8.2f} {template['compile'][0]:>9} "
+              f"{template['compile'][1]:>10.2f} {template['render'][0]:>8} "
+              f"{template['render'][1]:>9.2f}")
+
+if __name__ == "__main__":
+    site = os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 else BUILD_DIR
+
+    os.makedirs(WORKSPACE, exist_ok=True)
+
+    settings_import()
+    pluralize()
+    compile_templates()
+    pelican(site)
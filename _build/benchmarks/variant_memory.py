@@ -0,0 +1,94 @@
+"""
+Variant Memory Benchmark
+
+Renders small variants of the largest JPEGs in the image tree across a pool
+of worker processes, with and without shrink-on-load, and reports the time
+taken and the peak RSS of each worker.
+
+Run from the _build directory:
+
+$ python benchmarks/variant_memory.py
+"""
+import os, sys
+import multiprocessing
+import resource
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath("."))
+
+import imagetools
+
+PATH = os.path.abspath("content/images")  # where to look for JPEGs
+LARGEST = 8                                # how many of the largest to use
+WIDTHS = (200, 400, 800)                   # variants to render
+WORKERS = 4
+
+def largest_jpegs(path, count):
+    found = []
+    
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in ("responsive", "fullsize")]
+        for name in files:
+            full_path = os.path.join(root, name)
+            if imagetools.is_jpeg(full_path):
+                found.append((os.path.getsize(full_path), full_path))
+    
+    return [path for size, path in sorted(found, reverse=True)[:count]]
+
+def render(args):
+    source, margin, dest = args
+    
+    imagetools.SHRINK_ON_LOAD_MARGIN = margin
+    
+    start = time.perf_counter()
+    
+    for width in WIDTHS:
+        with imagetools.open_image(source, width) as image:
+            image.transform(resize=f'{width}x{width}>')
+            image.format = "jpg"
+            image.save(filename=os.path.join(dest, f"{os.getpid()}-{width}.jpg"))
+    
+    elapsed = time.perf_counter() - start
+    
+    # ru_maxrss is in kilobytes on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak // 1024
+    
+    return os.getpid(), elapsed, peak
+
+def run(sources, margin):
+    with tempfile.TemporaryDirectory() as dest:
+        with multiprocessing.Pool(WORKERS, initializer=imagetools.apply_resource_limits) as pool:
+            start = time.perf_counter()
+            results = pool.map(render, [(source, margin, dest) for source in sources])
+            total = time.perf_counter() - start
+    
+    peaks = {}
+    for pid, elapsed, peak in results:
+        peaks[pid] = max(peaks.get(pid, 0), peak)
+    
+    return total, peaks
+
+if __name__ == "__main__":
+    sources = largest_jpegs(PATH, LARGEST)
+    
+    if not sources:
+        print(f"No JPEGs found in {PATH}")
+        sys.exit(1)
+    
+    for source in sources:
+        width, height = imagetools.image_size(source)
+        print(f"{os.path.relpath(source, PATH)}: {width}x{height}")
+    print()
+    
+    for label, margin in (("full decode", None), 
+                          ("shrink-on-load", imagetools.SHRINK_ON_LOAD_MARGIN)):
+        total, peaks = run(sources, margin)
+        
+        print(f"{label}: {total:.2f}s total")
+        for pid, peak in sorted(peaks.items()):
+            print(f"\tworker {pid}: peak RSS {peak/1024:.1f} MB")
+        print(f"\tmax per worker: {max(peaks.values())/1024:.1f} MB")
+        print()
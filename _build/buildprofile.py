@@ -0,0 +1,211 @@
+"""
+Build Profiler
+
+Records how long each stage of the build takes, per file, across pelican and
+the post-processing scripts, and turns the result into a trace that can be
+loaded into chrome://tracing (or https://ui.perfetto.dev), plus a summary of
+where the time went.
+
+It's off unless the BUILD_PROFILE environment variable is set to a directory.
+When it's off, span() hands back a shared do-nothing context manager and the
+pelican plugin doesn't patch anything, so the cost is a function call.
+
+Each process appends its spans to its own file in BUILD_PROFILE as they
+finish, so worker processes (and crashes) don't lose anything:
+
+$ BUILD_PROFILE=cache/profile make html postprocess
+$ python buildprofile.py cache/profile
+
+Or just:
+
+$ make profile
+
+The second command merges the files into cache/profile/trace.json and prints
+the TOP most expensive kinds of span, and the TOP slowest single spans. Spans
+nest (a template render happens inside a write), so the totals overlap.
+
+Code is instrumented like so:
+
+    from buildprofile import span
+
+    with span("decode", "images", file=path):
+        ...
+"""
+import os, sys
+import json
+import time
+from collections import defaultdict
+from functools import wraps
+
+PROFILE_DIR = os.environ.get("BUILD_PROFILE")
+ENABLED = bool(PROFILE_DIR)
+
+TOP = 20 # rows in each summary table
+
+TRACE_NAME = "trace.json"
+
+_output = None
+_output_pid = None
+
+class NullSpan:
+    """
+    Stand-in for Span when profiling is off.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    """
+    Times the code in a with block, and records it when the block exits.
+    """
+    __slots__ = ("name", "category", "args", "start", "timestamp")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.timestamp = time.time_ns() // 1000
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = (time.perf_counter_ns() - self.start) // 1000
+        record({
+            "name": self.name,
+            "cat": self.category,
+            "ph": "X",
+            "ts": self.timestamp,
+            "dur": duration,
+            "pid": os.getpid(),
+            "tid": 0,
+            "args": self.args
+        })
+        return False
+
+def span(name, category="build", **args):
+    """
+    Return a context manager that records how long its block takes. args
+    are saved with the span (a file name, for example).
+    """
+    if not ENABLED:
+        return NULL_SPAN
+
+    return Span(name, category, args)
+
+def profiled(name, category="build", describe=None):
+    """
+    Decorator version of span(). describe is called with the function's
+    arguments and returns the args to record.
+
+    The function is returned untouched when profiling is off.
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            details = describe(*args, **kwargs) if describe else {}
+            with Span(name, category, details):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def record(event):
+    """
+    Append an event to this process's file, opening it if needed.
+
+    The file is line buffered, so a forked worker never inherits unwritten
+    events from its parent.
+    """
+    global _output, _output_pid
+
+    pid = os.getpid()
+
+    if _output_pid != pid:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        _output = open(os.path.join(PROFILE_DIR, f"{pid}.jsonl"), "a", buffering=1)
+        _output_pid = pid
+
+        process = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"
+        _output.write(json.dumps({
+            "name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+            "args": {"name": f"{process} ({pid})"}}) + "\n")
+
+    _output.write(json.dumps(event, default=str) + "\n")
+
+def load(directory):
+    """
+    Read the events from every process's file in directory.
+    """
+    events = []
+
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".jsonl"):
+            continue
+
+        with open(os.path.join(directory, name)) as fp:
+            for line in fp:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # a process was killed mid-write
+                    pass
+
+    return events
+
+def summarize(events, top=TOP):
+    """
+    Print the kinds of span with the most total time, and the slowest single
+    spans.
+    """
+    spans = [event for event in events if event.get("ph") == "X"]
+
+    totals = defaultdict(lambda: [0, 0, 0])
+
+    for event in spans:
+        entry = totals[(event["cat"], event["name"])]
+        entry[0] += 1
+        entry[1] += event["dur"]
+        entry[2] = max(entry[2], event["dur"])
+
+    print(f"{'category':<12} {'span':<40} {'count':>7} {'total ms':>10} {'mean ms':>9} {'max ms':>9}")
+
+    for (category, name), (count, total, longest) in sorted(
+            totals.items(), key=lambda item: item[1][1], reverse=True)[:top]:
+        print(f"{category:<12} {name[:40]:<40} {count:>7} {total/1000:>10.1f} "
+              f"{total/count/1000:>9.2f} {longest/1000:>9.1f}")
+
+    print()
+    print(f"{'category':<12} {'span':<24} {'ms':>9}  details")
+
+    for event in sorted(spans, key=lambda event: event["dur"], reverse=True)[:top]:
+        details = ", ".join(f"{key}={value}" for key, value in event.get("args", {}).items())
+        print(f"{event['cat']:<12} {event['name'][:24]:<24} {event['dur']/1000:>9.1f}  {details}")
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else PROFILE_DIR
+
+    if not directory:
+        sys.exit(f"usage: {sys.argv[0]} PROFILE_DIR")
+
+    events = load(directory)
+
+    trace_path = os.path.join(directory, TRACE_NAME)
+
+    with open(trace_path, "w") as fp:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+
+    print(f"Wrote {len(events)} events to {trace_path}")
+    print()
+
+    summarize(events)
@@ -0,0 +1,360 @@
+"""
+Critical CSS
+
+Inlines the CSS needed to draw the top of each page, so the browser can start
+painting without waiting for the full stylesheet:
+
+  - the generated pages are grouped by the template that made them (article,
+    index, tag, archives - see TEMPLATE_TYPES)
+  - for a few sample pages of each type, the first FOLD_ELEMENTS elements in
+    the body (and their ancestors) are taken as "above the fold", and every
+    rule in STYLESHEET that matches one of them is kept
+  - the kept rules are inlined in a <style> tag in each page of that type,
+    the full stylesheet is changed to load asynchronously (with a <noscript>
+    fallback), and a preload hint is added for each font in the stylesheet's
+    @font-face rules
+
+Everything is done with BeautifulSoup and a small CSS parser, so no browser is
+needed. Pages that already have the critical CSS are skipped, unless the
+stylesheet has changed.
+
+Run it after responsive_postprocess.py, and before minify.py and
+fingerprint.py, from the _build directory:
+
+$ python critical_css.py
+"""
+import os
+import hashlib
+import re
+from fnmatch import fnmatch
+from bs4 import BeautifulSoup
+
+from buildprofile import span
+from fingerprint import walk
+
+PATH = os.path.abspath("../") # the path to scan for HTML files
+DOCUMENT_ROOT = PATH          # the physical path that maps to / for absolute
+                              # paths
+
+# the stylesheet to inline, as it's referenced in the pages
+STYLESHEET = "/theme/css/main.css"
+
+# patterns (relative to PATH) for each type of page, first match wins
+TEMPLATE_TYPES = (
+    ("index", ("index.html", "index[0-9]*.html", "category/*.html", 
+               "author/*.html")),
+    ("tag", ("tag/*.html",)),
+    ("archives", ("archives.html", "tags.html", "categories.html", 
+                  "authors.html")),
+    ("article", ("*.html",)),
+)
+
+SAMPLES = 3          # pages of each type used to pick the rules
+FOLD_ELEMENTS = 120  # elements at the start of the body treated as visible
+
+# pseudo-classes and pseudo-elements that can't be matched against a static
+# document - they're stripped, and the rest of the selector is matched
+DYNAMIC_PSEUDO = re.compile(
+    r"::?(?:hover|focus|focus-within|focus-visible|active|visited|link|target|"
+    r"before|after|first-line|first-letter|selection|placeholder|-[\w-]+)"
+    r"(?:\([^)]*\))?")
+
+CSS_COMMENT = re.compile(r"/\*.*?\*/", re.DOTALL)
+CSS_URL = re.compile(r"""url\(\s*(?P<quote>["']?)(?P<value>[^)"']+)(?P=quote)\s*\)""")
+FONT_FORMATS = {".woff2": "font/woff2", ".woff": "font/woff", ".ttf": "font/ttf",
+                ".otf": "font/otf"}
+
+LINK_TAG = re.compile(r"<link\b[^>]*>", re.IGNORECASE)
+STYLESHEET_HREF = re.compile(
+    r"""\bhref\s*=\s*["'](?P<href>[^"']*%s(?:\.[0-9a-f]{10})?\.css)["']""" %
+    re.escape(os.path.splitext(STYLESHEET)[0]), re.IGNORECASE)
+CRITICAL_STYLE = re.compile(
+    r"""<style id="critical-css" data-hash="(?P<hash>[0-9a-f]*)">.*?</style>""",
+    re.DOTALL)
+
+def split_top_level(text, separator):
+    """
+    Split text on separator, ignoring separators in brackets or strings.
+    """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+
+    for index, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:index])
+            start = index + 1
+
+    parts.append(text[start:])
+
+    return parts
+
+def parse_css(css):
+    """
+    Parse a stylesheet into a list of rules.
+
+    Each rule is a tuple of (prelude, body). For @media and @supports the body
+    is a list of rules, for everything else it's the declarations as a string
+    (or None for statements like @import).
+    """
+    css = CSS_COMMENT.sub("", css)
+    rules = []
+    pos = 0
+
+    while pos < len(css):
+        brace = css.find("{", pos)
+        semicolon = css.find(";", pos)
+
+        if brace == -1:
+            break
+
+        if css[pos:brace].lstrip().startswith("@") and -1 < semicolon < brace:
+            rules.append((css[pos:semicolon].strip(), None))
+            pos = semicolon + 1
+            continue
+
+        prelude = css[pos:brace].strip()
+        depth = 1
+        end = brace + 1
+        quote = None
+
+        while end < len(css) and depth:
+            char = css[end]
+            if quote:
+                if char == quote:
+                    quote = None
+            elif char in "\"'":
+                quote = char
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+            end += 1
+
+        body = css[brace+1:end-1]
+
+        if prelude.startswith(("@media", "@supports")):
+            rules.append((prelude, parse_css(body)))
+        else:
+            rules.append((prelude, body.strip()))
+
+        pos = end
+
+    return rules
+
+def serialize(rules):
+    """
+    Turn a list of rules from parse_css() back into CSS.
+    """
+    output = []
+
+    for prelude, body in rules:
+        if body is None:
+            output.append(f"{prelude};")
+        elif isinstance(body, list):
+            output.append(f"{prelude}{{{serialize(body)}}}")
+        else:
+            output.append(f"{prelude}{{{body}}}")
+
+    return "\n".join(output)
+
+def absolute_urls(css, base_url):
+    """
+    Make the relative url()s in css absolute, since the rules are moving from
+    the stylesheet into the page.
+    """
+    base = os.path.dirname(base_url)
+
+    def replace(matches):
+        value = matches.group("value").strip()
+
+        if value.startswith(("/", "data:", "#")) or re.match(r"^[a-z]+://", value):
+            return matches.group(0)
+
+        return f'url("{os.path.normpath(os.path.join(base, value))}")'
+
+    return CSS_URL.sub(replace, css)
+
+def font_urls(rules):
+    """
+    Yield (url, mime type) for the fonts in the @font-face rules.
+    """
+    for prelude, body in rules:
+        if prelude.startswith("@font-face") and isinstance(body, str):
+            for matches in CSS_URL.finditer(body):
+                url = matches.group("value").strip()
+                ext = os.path.splitext(url)[1].lower()
+                if ext in FONT_FORMATS:
+                    yield url, FONT_FORMATS[ext]
+                    # the first supported format is enough
+                    break
+
+def above_the_fold(soup):
+    """
+    Return the elements treated as visible when the page first loads.
+    """
+    body = soup.body or soup
+    elements = set()
+
+    for element in body.find_all(True, limit=FOLD_ELEMENTS):
+        elements.add(id(element))
+        for parent in element.parents:
+            elements.add(id(parent))
+
+    return elements
+
+def selector_matches(soup, selector, visible):
+    """
+    Check if selector matches any of the visible elements.
+
+    Selectors that can't be matched are assumed to be used, to be safe.
+    """
+    selector = DYNAMIC_PSEUDO.sub("", selector).strip()
+
+    if not selector or selector[-1] in ">+~":
+        selector = f"{selector} *".strip()
+
+    try:
+        return any(id(element) in visible for element in soup.select(selector))
+    except Exception:
+        return True
+
+def used_rules(rules, pages):
+    """
+    Filter rules down to the ones used above the fold in pages (a list of
+    (soup, visible) tuples).
+    """
+    kept = []
+
+    for prelude, body in rules:
+        if body is None or prelude.startswith("@font-face"):
+            kept.append((prelude, body))
+        elif isinstance(body, list):
+            children = used_rules(body, pages)
+            if children:
+                kept.append((prelude, children))
+        elif prelude.startswith("@"):
+            # @keyframes, @page and friends aren't needed for first paint
+            continue
+        elif any(selector_matches(soup, selector, visible)
+                 for selector in split_top_level(prelude, ",")
+                 for soup, visible in pages):
+            kept.append((prelude, body))
+
+    return kept
+
+def template_type(path, basepath):
+    relative = os.path.relpath(path, basepath).replace(os.path.sep, "/")
+
+    for name, patterns in TEMPLATE_TYPES:
+        if any(fnmatch(relative, pattern) for pattern in patterns):
+            return name
+
+def critical_css(rules, samples):
+    """
+    Build the critical css from the sample pages for a template type.
+    """
+    pages = []
+
+    for path in samples:
+        with open(path) as fp:
+            soup = BeautifulSoup(fp.read(), "html.parser")
+        pages.append((soup, above_the_fold(soup)))
+
+    return absolute_urls(serialize(used_rules(rules, pages)), STYLESHEET)
+
+def rewrite(html, css, css_hash, fonts):
+    """
+    Inline css in html, and make the stylesheet load asynchronously.
+
+    Returns the new html, or None if nothing needed to change.
+    """
+    existing = CRITICAL_STYLE.search(html)
+    style = f'<style id="critical-css" data-hash="{css_hash}">{css}</style>'
+
+    if existing:
+        if existing.group("hash") == css_hash:
+            return None
+        return html[:existing.start()] + style + html[existing.end():]
+
+    for link in LINK_TAG.finditer(html):
+        tag = link.group(0)
+        href = STYLESHEET_HREF.search(tag)
+
+        if not href or not re.search(r"""\brel\s*=\s*["']stylesheet["']""", tag, re.IGNORECASE):
+            continue
+
+        href = href.group("href")
+
+        preloads = "".join(
+            f'<link href="{url}" rel="preload" as="font" type="{mime}" crossorigin/>\n'
+            for url, mime in fonts)
+
+        replacement = (
+            f"{preloads}{style}\n"
+            f"""<link href="{href}" rel="preload" as="style" onload="this.onload=null;this.rel='stylesheet'"/>\n"""
+            f'<noscript><link href="{href}" rel="stylesheet" type="text/css"/></noscript>')
+
+        return html[:link.start()] + replacement + html[link.end():]
+
+    return None
+
+def process_dir(basepath):
+    print(f"INLINING CRITICAL CSS IN {basepath}...")
+    print("====================================")
+
+    stylesheet_path = os.path.join(DOCUMENT_ROOT, STYLESHEET.lstrip("/"))
+
+    with open(stylesheet_path) as fp:
+        stylesheet = fp.read()
+
+    rules = parse_css(stylesheet)
+    fonts = list(font_urls(rules))
+
+    pages = {}
+
+    for path in sorted(walk(basepath)):
+        if path.endswith(".html"):
+            pages.setdefault(template_type(path, basepath), []).append(path)
+
+    for name, _ in TEMPLATE_TYPES:
+        paths = pages.get(name, [])
+
+        if not paths:
+            continue
+
+        css = critical_css(rules, paths[:SAMPLES])
+        css_hash = hashlib.sha1(css.encode("utf-8")).hexdigest()[:10]
+        changed = 0
+
+        for path in paths:
+            with open(path) as fp:
+                html = fp.read()
+
+            new_html = rewrite(html, css, css_hash, fonts)
+
+            if new_html is None:
+                continue
+
+            temp_path = f"{path}.new"
+            with open(temp_path, "w") as fp:
+                fp.write(new_html)
+            os.replace(temp_path, path)
+            changed += 1
+
+        print(f"{name}: {len(css)} of {len(stylesheet)} bytes of CSS inlined, "
+              f"{changed} of {len(paths)} pages updated")
+
+if __name__ == "__main__":
+    with span("critical_css", "stage"):
+        process_dir(PATH)
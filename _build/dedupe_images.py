@@ -0,0 +1,141 @@
+"""
+Image Deduplication
+
+The same images live in several places: the sources in content/images, the
+copies pelican publishes to images/, and the variants made of each copy by
+responsive-images.py and responsive_postprocess.py. This script hard links
+every image file in ROOTS with the same contents to one object in the
+variant store (see imagetools.cached_variant()), and reports how many bytes
+that saved.
+
+Files are compared by their sha1, and files that are already links to each
+other are only counted once, so the report shows what's actually on disk.
+
+Run from the _build directory:
+
+$ python dedupe_images.py            # link duplicates, and report
+$ python dedupe_images.py --dry-run  # only report what could be reclaimed
+$ python dedupe_images.py --prune    # also drop store objects nothing uses
+
+Symlinks (like the ones link_to_simpler_name() makes) and fingerprinted
+copies are left alone.
+"""
+import os, sys
+from collections import defaultdict
+
+from fingerprint import HASHED_NAME
+from imagetools import STORE_PATH, file_digest, store
+
+ROOTS = (
+    os.path.abspath("content/images"),
+    os.path.abspath("../images"),
+)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+
+def image_files(roots=ROOTS):
+    """
+    Yield the path of every image file under roots, skipping symlinks.
+    """
+    for root in roots:
+        for directory, dirs, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+
+                if (not name.lower().endswith(IMAGE_EXTENSIONS) or
+                    HASHED_NAME.match(name) or os.path.islink(path)):
+                    continue
+
+                yield path
+
+def disk_usage(paths):
+    """
+    Return (apparent bytes, bytes on disk) for paths, counting each inode
+    once.
+    """
+    apparent = 0
+    inodes = {}
+
+    for path in paths:
+        stat = os.stat(path)
+        apparent += stat.st_size
+        inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+
+    return apparent, sum(inodes.values())
+
+def duplicates(paths):
+    """
+    Return {sha1: [paths]} for contents found in more than one inode.
+    """
+    by_digest = defaultdict(list)
+    inodes = defaultdict(set)
+
+    for path in paths:
+        stat = os.stat(path)
+        digest = file_digest(path)
+        by_digest[digest].append(path)
+        inodes[digest].add((stat.st_dev, stat.st_ino))
+
+    return {digest: found for digest, found in by_digest.items()
+            if len(inodes[digest]) > 1}
+
+def reclaimable(paths):
+    """
+    Return the bytes that would be saved by linking paths (which have the same
+    contents) together.
+    """
+    apparent, on_disk = disk_usage(paths)
+
+    return on_disk - os.path.getsize(paths[0])
+
+def prune(store_path=STORE_PATH):
+    """
+    Remove store objects that aren't linked from anywhere else. Returns the
+    number of bytes freed.
+    """
+    freed = 0
+
+    for directory, dirs, names in os.walk(store_path):
+        for name in names:
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+
+            if stat.st_nlink == 1:
+                os.remove(path)
+                freed += stat.st_size
+
+    return freed
+
+def megabytes(size):
+    return f"{size/1024/1024:.1f} MB"
+
+if __name__ == "__main__":
+    dry_run = "--dry-run" in sys.argv
+
+    paths = list(image_files())
+
+    apparent, before = disk_usage(paths)
+
+    print(f"{len(paths)} image files, {megabytes(apparent)} in total, "
+          f"{megabytes(before)} on disk")
+
+    found = duplicates(paths)
+
+    if dry_run:
+        wasted = sum(reclaimable(found_paths) for found_paths in found.values())
+        print(f"{len(found)} images have duplicate copies, "
+              f"{megabytes(wasted)} could be reclaimed")
+        sys.exit()
+
+    for digest, found_paths in found.items():
+        for path in found_paths:
+            store(path)
+
+    apparent, after = disk_usage(paths)
+
+    print(f"Linked {sum(len(paths) for paths in found.values())} copies of "
+          f"{len(found)} images")
+    print(f"{megabytes(after)} on disk, {megabytes(before - after)} reclaimed")
+
+    if "--prune" in sys.argv:
+        print(f"Pruned {megabytes(prune())} of unused objects from the store")
@@ -0,0 +1,312 @@
+"""
+Asset Fingerprinting
+
+Gives static assets (the theme's CSS, JS, fonts and icons, the site's js/ 
+folder, and the image variants made by the post-processor) a second name with 
+a hash of their contents in it, and points the generated site at those names.
+
+Given ./theme/css/main.css, a copy named ./theme/css/main.0123456789.css is 
+created, and every reference to main.css in the site's HTML, CSS and JS is 
+rewritten to use it. Since the name changes whenever the contents do, the 
+hashed files can be cached by browsers forever (see wsgi.py). The original
+names are left in place, for anything that still refers to them. The urls in
+the files in KEEP_URLS are left alone, since they're saved in visitors' 
+browsers (see js/config.js), and have to keep working after the hashed files
+they'd point to are pruned.
+
+The hashed files are hard links to the originals, so they take no extra 
+space (the output is committed to the repository, so a copy per change adds
+up). Everything after pelican replaces files rather than writing them in 
+place, which would change the contents of a linked "immutable" file too. 
+Pelican itself copies the theme's static files over the old ones in place,
+so the theme's (small) files in COPY_DIRS are still copied.
+
+Run it after responsive_postprocess.py, from the _build directory:
+
+$ python fingerprint.py
+
+It's safe to run repeatedly: references to an out of date hashed name are 
+updated to the current one, and hashed files that no longer match the 
+contents of their original (or whose original is gone) are removed.
+"""
+import os, shutil
+import hashlib
+import re
+from urllib.parse import unquote
+
+from buildprofile import span
+
+PATH = os.path.abspath("../") # the path to scan for HTML files
+DOCUMENT_ROOT = PATH          # the physical path that maps to / for absolute
+                              # paths
+
+IGNORE_PATHS = [
+    os.path.abspath("../lib"),
+    os.path.abspath("../include"),
+    os.path.abspath("../bin")
+]
+
+# folders (relative to DOCUMENT_ROOT) whose contents are all fingerprinted
+ASSET_DIRS = ("theme", "js")
+
+# folders (relative to DOCUMENT_ROOT) whose hashed files are copied rather 
+# than linked, since pelican overwrites the originals in place
+COPY_DIRS = ("theme",)
+
+# sub-folders anywhere in the site that hold image variants
+VARIANT_DIRS = ("responsive", "fullsize")
+
+# files (relative to DOCUMENT_ROOT) whose urls are never rewritten. The 
+# settings page's script saves the stylesheet urls in it to localStorage, 
+# where a hashed name would break for returning visitors once it's pruned
+KEEP_URLS = ("js/config.js",)
+
+ASSET_EXTENSIONS = (".css", ".js", ".woff", ".woff2", ".svg", ".png", ".jpg", 
+                    ".jpeg", ".gif", ".webp", ".ico")
+
+HASH_LENGTH = 10
+
+HASHED_NAME = re.compile(
+    r"^(?P<name>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[^.]+)$" % HASH_LENGTH)
+
+# attributes in html that hold urls
+HTML_URL = re.compile(
+    r"""(?P<prefix>\b(?:src|href|srcset|poster)\s*=\s*)(?P<quote>["'])(?P<value>.*?)(?P=quote)""",
+    re.IGNORECASE | re.DOTALL)
+
+# url() in css and style attributes
+CSS_URL = re.compile(r"""(?P<prefix>url\(\s*)(?P<quote>["']?)(?P<value>[^)"']+)(?P=quote)""")
+
+# quoted absolute paths in javascript
+JS_URL = re.compile(r"""(?P<prefix>)(?P<quote>["'])(?P<value>/[^"'\s]+)(?P=quote)""")
+
+def walk(path):
+    """
+    Yield the path of every file under path, skipping IGNORE_PATHS and 
+    anything starting with _ or .
+    """
+    for entry in os.scandir(path):
+        if entry.name.startswith(("_", ".")):
+            continue
+        
+        full_path = os.path.abspath(entry.path)
+        
+        if entry.is_dir(follow_symlinks=False):
+            if full_path not in IGNORE_PATHS:
+                yield from walk(full_path)
+        elif entry.is_file():
+            yield full_path
+
+def top_dir(path):
+    return os.path.relpath(path, DOCUMENT_ROOT).split(os.path.sep)[0]
+
+def is_asset(path):
+    """
+    Decide if the file at path should be fingerprinted.
+    """
+    name = os.path.basename(path)
+    
+    if not name.lower().endswith(ASSET_EXTENSIONS) or HASHED_NAME.match(name):
+        return False
+    
+    relpath = os.path.relpath(path, DOCUMENT_ROOT)
+    parts = relpath.split(os.path.sep)
+    
+    return parts[0] in ASSET_DIRS or any(part in VARIANT_DIRS for part in parts[:-1])
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()[:HASH_LENGTH]
+
+def hashed_name(path, data):
+    """
+    Return the fingerprinted version of path's file name, given its contents.
+    """
+    name, ext = os.path.splitext(os.path.basename(path))
+    return f"{name}.{content_hash(data)}{ext}"
+
+def fingerprint(path, data, assets):
+    """
+    Create the fingerprinted link to (or copy of) the file at path (with the
+    given contents), and record it in assets.
+    """
+    hashed = os.path.join(os.path.dirname(path), hashed_name(path, data))
+    copy = top_dir(path) in COPY_DIRS
+    
+    if not os.path.exists(hashed) or not (copy or os.path.samefile(path, hashed)):
+        # a new file, or a copy made before the hashed files were linked
+        temp_path = f"{hashed}.new"
+        
+        if copy:
+            shutil.copy2(path, temp_path)
+        else:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            os.link(path, temp_path)
+        
+        os.replace(temp_path, hashed)
+    
+    assets[path] = os.path.basename(hashed)
+
+def prune(files, assets):
+    """
+    Remove the hashed files that aren't the current one for their original.
+    Returns the number of bytes freed.
+    """
+    freed = 0
+    
+    for path in files:
+        directory, name = os.path.split(path)
+        matches = HASHED_NAME.match(name)
+        
+        if not matches:
+            continue
+        
+        original = os.path.join(directory, f"{matches.group('name')}{matches.group('ext')}")
+        
+        if not is_asset(original) or assets.get(original) == name:
+            continue
+        
+        stat = os.stat(path)
+        if stat.st_nlink == 1:
+            freed += stat.st_size
+        
+        print(f"\tRemoved {path}")
+        os.remove(path)
+    
+    return freed
+
+def resolve(url, base_dir):
+    """
+    Return the filesystem path the given url refers to, with any 
+    fingerprint removed, or None if it's not a local url.
+    """
+    if url.startswith(("#", "//", "data:")) or re.match(r"^[a-z][a-z0-9+.-]*:", url, re.I):
+        return None
+    
+    url = re.split(r"[?#]", url, 1)[0]
+    
+    if not url:
+        return None
+    
+    if url.startswith("/"):
+        path = os.path.join(DOCUMENT_ROOT, unquote(url[1:]))
+    else:
+        path = os.path.join(base_dir, unquote(url))
+    
+    directory, name = os.path.split(os.path.normpath(path))
+    
+    matches = HASHED_NAME.match(name)
+    if matches:
+        name = f"{matches.group('name')}{matches.group('ext')}"
+    
+    return os.path.join(directory, name)
+
+def rewrite_url(url, base_dir, assets):
+    """
+    Return url, pointing at the fingerprinted name if it refers to an asset.
+    """
+    stripped = url.strip()
+    path = resolve(stripped, base_dir)
+    
+    if path not in assets:
+        return url
+    
+    end = re.search(r"[?#]|$", stripped).start()
+    directory = stripped[:stripped.rfind("/", 0, end) + 1]
+    
+    return f"{directory}{assets[path]}{stripped[end:]}"
+
+def rewrite_srcset(value, base_dir, assets):
+    candidates = []
+    
+    for candidate in value.split(","):
+        parts = candidate.strip().split(None, 1)
+        
+        if parts:
+            parts[0] = rewrite_url(parts[0], base_dir, assets)
+        
+        candidates.append(" ".join(parts))
+    
+    return ",".join(candidates)
+
+def rewrite(text, pattern, base_dir, assets):
+    """
+    Rewrite every url matched by pattern in text.
+    """
+    def replace(matches):
+        value = matches.group("value")
+        
+        if matches.group("prefix").lower().startswith("srcset"):
+            value = rewrite_srcset(value, base_dir, assets)
+        else:
+            value = rewrite_url(value, base_dir, assets)
+            
+        quote = matches.group("quote")
+        
+        return f"{matches.group('prefix')}{quote}{value}{quote}"
+    
+    return pattern.sub(replace, text)
+
+def rewrite_file(path, patterns, assets):
+    """
+    Rewrite the urls in the text file at path, saving it if anything changed. 
+    
+    Returns the new contents, as bytes.
+    """
+    with open(path, encoding="utf-8") as fp:
+        text = fp.read()
+    
+    base_dir = os.path.dirname(path)
+    new_text = text
+    
+    for pattern in patterns:
+        new_text = rewrite(new_text, pattern, base_dir, assets)
+    
+    if new_text != text:
+        print(f"\tRewrote {path}")
+        
+        temp_path = f"{path}.new"
+        with open(temp_path, "w", encoding="utf-8") as fp:
+            fp.write(new_text)
+        os.replace(temp_path, path)
+    
+    return new_text.encode("utf-8")
+
+def process_dir(basepath):
+    print(f"FINGERPRINTING {basepath}...")
+    print("====================================")
+    
+    files = list(walk(basepath))
+    assets = {}
+    
+    # binary assets first, since the css and js refer to them, then the css 
+    # and js (hashed after their references are updated), then the html
+    to_hash = [path for path in files if is_asset(path)]
+    
+    for path in to_hash:
+        if not path.endswith((".css", ".js")):
+            with open(path, "rb") as fp:
+                fingerprint(path, fp.read(), assets)
+    
+    for path in to_hash:
+        if path.endswith(".css"):
+            fingerprint(path, rewrite_file(path, [CSS_URL], assets), assets)
+    
+    for path in to_hash:
+        if path.endswith(".js"):
+            relpath = os.path.relpath(path, DOCUMENT_ROOT).replace(os.path.sep, "/")
+            patterns = [] if relpath in KEEP_URLS else [JS_URL]
+            fingerprint(path, rewrite_file(path, patterns, assets), assets)
+    
+    print(f"{len(assets)} assets fingerprinted")
+    
+    freed = prune(files, assets)
+    print(f"{freed} bytes freed by removing out of date hashed files")
+    
+    for path in files:
+        if path.endswith(".html"):
+            rewrite_file(path, [HTML_URL, CSS_URL], assets)
+
+if __name__ == "__main__":
+    with span("fingerprint", "stage"):
+        process_dir(PATH)
@@ -0,0 +1,568 @@
+"""
+Image Tools
+
+Helpers shared by the image scripts (responsive_postprocess.py and 
+responsive-images.py).
+
+Opening images:
+
+  - the source's dimensions are read with ping(), which only parses the 
+    header
+  - JPEGs that are going to be resized well below their full size are decoded
+    at a fraction of it (using libjpeg's DCT scaling, via ImageMagick's 
+    jpeg:size hint), which is much faster and uses a fraction of the memory
+    
+ImageMagick's resource limits are set by apply_resource_limits(), so a batch
+of workers running at once can't exhaust the machine's memory. Wand (and so 
+ImageMagick) is only loaded by the functions that use it, so the scripts that 
+import this module can be imported without ImageMagick installed.
+
+Square thumbnails are cropped by smart_square(), which picks the most 
+"interesting" square using an edge map computed on a small copy of the image,
+then does a plain resize.
+
+JPEG quality is picked per variant by jpeg_quality(): the lowest quality whose
+SSIM against the resized image meets JPEG_SSIM_TARGET. The result is stored 
+in the image manifest (see Manifest), keyed by the source's content hash and 
+the variant width, so the search only happens once.
+
+The manifest also records each source's display dimensions (see 
+image_dimensions()), so pages can reserve the right amount of space for it.
+
+Each source also gets a tiny, blurred placeholder (see placeholder()), stored
+in the manifest as a data URI, that pages can show while the real image loads.
+
+Generated variants are kept in a content-addressed store (see 
+cached_variant()): each variant is recorded in the manifest against the 
+source's content hash, and the file itself is a hard link to an object in 
+STORE_PATH named after the hash of its own contents. Copies of the same source
+(in content/images and the published images/, say) share a single set of 
+variants. Since variant files are hard links, they must always be replaced 
+(written to a temporary file, then os.replace()'d), never written in place.
+"""
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import numpy
+
+from strip_metadata import strip_variant
+
+# decode JPEGs at no less than this many times the target width, so there's
+# still detail left for the final resize to work with. Set to None to always
+# decode at full size
+SHRINK_ON_LOAD_MARGIN = 2
+
+# ImageMagick resource limits, applied per process. Once memory/map are used 
+# up, ImageMagick falls back to disk, which is slow but won't take the machine
+# down. None leaves ImageMagick's default in place.
+RESOURCE_LIMITS = {
+    'memory': 256 * 1024 * 1024,
+    'map': 512 * 1024 * 1024,
+    'thread': 1,
+}
+
+# longest side of the copy used to find the crop for square thumbnails
+ANALYSIS_SIZE = 256
+
+# how much to favor the middle of the image when picking a square crop, from
+# 0 (not at all) to 1 (only consider how close the window is to the middle)
+CENTER_BIAS = 0.2
+
+# JPEG quality selection. Set JPEG_QUALITY_MODE to None to use ImageMagick's 
+# default quality instead of searching for one.
+JPEG_QUALITY_MODE = "ssim"
+JPEG_SSIM_TARGET = 0.97
+JPEG_QUALITY_MIN = 40
+JPEG_QUALITY_MAX = 92
+# the full size variant uses the quality found for a copy no bigger than this
+# (the largest responsive variant), rather than searching at full size, which
+# means several float arrays of the whole image per probe
+FULL_SIZE_QUALITY_WIDTH = 2500
+
+# low quality image placeholders
+PLACEHOLDER_WIDTH = 20
+PLACEHOLDER_BLUR = 1.0    # sigma of the gaussian blur, in (placeholder) pixels
+PLACEHOLDER_QUALITY = 40
+
+# where we keep track of what we know about each source image
+MANIFEST_PATH = os.path.abspath("cache/image_manifest.json")
+
+# content-addressed store of generated variants. Must be on the same 
+# filesystem as the site, or variants are copied instead of linked
+STORE_PATH = os.path.abspath("cache/variant_store")
+
+def apply_resource_limits(resource_limits=RESOURCE_LIMITS):
+    """
+    Set ImageMagick's resource limits for this process.
+    """
+    from wand.resource import limits
+    
+    for name, value in resource_limits.items():
+        if value is not None:
+            limits[name] = value
+
+def image_size(path):
+    """
+    Return the (width, height) of the image at path, without decoding it.
+    """
+    from wand.image import Image
+    
+    with Image() as image:
+        image.ping(filename=path)
+        return image.width, image.height
+
+# EXIF orientations that rotate the image by 90 degrees, one way or the other
+ROTATED_ORIENTATIONS = ('left_top', 'right_top', 'right_bottom', 'left_bottom')
+
+def image_dimensions(source):
+    """
+    Return the (width, height) the image at source displays at, taking its
+    EXIF orientation into account, from the manifest if it's been seen before.
+    """
+    entry = get_manifest().entry(source)
+    
+    if "dimensions" not in entry:
+        from wand.image import Image
+        
+        with Image() as image:
+            image.ping(filename=source)
+            
+            width, height = image.width, image.height
+            
+            if image.orientation in ROTATED_ORIENTATIONS:
+                width, height = height, width
+        
+        entry["dimensions"] = [width, height]
+    
+    return tuple(entry["dimensions"])
+
+def is_jpeg(path):
+    return mimetypes.guess_type(path)[0] == "image/jpeg"
+
+def is_gif(path):
+    return mimetypes.guess_type(path)[0] == "image/gif"
+
+def open_image(path, width=None):
+    """
+    Open the image at path, to be resized down to fit in width x width pixels.
+    
+    If width is given and the image is a JPEG, it will be decoded at the 
+    smallest scale (1/2 to 1/8) that's still at least SHRINK_ON_LOAD_MARGIN 
+    times the width. Sources that aren't much bigger than that are decoded 
+    at full size, as usual.
+    
+    Only the first frame of a GIF is read, so animations are flattened to it
+    rather than saved as a series of files.
+    
+    The caller is responsible for closing the image (it works as a context 
+    manager, like Image).
+    """
+    from wand.image import Image
+    
+    image = Image()
+    
+    try:
+        if width is not None and SHRINK_ON_LOAD_MARGIN and is_jpeg(path):
+            hint = width * SHRINK_ON_LOAD_MARGIN
+            image.options['jpeg:size'] = f"{hint}x{hint}"
+        
+        image.read(filename=f"{path}[0]" if is_gif(path) else path)
+    except Exception:
+        image.close()
+        raise
+    
+    return image
+
+def grayscale_pixels(image, size=ANALYSIS_SIZE):
+    """
+    Return a 2D numpy array of 8-bit intensities for a copy of image that's 
+    been shrunk to fit in size x size pixels.
+    """
+    with image.clone() as small:
+        small.transform(resize=f"{size}x{size}>")
+        small.depth = 8
+        blob = small.make_blob(format="gray")
+        
+        return numpy.frombuffer(blob, dtype=numpy.uint8).reshape(
+            small.height, small.width)
+
+def saliency(pixels):
+    """
+    Edge map of the given grayscale pixels: the gradient magnitude at each 
+    pixel.
+    """
+    pixels = pixels.astype(numpy.float32)
+    
+    dy, dx = numpy.gradient(pixels)
+    
+    return numpy.hypot(dx, dy)
+
+def best_window(profile, window):
+    """
+    Given a 1D array of scores, return the start of the window of the given
+    length with the highest total, nudged towards the middle by CENTER_BIAS.
+    """
+    cumulative = numpy.concatenate(([0], numpy.cumsum(profile)))
+    totals = cumulative[window:] - cumulative[:-window]
+    
+    if totals.max() > 0:
+        totals = totals / totals.max()
+    
+    starts = numpy.arange(len(totals))
+    middle = (len(totals) - 1) / 2
+    
+    if middle:
+        closeness = 1 - numpy.abs(starts - middle) / middle
+    else:
+        closeness = numpy.ones(len(totals))
+    
+    scores = (1 - CENTER_BIAS) * totals + CENTER_BIAS * closeness
+    
+    return int(numpy.argmax(scores))
+
+def smart_crop_box(image):
+    """
+    Return (left, top, side) of the largest square in image that has the 
+    most going on in it.
+    """
+    side = min(image.width, image.height)
+    
+    if image.width == image.height:
+        return 0, 0, side
+    
+    edges = saliency(grayscale_pixels(image))
+    height, width = edges.shape
+    
+    # the square in the small copy's coordinates
+    scale = image.width / width
+    small_side = min(width, height)
+    
+    if image.width > image.height:
+        start = best_window(edges.sum(axis=0), small_side)
+        left = min(round(start * scale), image.width - side)
+        return left, 0, side
+    else:
+        start = best_window(edges.sum(axis=1), small_side)
+        top = min(round(start * scale), image.height - side)
+        return 0, top, side
+
+def smart_square(image, width):
+    """
+    Crop image (in place) to its most interesting square, and resize it to 
+    width x width.
+    """
+    left, top, side = smart_crop_box(image)
+    
+    image.crop(left, top, width=side, height=side)
+    image.resize(width, width)
+
+def file_digest(path):
+    """
+    Return the sha1 of the contents of the file at path.
+    """
+    digest = hashlib.sha1()
+    
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024*1024), b""):
+            digest.update(chunk)
+    
+    return digest.hexdigest()
+
+class Manifest:
+    """
+    Record of what we know about each source image, saved as JSON to path.
+    
+    Images are keyed by a hash of their contents, so copies of the same image
+    share an entry. The hash of each file is remembered along with its mtime
+    and size, so files are only re-hashed when they change.
+    """
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.files = {}
+        self.images = {}
+        
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+                self.files = data.get("files", {})
+                self.images = data.get("images", {})
+        except (OSError, ValueError):
+            pass
+    
+    def file_hash(self, path):
+        """
+        Return the sha1 of the contents of the file at path.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        
+        known = self.files.get(path)
+        
+        if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+        
+        digest = file_digest(path)
+        
+        self.files[path] = [stat.st_mtime_ns, stat.st_size, digest]
+        
+        return digest
+    
+    def entry(self, path):
+        """
+        Return the (mutable) dictionary of information about the image at path.
+        """
+        return self.images.setdefault(self.file_hash(path), {})
+    
+    def save(self):
+        directory = os.path.dirname(self.path)
+        
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        temp_path = f"{self.path}.new"
+        
+        with open(temp_path, "w") as fp:
+            json.dump({"files": self.files, "images": self.images}, fp)
+        
+        os.replace(temp_path, self.path)
+
+_manifest = None
+
+def get_manifest():
+    """
+    Return the manifest for this process, loading it on first use.
+    """
+    global _manifest
+    
+    if _manifest is None:
+        _manifest = Manifest()
+    
+    return _manifest
+
+def _window_means(values, size):
+    """
+    Mean of every size x size window in values, using an integral image.
+    """
+    integral = numpy.pad(values.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    
+    totals = (integral[size:, size:] - integral[:-size, size:] - 
+              integral[size:, :-size] + integral[:-size, :-size])
+    
+    return totals / (size * size)
+
+def ssim(first, second, window=8):
+    """
+    Mean structural similarity of two grayscale images (2D arrays of the same
+    shape), over window x window blocks.
+    """
+    first = first.astype(numpy.float64)
+    second = second.astype(numpy.float64)
+    
+    window = min(window, *first.shape)
+    
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    
+    mean_first = _window_means(first, window)
+    mean_second = _window_means(second, window)
+    
+    variance_first = _window_means(first * first, window) - mean_first ** 2
+    variance_second = _window_means(second * second, window) - mean_second ** 2
+    covariance = _window_means(first * second, window) - mean_first * mean_second
+    
+    similarity = (
+        ((2 * mean_first * mean_second + c1) * (2 * covariance + c2)) / 
+        ((mean_first ** 2 + mean_second ** 2 + c1) * (variance_first + variance_second + c2)))
+    
+    return float(similarity.mean())
+
+def _gray(image):
+    with image.clone() as gray:
+        gray.depth = 8
+        blob = gray.make_blob(format="gray")
+        
+        return numpy.frombuffer(blob, dtype=numpy.uint8).reshape(
+            gray.height, gray.width)
+
+def search_quality(image, target=JPEG_SSIM_TARGET, 
+                   low=JPEG_QUALITY_MIN, high=JPEG_QUALITY_MAX):
+    """
+    Binary search for the lowest JPEG quality that keeps the SSIM between the
+    encoded image and image itself at or above target.
+    """
+    from wand.image import Image
+    
+    reference = _gray(image)
+    best = high
+    
+    while low <= high:
+        quality = (low + high) // 2
+        
+        with image.clone() as encoded:
+            encoded.format = "jpeg"
+            encoded.compression_quality = quality
+            blob = encoded.make_blob()
+        
+        with Image(blob=blob) as decoded:
+            score = ssim(reference, _gray(decoded))
+        
+        if score >= target:
+            best = quality
+            high = quality - 1
+        else:
+            low = quality + 1
+    
+    return best
+
+def jpeg_quality(source, width, image):
+    """
+    Return the JPEG quality to save image (the variant of source at width, 
+    None for full size) with, or None to leave it up to ImageMagick.
+    
+    The result is looked up in (or added to) the manifest. Variants that are 
+    the same width but look different (squares, cropped one way or another) 
+    can pass the same kind they give cached_variant() as width, so they each 
+    get their own entry.
+    """
+    if JPEG_QUALITY_MODE is None:
+        return None
+    
+    qualities = get_manifest().entry(source).setdefault("quality", {})
+    key = str(width or "full")
+    
+    if key in qualities:
+        return qualities[key]
+    
+    size = FULL_SIZE_QUALITY_WIDTH
+    
+    if width is None and max(image.width, image.height) > size:
+        if str(size) not in qualities:
+            with image.clone() as resized:
+                resized.transform(resize=f"{size}x{size}>")
+                qualities[str(size)] = search_quality(resized)
+        
+        qualities[key] = qualities[str(size)]
+    else:
+        qualities[key] = search_quality(image)
+    
+    return qualities[key]
+
+def make_placeholder(source):
+    """
+    Return a data URI for a PLACEHOLDER_WIDTH pixel wide, blurred JPEG version
+    of the image at source. 
+    
+    Returns None for images with transparency, since the placeholder would 
+    show through.
+    """
+    with open_image(source, PLACEHOLDER_WIDTH) as image:
+        if image.alpha_channel:
+            return None
+        
+        image.transform(resize=f"{PLACEHOLDER_WIDTH}x{PLACEHOLDER_WIDTH}>")
+        image.gaussian_blur(sigma=PLACEHOLDER_BLUR)
+        image.strip()
+        image.format = "jpeg"
+        image.compression_quality = PLACEHOLDER_QUALITY
+        
+        encoded = base64.b64encode(image.make_blob()).decode("ascii")
+    
+    return f"data:image/jpeg;base64,{encoded}"
+
+def placeholder(source):
+    """
+    Return the placeholder data URI for the image at source (or None), from 
+    the manifest if it's been made before.
+    """
+    entry = get_manifest().entry(source)
+    
+    if "placeholder" not in entry:
+        entry["placeholder"] = make_placeholder(source)
+    
+    return entry["placeholder"]
+
+def store_object(digest, ext):
+    """
+    Return the path in the store for contents with the given sha1.
+    """
+    return os.path.join(STORE_PATH, digest[:2], f"{digest}{ext.lower()}")
+
+def link(source, dest):
+    """
+    Replace dest with a hard link to source, or a copy if they're on 
+    different filesystems.
+    """
+    temp_path = f"{dest}.link"
+    
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copy2(source, temp_path)
+    
+    os.replace(temp_path, dest)
+
+def store(path):
+    """
+    Add the file at path to the store, and return its sha1. 
+    
+    If the store already has a file with the same contents, path is replaced 
+    with a link to it.
+    """
+    digest = file_digest(path)
+    store_path = store_object(digest, os.path.splitext(path)[1])
+    
+    if not os.path.exists(store_path):
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        link(path, store_path)
+    elif not os.path.samefile(path, store_path):
+        link(store_path, path)
+    
+    return digest
+
+def cached_variant(source, kind, dest, make, force=False):
+    """
+    Put the variant of the image at source identified by kind (its width, 
+    say) at dest.
+    
+    If that variant of an image with the same contents has been made before, 
+    dest is linked to the copy in the store. Otherwise (or if force is True) 
+    make(path) is called to write the variant to a temporary path, which is 
+    stripped of its metadata (see strip_metadata.py), then moved into place 
+    and added to the store.
+    
+    Returns True if the variant was made, False if it came from the store.
+    """
+    variants = get_manifest().entry(source).setdefault("variants", {})
+    base, ext = os.path.splitext(dest)
+    
+    digest = variants.get(kind)
+    
+    if digest and not force:
+        store_path = store_object(digest, ext)
+        
+        if os.path.exists(store_path):
+            if not (os.path.exists(dest) and os.path.samefile(store_path, dest)):
+                link(store_path, dest)
+            return False
+    
+    # keep the extension, ImageMagick picks the format from it
+    temp_path = f"{base}.new{ext}"
+    
+    try:
+        make(temp_path)
+        strip_variant(temp_path)
+        os.replace(temp_path, dest)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    variants[kind] = store(dest)
+    
+    return True
@@ -0,0 +1,251 @@
+"""
+Minifier
+
+Shrinks the generated HTML, and the CSS and JS in the output, in place:
+
+  - HTML: comments are removed and runs of whitespace are collapsed to a 
+    single space. The contents of <pre>, <textarea> and <script> are left 
+    exactly as they are (so code listings are untouched), and <style> blocks
+    are minified as CSS.
+  - CSS: comments are removed, whitespace is collapsed, and dropped entirely
+    around braces, semicolons, commas and after colons.
+  - JS: only the safe stuff - indentation, blank lines and whole-line 
+    comments are removed. Line breaks are kept, so automatic semicolon 
+    insertion still works. Files that are already minified (*.min.js) are 
+    skipped.
+
+Files are processed in parallel, and the hash of each minified file is saved
+to MANIFEST_PATH, so files that haven't changed since the last run are 
+skipped.
+
+Run it after responsive_postprocess.py, and before fingerprint.py (so the 
+hashed copies are made from the minified files), from the _build directory:
+
+$ python minify.py
+"""
+import os
+import hashlib
+import json
+import multiprocessing
+import re
+
+from buildprofile import profiled, span
+from fingerprint import HASHED_NAME, walk
+
+PATH = os.path.abspath("../") # the path to scan for files to minify
+
+# folders (relative to PATH) whose CSS and JS are minified
+ASSET_DIRS = ("theme", "js")
+
+MANIFEST_PATH = os.path.abspath("cache/minify_manifest.json")
+
+WORKERS = None  # None means one per CPU
+
+# elements whose contents are left alone in HTML (style is handled separately)
+HTML_RAW = re.compile(
+    r"(<(pre|textarea|script)\b.*?</\2\s*>)|(<style\b[^>]*>)(.*?)(</style\s*>)|(<!--.*?-->)",
+    re.IGNORECASE | re.DOTALL)
+
+WHITESPACE = re.compile(r"\s+")
+
+# strings and comments in CSS
+CSS_TOKENS = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(/\*.*?\*/)""", re.DOTALL)
+
+CSS_PUNCTUATION = re.compile(r"\s*([{};,])\s*")
+CSS_COLON = re.compile(r":\s+")
+
+def minify_css(css):
+    """
+    Minify a stylesheet.
+    """
+    parts = []
+    pos = 0
+    
+    def squeeze(text):
+        text = WHITESPACE.sub(" ", text)
+        text = CSS_PUNCTUATION.sub(r"\1", text)
+        text = CSS_COLON.sub(":", text)
+        return text.replace(";}", "}")
+    
+    text = ""
+    
+    for matches in CSS_TOKENS.finditer(css):
+        # comments are dropped, so the text around them is squeezed together
+        text += css[pos:matches.start()]
+        
+        if matches.group(1):
+            # strings stay as-is
+            parts.append(squeeze(text))
+            parts.append(matches.group(1))
+            text = ""
+        
+        pos = matches.end()
+    
+    parts.append(squeeze(text + css[pos:]))
+    
+    # squeeze() runs on the pieces between strings, so there may be a ;} 
+    # across a boundary
+    return "".join(parts).replace(";}", "}").strip()
+
+def minify_js(js):
+    """
+    Conservatively minify a script, keeping the line structure.
+    """
+    lines = []
+    in_comment = False
+    
+    for line in js.splitlines():
+        stripped = line.strip()
+        
+        if in_comment:
+            if "*/" in stripped:
+                in_comment = False
+                stripped = stripped[stripped.index("*/")+2:].strip()
+            else:
+                continue
+        
+        if stripped.startswith("/*"):
+            if "*/" not in stripped:
+                in_comment = True
+                continue
+            if stripped.endswith("*/") and stripped.index("*/") == len(stripped) - 2:
+                continue
+        
+        if not stripped or stripped.startswith("//"):
+            continue
+        
+        lines.append(stripped)
+    
+    return "\n".join(lines)
+
+def minify_html(html):
+    """
+    Minify an HTML page, leaving preformatted content alone.
+    """
+    parts = []
+    pos = 0
+    
+    for matches in HTML_RAW.finditer(html):
+        parts.append(WHITESPACE.sub(" ", html[pos:matches.start()]))
+        
+        raw, tag, style_open, style, style_close, comment = matches.group(1, 2, 3, 4, 5, 6)
+        
+        if raw:
+            parts.append(raw)
+        elif style_open:
+            parts.append(f"{style_open}{minify_css(style)}{style_close}")
+        elif comment.startswith(("<!--[if", "<!--!")):
+            # conditional and "important" comments stay
+            parts.append(comment)
+        
+        pos = matches.end()
+    
+    parts.append(WHITESPACE.sub(" ", html[pos:]))
+    
+    return "".join(parts).strip()
+
+MINIFIERS = {
+    ".html": minify_html,
+    ".css": minify_css,
+    ".js": minify_js
+}
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+def wanted(path):
+    """
+    Decide if the file at path should be minified.
+    """
+    name = os.path.basename(path)
+    base, ext = os.path.splitext(name)
+    
+    if ext not in MINIFIERS or HASHED_NAME.match(name) or name.endswith(".min.js"):
+        return False
+    
+    if ext == ".html":
+        return True
+    
+    return os.path.relpath(path, PATH).split(os.path.sep)[0] in ASSET_DIRS
+
+@profiled("minify", "minify", lambda args: {"file": args[0]})
+def minify_file(args):
+    """
+    Minify the file at path in place, unless its hash matches known (the hash
+    recorded the last time it was minified).
+    
+    Returns (path, extension, bytes before, bytes after, new hash), or None 
+    for the sizes if the file was skipped.
+    """
+    path, known = args
+    ext = os.path.splitext(path)[1]
+    
+    with open(path, "rb") as fp:
+        data = fp.read()
+    
+    current = digest(data)
+    
+    if current == known:
+        return path, ext, None, None, current
+    
+    minified = MINIFIERS[ext](data.decode("utf-8")).encode("utf-8")
+    
+    if minified != data:
+        temp_path = f"{path}.new"
+        with open(temp_path, "wb") as fp:
+            fp.write(minified)
+        os.replace(temp_path, path)
+    
+    return path, ext, len(data), len(minified), digest(minified)
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest):
+    directory = os.path.dirname(MANIFEST_PATH)
+    
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    with open(MANIFEST_PATH, "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+
+def process_dir(basepath):
+    print(f"MINIFYING {basepath}...")
+    print("====================================")
+    
+    manifest = load_manifest()
+    
+    jobs = [(path, manifest.get(path)) for path in walk(basepath) if wanted(path)]
+    
+    with multiprocessing.Pool(WORKERS) as pool:
+        results = pool.map(minify_file, jobs, chunksize=8)
+    
+    totals = {}
+    
+    for path, ext, before, after, new_digest in results:
+        manifest[path] = new_digest
+        
+        files, skipped, total_before, total_after = totals.get(ext, (0, 0, 0, 0))
+        
+        if before is None:
+            totals[ext] = (files, skipped + 1, total_before, total_after)
+        else:
+            totals[ext] = (files + 1, skipped, total_before + before, total_after + after)
+    
+    save_manifest(manifest)
+    
+    print(f"{'type':<6} {'files':>7} {'skipped':>8} {'before':>12} {'after':>12} {'saved':>12}")
+    
+    for ext, (files, skipped, before, after) in sorted(totals.items()):
+        saved = before - after
+        percent = (saved / before * 100) if before else 0
+        print(f"{ext:<6} {files:>7} {skipped:>8} {before:>12} {after:>12} {saved:>12} ({percent:.1f}%)")
+
+if __name__ == "__main__":
+    with span("minify", "stage"):
+        process_dir(PATH)
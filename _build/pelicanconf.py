@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*- #
 from __future__ import unicode_literals
-from num2words import num2words
+import os
+import sys
+sys.path.append(os.curdir)
+from functools import lru_cache
 
+from jinja2 import FileSystemBytecodeCache
+
+@lru_cache(maxsize=1024)
 def my_plural(amount, single, plural):
     """
     Filter to pluralize a grouping word, like so:
@@ -18,6 +24,9 @@ def my_plural(amount, single, plural):
     inspired by: https://stackoverflow.com/a/11715582
     """
     
+    # only needed once the filter's used, and slow to import
+    from num2words import num2words
+    
     amount = int(amount)
     
     if amount == 1 or amount == 0 or amount == -1:
@@ -33,17 +42,37 @@ JINJA_FILTERS = {
     'pluralize': my_plural
 }
 
+# compiled templates are kept here, so they're only recompiled when they change
+JINJA_BYTECODE_CACHE = os.path.abspath("cache/jinja")
+os.makedirs(JINJA_BYTECODE_CACHE, exist_ok=True)
+
+# pelican's defaults, plus the cache
+JINJA_ENVIRONMENT = {
+    'trim_blocks': True,
+    'lstrip_blocks': True,
+    'extensions': [],
+    'bytecode_cache': FileSystemBytecodeCache(JINJA_BYTECODE_CACHE)
+}
+
 #CACHE_CONTENT = True
 #LOAD_CONTENT_CACHE = True
 #CACHE_PATH = "./cache"
 STATIC_CHECK_IF_MODIFIED=True
+# hard link static files (mostly images) into the output instead of copying 
+# them. Everything that changes files in the output replaces them rather than
+# writing in place, so the sources are safe
+STATIC_CREATE_LINKS = True
 
 AUTHOR = 'jjmojojjmojo'
 SITENAME = 'The Collected Works of jjmojojjmojo'
 SITEURL = ''
 
 PLUGIN_PATHS = ["plugins", "pelican-plugins"]
-PLUGINS = ["explanation", "pelican-toc", "summary"]
+PLUGINS = ["explanation", "pelican-toc", "summary", "write_if_changed", "depgraph",
+           "streaming_feeds", "search_index", "profiler"]
+
+# only extract summaries when a template or feed actually reads them
+SUMMARY_LAZY = True
 
 PATH = 'content'
 OUTPUT_PATH = "output"
@@ -118,6 +147,9 @@ STATIC_PATHS = ['images', 'files', 'js', 'videos', 'attachments']
 
 TEMPLATE_PAGES = {'pages.html': 'pages/index.html'}
 
+DIRECT_TEMPLATES = ['index', 'tags', 'categories', 'authors', 'archives', 
+                    'search']
+
 DEFAULT_METADATA = {
     'status': 'draft',
 }
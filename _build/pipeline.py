@@ -0,0 +1,232 @@
+"""
+Post-Processing Pipeline
+
+Runs every post-processing stage, in order, on a staged copy of the site, and
+only publishes the result once they've all finished. Run on their own, each
+stage rewrites the live files as it goes, so for most of "make postprocess"
+the preview server would serve a mix of old and new pages (and pages that
+point at assets that haven't been fingerprinted yet).
+
+The staged copy is made of hard links to the live files, so it's quick to
+make and takes no extra space; every stage replaces the files it changes
+rather than writing them in place, so the live files are never touched.
+
+Publishing works like responsive_postprocess.publish():
+
+  - if PATH is a symlink to the real output directory, the symlink is
+    atomically swapped to the staged tree, so the whole site changes at once
+  - otherwise (the root of this repository, which also holds _build and .git
+    and can't be swapped out) the files the stages changed are moved into 
+    place, and the ones they removed are deleted, in one quick pass at the
+    end. Live files that changed while the stages ran (pelican was run again,
+    say) are left alone. This pass isn't atomic, so a request during it can
+    get a mix of old and new files
+
+Run from the _build directory (this is what "make postprocess" does):
+
+$ python pipeline.py
+"""
+import os, shutil
+import importlib
+from datetime import datetime
+
+from buildprofile import span
+from fingerprint import IGNORE_PATHS
+import responsive_postprocess
+
+PATH = os.path.abspath("../") # the site to process
+
+STAGING_NAME = ".pipeline"
+
+def run_responsive_postprocess(stage, staging):
+    stage.apply_resource_limits()
+
+    if stage.ONLY_CHANGED:
+        # the report lists the live files
+        for path in stage.changed_files(basepath=PATH):
+            stage.process_file(os.path.join(staging, os.path.relpath(path, PATH)))
+    else:
+        stage.process_dir(staging)
+
+    stage.get_manifest().save()
+
+def run_process_dir(stage, staging):
+    stage.process_dir(staging)
+
+# (module, how to run it on the staged tree), in order
+STAGES = (
+    ("responsive_postprocess", run_responsive_postprocess),
+    ("strip_metadata", run_process_dir),
+    ("critical_css", run_process_dir),
+    ("minify", run_process_dir),
+    ("fingerprint", run_process_dir),
+    ("preload_manifest", run_process_dir),
+)
+
+def site_files(basepath, path=None):
+    """
+    Yield the path of every file (and symlink) in the site under basepath,
+    skipping IGNORE_PATHS and anything starting with _ or ., like the stages
+    themselves do.
+    """
+    for entry in os.scandir(path or basepath):
+        if entry.name.startswith(("_", ".")):
+            continue
+
+        full_path = os.path.abspath(entry.path)
+
+        if entry.is_dir(follow_symlinks=False):
+            if full_path not in IGNORE_PATHS:
+                yield from site_files(basepath, full_path)
+        else:
+            yield full_path
+
+def identity(path):
+    """
+    Return something that changes whenever the file at path is replaced: its
+    inode, or its target if it's a symlink.
+    """
+    if os.path.islink(path):
+        return ("link", os.readlink(path))
+
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino)
+
+def stage_site(basepath=PATH):
+    """
+    Return (staged copy, snapshot) for the site at basepath. The copy is made
+    of hard links, and the snapshot is {relative path: identity()} of what
+    was staged.
+
+    The copy is made inside the real directory basepath points to, so it's on
+    the same filesystem, and the stages skip it since it starts with a '.'.
+    Anything left over from a run that failed is thrown away.
+    """
+    live = os.path.realpath(basepath)
+    staging = os.path.join(live, STAGING_NAME)
+
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+
+    os.makedirs(staging)
+
+    if os.path.islink(basepath):
+        # the whole directory is swapped, so everything in it is staged
+        responsive_postprocess.link_tree(live, staging)
+        return staging, {}
+
+    snapshot = {}
+
+    for path in site_files(live):
+        relpath = os.path.relpath(path, live)
+        target = os.path.join(staging, relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        if os.path.islink(path):
+            os.symlink(os.readlink(path), target)
+        else:
+            os.link(path, target)
+
+        snapshot[relpath] = identity(target)
+
+    return staging, snapshot
+
+def run_stage(module, run, staging):
+    """
+    Import the stage's module, point it at the staged tree, and run it.
+    """
+    stage = importlib.import_module(module)
+
+    for name in ("PATH", "DOCUMENT_ROOT"):
+        if hasattr(stage, name):
+            setattr(stage, name, staging)
+
+    if hasattr(stage, "IGNORE_PATHS"):
+        stage.IGNORE_PATHS = []
+
+    with span(module, "stage"):
+        run(stage, staging)
+
+def swap(staging, basepath):
+    """
+    Atomically point the basepath symlink at staging, and remove the old tree.
+    """
+    live = os.path.realpath(basepath)
+    parent = os.path.dirname(os.path.abspath(basepath))
+
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    new_tree = os.path.join(os.path.dirname(live),
+                            f"{os.path.basename(basepath)}.{stamp}")
+    os.rename(staging, new_tree)
+
+    temp_link = os.path.join(parent, f".{os.path.basename(basepath)}.{stamp}")
+    os.symlink(os.path.relpath(new_tree, parent), temp_link)
+    os.replace(temp_link, basepath)
+
+    shutil.rmtree(live)
+
+def sync(staging, basepath, snapshot):
+    """
+    Move the files the stages changed in staging over the live ones, and 
+    delete the live files they removed from staging, unless the live file has
+    changed since it was staged. Returns (files replaced, files removed).
+    """
+    live = os.path.realpath(basepath)
+    staged = set()
+    replaced = 0
+    removed = 0
+
+    for path in site_files(staging):
+        relpath = os.path.relpath(path, staging)
+        staged.add(relpath)
+
+        if snapshot.get(relpath) == identity(path):
+            continue
+
+        target = os.path.join(live, relpath)
+
+        if relpath in snapshot and (not os.path.lexists(target) or 
+                                    identity(target) != snapshot[relpath]):
+            # changed (or removed) since it was staged, the next run will
+            # pick it up
+            continue
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+        replaced += 1
+
+    for path in site_files(live):
+        relpath = os.path.relpath(path, live)
+
+        if relpath in snapshot and relpath not in staged and \
+           snapshot[relpath] == identity(path):
+            os.remove(path)
+            removed += 1
+
+    shutil.rmtree(staging)
+
+    return replaced, removed
+
+def publish(staging, snapshot, basepath=PATH):
+    with span("publish", "postprocess"):
+        if os.path.islink(basepath):
+            swap(staging, basepath)
+            print(f"Published {basepath}")
+        else:
+            print(f"WARNING: {basepath} isn't a symlink, so its files are "
+                  "replaced one by one, not atomically")
+            replaced, removed = sync(staging, basepath, snapshot)
+            print(f"Published {basepath}: {replaced} files replaced, "
+                  f"{removed} removed")
+
+def process_site(basepath=PATH):
+    with span("stage_site", "postprocess"):
+        staging, snapshot = stage_site(basepath)
+
+    for module, run in STAGES:
+        run_stage(module, run, staging)
+
+    publish(staging, snapshot, basepath)
+
+if __name__ == "__main__":
+    process_site(PATH)
@@ -0,0 +1,447 @@
+"""
+Dependency Graph
+----------------
+
+Records which source files and templates went into every file pelican writes,
+and skips rendering an output entirely when none of them have changed since 
+the last build. A tag edit in one article then only re-renders that article,
+the tag, category and author pages and feeds it appears in, and the listings
+that include it, instead of the whole site.
+
+An output's signature covers:
+
+  - the source file of every article/page passed to the template for it (or
+    all of them, for things like the index and archives), and the files they
+    pull in with the reST include directive
+  - the template, and every template it extends, includes or imports
+  - the site's URL map, so renamed articles invalidate links to them
+  - the (serializable) settings, the files that define the functions in them
+    (like the Jinja filters in pelicanconf.py), and the plugins' code
+
+The graph is saved to DEPGRAPH_PATH, as {output: {signature, sources, 
+templates}}.
+
+Outputs that are skipped aren't written, so the content_written and 
+feed_written signals aren't sent for them.
+
+Set DEPGRAPH_CHECK to True to render everything anyway and log an error for 
+every output the graph would have wrongly skipped. This needs the 
+write_if_changed plugin, which must come before this one in PLUGINS. Pelican
+checks -e/--extra-settings before it loads any plugins, and ignores settings
+it doesn't know about, so to turn the check on for a single run, set the 
+DEPGRAPH_CHECK environment variable instead (this is what "make 
+depgraph-check" does).
+"""
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+
+from pelican import signals
+from pelican.contents import Content
+
+from write_if_changed import register_writer_mixin
+import write_if_changed
+
+logger = logging.getLogger(__name__)
+
+# keyword arguments that hold content that's available to, but not really 
+# rendered by, the template
+IGNORE_KWARGS = ('all_articles',)
+
+# settings that have no bearing on the output
+IGNORE_SETTINGS = ('DEPGRAPH_CHECK',)
+
+# the context lists used when a template isn't given specific content
+CONTEXT_LISTS = ('articles', 'drafts', 'pages', 'hidden_pages')
+
+TEMPLATE_REFERENCE = re.compile(
+    r"""{%-?\s*(?:extends|include|import|from)\s+["']([^"']+)["']""")
+
+INCLUDE_DIRECTIVE = re.compile(r"^\s*\.\.\s+include::\s*(\S.*?)\s*$", re.MULTILINE)
+
+_graph = {}
+_signatures = {}
+_includes = {}
+_code_files = []
+_stale = []
+_skipped = 0
+
+def initialized(pelican):
+    from pelican.settings import DEFAULT_CONFIG
+    
+    cache_path = pelican.settings.get('CACHE_PATH', DEFAULT_CONFIG['CACHE_PATH'])
+    
+    DEFAULT_CONFIG.setdefault('DEPGRAPH_PATH', 
+                              os.path.join(cache_path, 'dependencies.json'))
+    DEFAULT_CONFIG.setdefault('DEPGRAPH_CHECK', False)
+    pelican.settings.setdefault('DEPGRAPH_PATH', DEFAULT_CONFIG['DEPGRAPH_PATH'])
+    pelican.settings.setdefault('DEPGRAPH_CHECK', False)
+    
+    if os.environ.get('DEPGRAPH_CHECK'):
+        pelican.settings['DEPGRAPH_CHECK'] = True
+    
+    _graph.clear()
+    
+    del _code_files[:]
+    for plugin in [write_if_changed] + list(getattr(pelican, 'plugins', [])):
+        _code_files.extend(module_files(plugin))
+    
+    try:
+        with open(pelican.settings['DEPGRAPH_PATH']) as fp:
+            _graph.update(json.load(fp))
+    except (OSError, ValueError):
+        logger.debug("No usable dependency graph, everything will be rendered")
+
+def finalized(pelican):
+    path = pelican.settings['DEPGRAPH_PATH']
+    directory = os.path.dirname(path)
+    
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    with open(path, "w") as fp:
+        json.dump(_graph, fp, indent=1, sort_keys=True)
+    
+    if pelican.settings['DEPGRAPH_CHECK']:
+        for output in _stale:
+            logger.error(f"{output} changed, but the dependency graph would have skipped it")
+        logger.info(f"Dependency check: {len(_stale)} stale outputs")
+    else:
+        logger.info(f"{_skipped} outputs were up to date and not rendered")
+    
+    reset()
+
+def reset():
+    """
+    Clear out the per-run state, so nothing carries over between runs with 
+    --autoreload.
+    """
+    global _skipped
+    _signatures.clear()
+    _includes.clear()
+    del _stale[:]
+    _skipped = 0
+
+def _hash(*parts):
+    digest = hashlib.sha1()
+    
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(part)
+        digest.update(b"\0")
+    
+    return digest.hexdigest()
+
+def file_signature(path):
+    """
+    Hash of the contents of the file at path, memoized for the run.
+    """
+    try:
+        return _signatures[path]
+    except KeyError:
+        pass
+    
+    try:
+        with open(path, "rb") as fp:
+            signature = _hash(path, fp.read())
+    except OSError:
+        signature = _hash(path, "missing")
+    
+    _signatures[path] = signature
+    
+    return signature
+
+def module_files(module):
+    """
+    Return the source files of a module, or of every module in it if it's a
+    package.
+    """
+    path = getattr(module, '__file__', None)
+    
+    if not path:
+        return []
+    
+    if os.path.basename(path) != '__init__.py':
+        return [path]
+    
+    files = []
+    
+    for directory, dirs, names in os.walk(os.path.dirname(path)):
+        dirs[:] = sorted(name for name in dirs if name != '__pycache__')
+        files.extend(os.path.join(directory, name) for name in sorted(names)
+                     if name.endswith('.py'))
+    
+    return files
+
+def include_files(path, seen=None):
+    """
+    Return the files pulled in by the reST include directives in the file at
+    path, and the ones they include in turn. Memoized for the run.
+    """
+    try:
+        return _includes[path]
+    except KeyError:
+        pass
+    
+    if seen is None:
+        seen = set()
+    
+    seen.add(path)
+    files = []
+    
+    try:
+        with open(path, encoding="utf-8") as fp:
+            source = fp.read()
+    except (OSError, ValueError):
+        source = ""
+    
+    for target in INCLUDE_DIRECTIVE.findall(source):
+        if target.startswith("<"):
+            # one of docutils' standard includes
+            continue
+        
+        included = os.path.normpath(os.path.join(os.path.dirname(path), target))
+        
+        if included in seen:
+            continue
+        
+        files.append(included)
+        files.extend(include_files(included, seen))
+    
+    _includes[path] = files
+    
+    return files
+
+def content_signature(content):
+    """
+    Signature for an article or page, based on its source file and the files
+    it includes. 
+    
+    The source is used rather than the parsed content since plugins (like 
+    summary) modify the latter as the build goes.
+    """
+    return _hash(file_signature(content.source_path), 
+                 *[file_signature(path) for path in include_files(content.source_path)],
+                 content.url or "", content.status or "")
+
+def template_files(env, name, seen=None):
+    """
+    Return the filenames of the template with the given name, and everything it
+    extends, includes or imports.
+    """
+    if seen is None:
+        seen = set()
+    
+    if name in seen:
+        return []
+    
+    seen.add(name)
+    
+    try:
+        source, filename, _ = env.loader.get_source(env, name)
+    except Exception:
+        return []
+    
+    filename = filename or name
+    
+    # we have the source already, no need to read it again for its signature
+    _signatures.setdefault(filename, _hash(filename, source))
+    
+    files = [filename]
+    
+    for parent in TEMPLATE_REFERENCE.findall(source):
+        files.extend(template_files(env, parent, seen))
+    
+    return files
+
+def _functions(value, found):
+    value = inspect.unwrap(value) if callable(value) else value
+    
+    if inspect.isfunction(value):
+        found.append(value)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _functions(item, found)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _functions(item, found)
+
+def code_files(settings):
+    """
+    Return the files the plugins, and the functions in the settings, are
+    defined in.
+    """
+    functions = []
+    
+    for key, value in settings.items():
+        _functions(value, functions)
+    
+    files = set(_code_files)
+    
+    for function in functions:
+        try:
+            files.add(inspect.getsourcefile(function))
+        except TypeError:
+            pass
+    
+    files.discard(None)
+    
+    return sorted(files)
+
+def settings_signature(settings):
+    """
+    Hash of the settings, and the code that goes with them.
+    
+    Values that can't be serialized (like the filters) are left out, since 
+    their repr changes from run to run; the files they're defined in are 
+    hashed instead, along with the plugins' code.
+    """
+    try:
+        return _signatures[id(settings)]
+    except KeyError:
+        pass
+    
+    simple = {
+        key: value for key, value in settings.items() 
+        if key not in IGNORE_SETTINGS and isinstance(value, (str, int, float, bool, list, tuple, dict, type(None)))}
+    
+    signature = _hash(json.dumps(simple, sort_keys=True, default=lambda o: type(o).__name__),
+                      *[file_signature(path) for path in code_files(settings)])
+    
+    _signatures[id(settings)] = signature
+    
+    return signature
+
+def url_map_signature(context):
+    """
+    Hash of every article and page's source and url.
+    """
+    try:
+        return _signatures[id(context)]
+    except KeyError:
+        pass
+    
+    urls = sorted(
+        f"{content.source_path}\0{content.url}" 
+        for content in _context_content(context))
+    
+    signature = _hash(*urls)
+    
+    _signatures[id(context)] = signature
+    
+    return signature
+
+def _context_content(context):
+    for key in CONTEXT_LISTS:
+        for content in context.get(key) or []:
+            yield content
+
+def _collect(value, found):
+    if isinstance(value, Content):
+        found.append(value)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect(item, found)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _collect(item, found)
+
+def dependencies(context, kwargs):
+    """
+    Return the content objects a template is rendered from.
+    """
+    found = []
+    
+    for key, value in kwargs.items():
+        if key not in IGNORE_KWARGS:
+            _collect(value, found)
+    
+    if not found:
+        found = list(_context_content(context))
+    
+    # keep the order, it matters for listings
+    unique = []
+    seen = set()
+    for content in found:
+        if id(content) not in seen:
+            seen.add(id(content))
+            unique.append(content)
+    
+    return unique
+
+class DependencyMixin:
+    """
+    Writer mixin that skips outputs whose dependencies haven't changed.
+    """
+    def _check(self, name, context, sources, templates, render, *extra):
+        global _skipped
+        
+        signature = _hash(
+            settings_signature(self.settings),
+            url_map_signature(context),
+            name,
+            *extra,
+            *[file_signature(template) for template in templates],
+            *[content_signature(content) for content in sources])
+        
+        path = os.path.abspath(os.path.join(self.output_path, name))
+        previous = _graph.get(name, {}).get('signature')
+        up_to_date = previous == signature and os.path.exists(path)
+        
+        if up_to_date and not self.settings['DEPGRAPH_CHECK']:
+            logger.debug(f"{name} is up to date, not rendering")
+            _skipped += 1
+            return None
+        
+        result = render()
+        
+        if up_to_date and path in write_if_changed._changed:
+            _stale.append(name)
+        
+        _graph[name] = {
+            'signature': signature,
+            'sources': [content.source_path for content in sources],
+            'templates': templates
+        }
+        
+        return result
+    
+    def write_file(self, name, template, context, relative_urls=False,
+                   paginated=None, template_name=None, override_output=False,
+                   url=None, **kwargs):
+        if not name:
+            return super().write_file(name, template, context, relative_urls, 
+                paginated, template_name, override_output, url, **kwargs)
+        
+        sources = dependencies(context, dict(kwargs, paginated=paginated))
+        
+        templates = template_files(template.environment, template.name)
+        
+        return self._check(
+            name, context, sources, templates,
+            lambda: super(DependencyMixin, self).write_file(
+                name, template, context, relative_urls, paginated, 
+                template_name, override_output, url, **kwargs),
+            str(relative_urls))
+    
+    def write_feed(self, elements, context, path=None, url=None,
+                   feed_type='atom', override_output=False, feed_title=None):
+        if not path:
+            return super().write_feed(elements, context, path, url, feed_type,
+                                      override_output, feed_title)
+        
+        return self._check(
+            path, context, list(elements), [],
+            lambda: super(DependencyMixin, self).write_feed(
+                elements, context, path, url, feed_type, override_output, 
+                feed_title),
+            feed_type, feed_title or "")
+
+def register():
+    signals.initialized.connect(initialized)
+    signals.finalized.connect(finalized)
+    register_writer_mixin(DependencyMixin)
@@ -0,0 +1,156 @@
+"""
+Profiler
+--------
+
+Hooks pelican up to the build profiler (see buildprofile.py in the _build 
+directory), recording spans for:
+
+  - each generator's context and output phases
+  - reading each reStructuredText file
+  - each Pygments highlight
+  - every signal handler, so plugins like summary and explanation show up 
+    under their own names
+  - each template compiled (templates loaded from the bytecode cache aren't)
+    and each template render
+  - each file and feed written (skipped outputs don't get a span), and each
+    feed entry the streaming_feeds plugin renders (rather than takes from 
+    its cache)
+
+Nothing is patched unless the BUILD_PROFILE environment variable is set, so
+it costs nothing otherwise.
+
+Writer spans need the write_if_changed plugin, and feed entry spans the 
+streaming_feeds plugin, which must come before this one in PLUGINS.
+"""
+import logging
+import sys
+from functools import wraps
+
+from buildprofile import ENABLED, Span
+
+logger = logging.getLogger(__name__)
+
+GENERATOR_METHODS = ('generate_context', 'generate_output')
+
+def instrument(owner, attribute, name, category, describe=None):
+    """
+    Replace owner.attribute with a version that records a span each time 
+    it's called.
+    """
+    original = getattr(owner, attribute)
+    
+    @wraps(original)
+    def wrapper(*args, **kwargs):
+        details = describe(*args, **kwargs) if describe else {}
+        with Span(name, category, details):
+            return original(*args, **kwargs)
+    
+    setattr(owner, attribute, wrapper)
+
+def instrument_generators():
+    from pelican import generators
+    
+    for value in vars(generators).values():
+        if not (isinstance(value, type) and 
+                issubclass(value, generators.Generator)):
+            continue
+        
+        for method in GENERATOR_METHODS:
+            # only patch where it's defined, or subclasses get two spans
+            if method in vars(value):
+                instrument(value, method, f"{value.__name__}.{method}", 
+                           "generator")
+
+def instrument_signals():
+    """
+    Wrap each receiver as blinker hands it out, so every handler gets its own
+    span.
+    """
+    from blinker import Signal
+    
+    receivers_for = Signal.receivers_for
+    
+    def traced_receivers_for(self, sender):
+        signal = getattr(self, 'name', None) or 'signal'
+        
+        for receiver in receivers_for(self, sender):
+            yield traced(receiver, signal)
+    
+    Signal.receivers_for = traced_receivers_for
+
+def traced(receiver, signal):
+    name = (f"{getattr(receiver, '__module__', '')}."
+            f"{getattr(receiver, '__qualname__', repr(receiver))}")
+    
+    def wrapper(sender, **kwargs):
+        with Span(name, "plugin", {"signal": signal}):
+            return receiver(sender, **kwargs)
+    
+    return wrapper
+
+def instrument_readers():
+    from pelican import readers
+    
+    instrument(readers.RstReader, 'read', "rst", "reader", 
+               lambda self, source_path: {"file": source_path})
+
+def instrument_pygments():
+    import pygments
+    from pelican import rstdirectives
+    
+    describe = lambda code, lexer, formatter, outfile=None: {
+        "lexer": getattr(lexer, 'name', lexer)}
+    
+    # pelican imports highlight by name, so patch both
+    instrument(pygments, 'highlight', "pygments", "highlight", describe)
+    rstdirectives.highlight = pygments.highlight
+
+def instrument_templates():
+    from jinja2 import Environment, Template
+    
+    instrument(Environment, 'compile', "compile", "template",
+               lambda self, source, name=None, *args, **kwargs: {"template": name})
+    instrument(Template, 'render', "render", "template", 
+               lambda self, *args, **kwargs: {"template": self.name})
+
+def instrument_feeds():
+    # only if the plugin is in use, it's imported before this one
+    streaming_feeds = sys.modules.get('streaming_feeds')
+    
+    if streaming_feeds is not None:
+        instrument(streaming_feeds.StreamingFeedMixin, '_render_entry', 
+                   "feed entry", "writer", 
+                   lambda self, feed, item: {"file": item.source_path, 
+                                             "feed": type(feed).__name__})
+
+class ProfileMixin:
+    """
+    Records a span for every file and feed that's actually written.
+    """
+    def write_file(self, name, template, context, *args, **kwargs):
+        with Span("write", "writer", {"file": name}):
+            return super().write_file(name, template, context, *args, **kwargs)
+    
+    def write_feed(self, elements, context, path=None, *args, **kwargs):
+        with Span("feed", "writer", {"file": path}):
+            return super().write_feed(elements, context, path, *args, **kwargs)
+
+def register():
+    if not ENABLED:
+        return
+    
+    logger.info("Build profiling is on")
+    
+    instrument_generators()
+    instrument_signals()
+    instrument_readers()
+    instrument_pygments()
+    instrument_templates()
+    instrument_feeds()
+    
+    try:
+        from write_if_changed import register_writer_mixin
+    except ImportError:
+        logger.warning("write_if_changed is not available, writes won't be profiled")
+    else:
+        register_writer_mixin(ProfileMixin)
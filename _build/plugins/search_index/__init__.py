@@ -0,0 +1,282 @@
+"""
+Search Index
+------------
+
+Builds an inverted index of the published articles for the client-side 
+search page (see search.js in the theme), so the site can have search while
+staying static.
+
+Each article's title, tags, summary and body text are broken into terms, and
+each term gets a score for the article (title matches count most, then tags, 
+the summary and the body, per SEARCH_WEIGHTS). The index is split into shards
+by the first SEARCH_PREFIX_LENGTH characters of each term, and every shard is
+written as gzipped JSON to SEARCH_INDEX_DIR in the output, so the browser 
+only fetches the shards for the words being searched for:
+
+    search/index.json        the shard names and the location of the rest
+    search/documents.json.gz {id: {title, url, date, summary}}
+    search/<prefix>.json.gz  {term: [id, score, id, score, ...]}
+
+The terms for each article are kept in SEARCH_INDEX_CACHE, keyed by the 
+article's signature, so only new and changed articles are re-read. Shard 
+files are only rewritten when their contents change.
+
+Article signatures come from the depgraph plugin, which must come before this
+one in PLUGINS.
+"""
+import gzip
+import html
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+from pelican import signals
+from pelican.generators import ArticlesGenerator
+
+from depgraph import content_signature, _hash
+
+logger = logging.getLogger(__name__)
+
+TERM = re.compile(r"[^\W_]+")
+TAG = re.compile(r"<[^>]*>")
+SAFE_PREFIX = re.compile(r"^[a-z0-9]+$")
+
+DEFAULTS = {
+    'SEARCH_INDEX_DIR': 'search',
+    'SEARCH_PREFIX_LENGTH': 2,
+    'SEARCH_MIN_TERM_LENGTH': 2,
+    'SEARCH_WEIGHTS': {'title': 10, 'tags': 6, 'summary': 3, 'body': 1},
+    'SEARCH_SUMMARY_LENGTH': 200,
+    'SEARCH_STOPWORDS': (
+        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 
+        'in', 'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that',
+        'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was', 
+        'will', 'with'),
+}
+
+# {source path: [signature, id, document, {term: score}]}
+_documents = {}
+
+# {source path: id}, kept so ids (and the shards that use them) are stable
+_ids = {}
+
+_read = 0
+
+def initialized(pelican):
+    from pelican.settings import DEFAULT_CONFIG
+    
+    cache_path = pelican.settings.get('CACHE_PATH', DEFAULT_CONFIG['CACHE_PATH'])
+    
+    defaults = dict(DEFAULTS, 
+                    SEARCH_INDEX_CACHE=os.path.join(cache_path, 'search_index.json'))
+    
+    for name, value in defaults.items():
+        DEFAULT_CONFIG.setdefault(name, value)
+        pelican.settings.setdefault(name, value)
+    
+    _documents.clear()
+    _ids.clear()
+    
+    try:
+        with open(pelican.settings['SEARCH_INDEX_CACHE']) as fp:
+            cached = json.load(fp)
+            _documents.update(cached['documents'])
+            _ids.update(cached['ids'])
+    except (OSError, ValueError, KeyError):
+        logger.debug("No usable search index cache, all articles will be indexed")
+
+def plain_text(markup):
+    return html.unescape(TAG.sub(" ", markup or ""))
+
+def terms(text, settings):
+    """
+    Yield the indexable terms in text.
+    """
+    minimum = settings['SEARCH_MIN_TERM_LENGTH']
+    stopwords = settings['SEARCH_STOPWORDS']
+    
+    for term in TERM.findall(text.lower()):
+        if len(term) >= minimum and term not in stopwords and not term.isdigit():
+            yield term
+
+def score_terms(fields, settings):
+    """
+    Return {term: score} for a document, given {field name: text}.
+    
+    Repeated terms count for less each time (1 + log of the count), so long
+    articles don't drown out short ones.
+    """
+    weights = settings['SEARCH_WEIGHTS']
+    scores = defaultdict(float)
+    
+    for field, text in fields.items():
+        for term, count in Counter(terms(text, settings)).items():
+            scores[term] += weights.get(field, 1) * (1 + math.log(count))
+    
+    return {term: max(1, round(score)) for term, score in scores.items()}
+
+def index_article(article, settings):
+    """
+    Return (document, {term: score}) for article.
+    """
+    summary = plain_text(getattr(article, 'summary', ''))
+    tags = " ".join(tag.name for tag in getattr(article, 'tags', []))
+    
+    fields = {
+        'title': plain_text(article.title),
+        'tags': tags,
+        'summary': summary,
+        'body': plain_text(article.content)
+    }
+    
+    summary = " ".join(summary.split())
+    limit = settings['SEARCH_SUMMARY_LENGTH']
+    if len(summary) > limit:
+        summary = summary[:limit].rsplit(" ", 1)[0] + "…"
+    
+    document = {
+        'title': fields['title'],
+        'url': article.url,
+        'date': article.date.strftime("%Y-%m-%d"),
+        'summary': summary
+    }
+    
+    return document, score_terms(fields, settings)
+
+def settings_key(settings):
+    return _hash(*(repr(settings[name]) for name in sorted(DEFAULTS)))
+
+def all_generators_finalized(generators):
+    global _read
+    
+    for generator in generators:
+        if not isinstance(generator, ArticlesGenerator):
+            continue
+        
+        settings = generator.settings
+        key = settings_key(settings)
+        current = set()
+        
+        for article in generator.articles:
+            source = article.source_path
+            signature = _hash(key, content_signature(article))
+            current.add(source)
+            
+            if source not in _ids:
+                _ids[source] = max(_ids.values(), default=-1) + 1
+            
+            cached = _documents.get(source)
+            
+            if cached is not None and cached[0] == signature:
+                continue
+            
+            document, scores = index_article(article, settings)
+            _documents[source] = [signature, _ids[source], document, scores]
+            _read += 1
+        
+        # drop articles that have been deleted or unpublished
+        for source in list(_documents):
+            if source not in current:
+                del _documents[source]
+
+def shard_name(prefix):
+    """
+    File name (without the extension) for the shard of terms starting with 
+    prefix. Anything that isn't plain ascii is hex encoded.
+    """
+    if SAFE_PREFIX.match(prefix):
+        return prefix
+    
+    return "_" + prefix.encode("utf-8").hex()
+
+def write_if_different(path, data):
+    """
+    Write data (bytes) to path, unless it already holds exactly that. Returns
+    True if the file was written.
+    """
+    try:
+        with open(path, "rb") as fp:
+            if fp.read() == data:
+                return False
+    except OSError:
+        pass
+    
+    temp_path = f"{path}.new"
+    with open(temp_path, "wb") as fp:
+        fp.write(data)
+    os.replace(temp_path, path)
+    
+    return True
+
+def compress(value):
+    # mtime=0 so unchanged contents produce identical bytes
+    return gzip.compress(
+        json.dumps(value, separators=(",", ":"), sort_keys=True).encode("utf-8"),
+        mtime=0)
+
+def finalized(pelican):
+    global _read
+    
+    settings = pelican.settings
+    length = settings['SEARCH_PREFIX_LENGTH']
+    directory = os.path.join(settings['OUTPUT_PATH'], settings['SEARCH_INDEX_DIR'])
+    
+    os.makedirs(directory, exist_ok=True)
+    
+    shards = defaultdict(dict)
+    documents = {}
+    
+    for source, (signature, id, document, scores) in sorted(
+            _documents.items(), key=lambda item: item[1][1]):
+        documents[id] = document
+        
+        for term, score in scores.items():
+            shards[term[:length]].setdefault(term, []).extend((id, score))
+    
+    files = {f"{shard_name(prefix)}.json.gz": postings 
+             for prefix, postings in shards.items()}
+    files["documents.json.gz"] = documents
+    
+    written = 0
+    
+    for name, value in files.items():
+        written += write_if_different(os.path.join(directory, name), compress(value))
+    
+    manifest = {
+        'prefix_length': length,
+        'min_term_length': settings['SEARCH_MIN_TERM_LENGTH'],
+        'stopwords': list(settings['SEARCH_STOPWORDS']),
+        'documents': "documents.json.gz",
+        'shards': {prefix: f"{shard_name(prefix)}.json.gz" for prefix in sorted(shards)}
+    }
+    
+    written += write_if_different(
+        os.path.join(directory, "index.json"), 
+        json.dumps(manifest, separators=(",", ":"), sort_keys=True).encode("utf-8"))
+    
+    # shards for prefixes that no longer have any terms
+    for name in os.listdir(directory):
+        if name.endswith(".json.gz") and name not in files:
+            os.remove(os.path.join(directory, name))
+    
+    cache = settings['SEARCH_INDEX_CACHE']
+    cache_directory = os.path.dirname(cache)
+    
+    if cache_directory and not os.path.exists(cache_directory):
+        os.makedirs(cache_directory)
+    
+    with open(cache, "w") as fp:
+        json.dump({'documents': _documents, 'ids': _ids}, fp)
+    
+    logger.info(f"Search index: {len(documents)} articles ({_read} read), "
+                f"{len(shards)} shards, {written} files written")
+    
+    _read = 0
+
+def register():
+    signals.initialized.connect(initialized)
+    signals.all_generators_finalized.connect(all_generators_finalized)
+    signals.finalized.connect(finalized)
@@ -0,0 +1,175 @@
+"""
+Streaming Feeds
+---------------
+
+Every article shows up in up to eight feeds (all, category, author and each of
+its tags, in both Atom and RSS), and pelican renders it from scratch for each
+one, every build.
+
+This plugin renders each article's feed entry once per feed type, keeps the 
+XML in a cache (saved to STREAMING_FEEDS_CACHE between builds), and writes 
+feeds by streaming the cached entries between the feed's header and footer.
+Only articles that have changed since the last build get rendered.
+
+Feeds whose members haven't changed are skipped entirely by the depgraph 
+plugin, which this one relies on for article signatures, so it must come 
+after depgraph in PLUGINS.
+"""
+import datetime
+import io
+import json
+import logging
+import os
+
+from feedgenerator.django.utils.xmlutils import SimplerXMLGenerator
+
+from pelican import signals
+
+from write_if_changed import register_writer_mixin
+from depgraph import (content_signature, settings_signature, url_map_signature,
+                      _hash)
+
+logger = logging.getLogger(__name__)
+
+# {feed type, site url and source path: [signature, xml, pubdate, updateddate]},
+# dates as isoformat strings
+_entries = {}
+
+_used = 0
+_rendered = 0
+
+def initialized(pelican):
+    from pelican.settings import DEFAULT_CONFIG
+    
+    cache_path = pelican.settings.get('CACHE_PATH', DEFAULT_CONFIG['CACHE_PATH'])
+    
+    DEFAULT_CONFIG.setdefault('STREAMING_FEEDS_CACHE', 
+                              os.path.join(cache_path, 'feed_entries.json'))
+    pelican.settings.setdefault('STREAMING_FEEDS_CACHE', 
+                                DEFAULT_CONFIG['STREAMING_FEEDS_CACHE'])
+    
+    _entries.clear()
+    
+    try:
+        with open(pelican.settings['STREAMING_FEEDS_CACHE']) as fp:
+            _entries.update(json.load(fp))
+    except (OSError, ValueError):
+        logger.debug("No usable feed entry cache, all entries will be rendered")
+
+def finalized(pelican):
+    global _rendered, _used
+    
+    path = pelican.settings['STREAMING_FEEDS_CACHE']
+    directory = os.path.dirname(path)
+    
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    # drop the entries for articles that have been deleted
+    for key in list(_entries):
+        if not os.path.exists(key.split("\0")[-1]):
+            del _entries[key]
+    
+    with open(path, "w") as fp:
+        json.dump(_entries, fp)
+    
+    logger.info(f"Rendered {_rendered} feed entries, {_used - _rendered} "
+                f"came from the cache")
+    
+    _used = 0
+    _rendered = 0
+
+def _date(value):
+    if value is None:
+        return None
+    return datetime.datetime.fromisoformat(value)
+
+class StreamingFeedMixin:
+    """
+    Writer mixin that builds feeds from cached, per-article XML fragments.
+    
+    Pelican's write_feed() is left alone (so the mixins around this one still
+    see every feed written); it's the feed it creates, and how items are 
+    added to it, that change.
+    """
+    def _create_new_feed(self, feed_type, feed_title, context):
+        """
+        Create a feed that writes the cached entries added to it, rather 
+        than rendering its items.
+        """
+        feed = super()._create_new_feed(feed_type, feed_title, context)
+        
+        feed.context = context
+        feed.entries = []
+        
+        def write_items(handler):
+            for signature, xml, pubdate, updateddate in feed.entries:
+                handler.ignorableWhitespace(xml)
+        
+        def latest_post_date():
+            # what feedgenerator would work out from the items it never gets
+            dates = [_date(date) for entry in feed.entries 
+                     for date in entry[2:] if date]
+            return max(dates) if dates else datetime.datetime.now()
+        
+        feed.write_items = write_items
+        feed.latest_post_date = latest_post_date
+        
+        return feed
+    
+    def _add_item_to_the_feed(self, feed, item):
+        feed.entries.append(self._feed_entry(feed, item, feed.context))
+    
+    def _feed_entry(self, feed, item, context):
+        """
+        Return the cached [signature, xml, pubdate, updateddate] for item in 
+        the given feed, rendering it if it's missing or out of date.
+        
+        Entries are re-rendered when the article (or a file it includes) 
+        changes, and when any url changes, since {filename} links to other
+        articles are resolved in the entry.
+        """
+        global _rendered, _used
+        
+        key = f"{type(feed).__name__}\0{self.site_url}\0{item.source_path}"
+        signature = _hash(settings_signature(self.settings), url_map_signature(context),
+                          content_signature(item))
+        
+        _used += 1
+        
+        entry = _entries.get(key)
+        
+        if entry is not None and entry[0] == signature:
+            return entry
+        
+        entry = [signature] + self._render_entry(feed, item)
+        
+        _entries[key] = entry
+        _rendered += 1
+        
+        return entry
+    
+    def _render_entry(self, feed, item):
+        """
+        Render item's entry in feed, and return [xml, pubdate, updateddate].
+        """
+        feed.items = []
+        super()._add_item_to_the_feed(feed, item)
+        
+        buffer = io.StringIO()
+        # the feed class's own write_items, not the one that streams entries
+        type(feed).write_items(feed, SimplerXMLGenerator(buffer, 'utf-8'))
+        
+        rendered = feed.items[0]
+        feed.items = []
+        
+        return [
+            buffer.getvalue(),
+            rendered['pubdate'].isoformat() if rendered['pubdate'] else None,
+            rendered['updateddate'].isoformat() if rendered['updateddate'] else None
+        ]
+
+def register():
+    signals.initialized.connect(initialized)
+    signals.finalized.connect(finalized)
+    register_writer_mixin(StreamingFeedMixin)
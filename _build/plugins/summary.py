@@ -4,12 +4,33 @@ Summary
 
 This plugin allows easy, variable length summaries directly embedded into the
 body of your articles.
+
+Set SUMMARY_LAZY to True to defer extraction until something (a template, an
+index page, the feed writer) actually reads the summary. The markers are then
+only removed from the content once the summary has been extracted, which is
+harmless since they're HTML comments.
 """
 
 from __future__ import unicode_literals
+import re
+from collections import OrderedDict
 from pelican import signals
 from pelican.generators import ArticlesGenerator, StaticGenerator, PagesGenerator
-import re
+
+# opening or closing div tags, see strip_div_tags()
+DIV_TAG = re.compile(r"</?div(?:[/ \t\n\r][^>]*)?>")
+
+# summaries with their div tags stripped, keyed by the length and first
+# STRIPPED_KEY_LENGTH characters of the summary as it was found, so unchanged
+# summaries are only stripped once per process (e.g. with --autoreload). The
+# least recently used are dropped past STRIPPED_CACHE_SIZE.
+_stripped = OrderedDict()
+
+STRIPPED_CACHE_SIZE = 1024
+STRIPPED_KEY_LENGTH = 64
+
+# lazy subclasses of the content classes, see lazy_class()
+_lazy_classes = {}
 
 def initialized(pelican):
     from pelican.settings import DEFAULT_CONFIG
@@ -18,30 +39,57 @@ def initialized(pelican):
     DEFAULT_CONFIG.setdefault('SUMMARY_END_MARKER',
                               '<!-- PELICAN_END_SUMMARY -->')
     DEFAULT_CONFIG.setdefault('SUMMARY_USE_FIRST_PARAGRAPH', False)
+    DEFAULT_CONFIG.setdefault('SUMMARY_LAZY', False)
     if pelican:
         pelican.settings.setdefault('SUMMARY_BEGIN_MARKER',
                                     '<!-- PELICAN_BEGIN_SUMMARY -->')
         pelican.settings.setdefault('SUMMARY_END_MARKER',
                                     '<!-- PELICAN_END_SUMMARY -->')
         pelican.settings.setdefault('SUMMARY_USE_FIRST_PARAGRAPH', False)
+        pelican.settings.setdefault('SUMMARY_LAZY', False)
 
-def extract_summary(instance):
-    # if summary is already specified, use it
-    # if there is no content, there's nothing to do
-    if hasattr(instance, '_summary') or 'summary' in instance.metadata:
-        instance.has_summary = True
-        return
-
-    if not instance._content:
-        instance.has_summary = False
-        return
+def strip_div_tags(html):
+    """
+    Remove every opening and closing div tag from html, leaving whatever they
+    wrapped in place.
+    
+    Each tag only runs to its own closing bracket, so unlike a greedy regex it
+    can't run past the end of a tag and swallow the content after it.
+    """
+    # hashing the whole summary would cost about as much as stripping it, so
+    # look it up by its length and start, and check it's really the same
+    key = (len(html), html[:STRIPPED_KEY_LENGTH])
+    
+    try:
+        _stripped.move_to_end(key)
+        original, stripped = _stripped[key]
+    except KeyError:
+        pass
+    else:
+        if original == html:
+            return stripped
+    
+    stripped = DIV_TAG.sub("", html)
+    
+    _stripped[key] = (html, stripped)
+    
+    while len(_stripped) > STRIPPED_CACHE_SIZE:
+        _stripped.popitem(last=False)
+    
+    return stripped
 
-    begin_marker = instance.settings['SUMMARY_BEGIN_MARKER']
-    end_marker   = instance.settings['SUMMARY_END_MARKER']
-    use_first_paragraph = instance.settings['SUMMARY_USE_FIRST_PARAGRAPH']
+def scan_summary(content, begin_marker, end_marker, use_first_paragraph=False):
+    """
+    Locate the summary in the given (raw) content.
+    
+    Returns a tuple of (summary, content), where content has had the summary
+    markers removed. Returns None if no summary could be found.
+    
+    The markers are located once, and the new content is put together from
+    the summary and whatever was either side of the markers.
+    """
     remove_markers = True
-
-    content = instance._update_content(instance._content, instance.settings['SITEURL'])
+    
     begin_summary = -1
     end_summary = -1
     if begin_marker:
@@ -56,29 +104,74 @@ def extract_summary(instance):
         end_summary = content.find(end_marker)
 
     if begin_summary == -1 and end_summary == -1:
-        instance.has_summary = False
-        return
-
+        return None
+    
     # skip over the begin marker, if present
     if begin_summary == -1:
-        begin_summary = 0
+        summary_start = 0
     else:
-        begin_summary = begin_summary + len(begin_marker)
+        summary_start = begin_summary + len(begin_marker)
 
     if end_summary == -1:
-        end_summary = None
-
-    summary = content[begin_summary:end_summary]
+        summary = content[summary_start:]
+    else:
+        summary = content[summary_start:end_summary]
 
     if remove_markers:
-        # remove the markers from the content
-        if begin_summary:
-            content = content.replace(begin_marker, '', 1)
-        if end_summary:
-            content = content.replace(end_marker, '', 1)
+        if end_summary == -1:
+            content = content.replace(begin_marker, "", 1)
+        elif begin_summary == -1:
+            content = content.replace(end_marker, "", 1)
+        elif summary_start <= end_summary:
+            # the markers are either side of the summary, so that's already
+            # the middle of the new content
+            content = "".join((content[:begin_summary], summary,
+                               content[end_summary + len(end_marker):]))
+        else:
+            # the end marker comes first, or the two overlap
+            cuts = [(begin_summary, summary_start),
+                    (end_summary, end_summary + len(end_marker))]
+            cuts.sort()
+            
+            parts = []
+            pos = 0
+            for start, end in cuts:
+                if start < pos:
+                    # overlapping markers, nothing sensible to cut
+                    continue
+                parts.append(content[pos:start])
+                pos = end
+            parts.append(content[pos:])
+            
+            content = "".join(parts)
+
+    return strip_div_tags(summary), content
+
+def extract_summary(instance):
+    # if summary is already specified, use it
+    # if there is no content, there's nothing to do
+    if hasattr(instance, '_summary') or 'summary' in instance.metadata:
+        instance.has_summary = True
+        return
+
+    if not instance._content:
+        instance.has_summary = False
+        return
 
-    summary = re.sub(r"<div.*>", "", summary)
-    summary = re.sub(r"</div>", "", summary)
+    result = scan_summary(instance._content,
+                          instance.settings['SUMMARY_BEGIN_MARKER'],
+                          instance.settings['SUMMARY_END_MARKER'],
+                          instance.settings['SUMMARY_USE_FIRST_PARAGRAPH'])
+    
+    if result is None:
+        instance.has_summary = False
+        return
+    
+    summary, content = result
+    
+    # only the (small) summary needs its links resolved here, pelican takes
+    # care of the content itself when it's rendered
+    summary = instance._update_content(summary, instance.settings['SITEURL'])
 
     instance._content = content
     # default_status was added to Pelican Content objects after 3.7.1.
@@ -91,14 +184,75 @@ def extract_summary(instance):
     instance.has_summary = True
 
 
+def ensure_summary(instance):
+    """
+    Run extract_summary() on instance, once.
+    """
+    if instance.__dict__.get('_summary_extracted'):
+        return
+    
+    instance._summary_extracted = True
+    extract_summary(instance)
+
+def lazy_class(cls):
+    """
+    Return a subclass of the given content class that extracts its summary the
+    first time summary or has_summary is read (or summary is assigned to).
+    
+    The subclasses are made once per content class, and reused.
+    """
+    try:
+        return _lazy_classes[cls]
+    except KeyError:
+        pass
+    
+    class LazySummary(cls):
+        @property
+        def summary(self):
+            ensure_summary(self)
+            return super().summary
+        
+        @summary.setter
+        def summary(self, value):
+            # extract first, so the value ends up where it would have without
+            # SUMMARY_LAZY, and isn't overwritten by a later extraction
+            ensure_summary(self)
+            cls.summary.fset(self, value)
+        
+        @property
+        def has_summary(self):
+            ensure_summary(self)
+            return self.__dict__.get('_has_summary', False)
+        
+        @has_summary.setter
+        def has_summary(self, value):
+            self._has_summary = value
+    
+    LazySummary.__name__ = cls.__name__
+    LazySummary.__qualname__ = cls.__qualname__
+    
+    _lazy_classes[cls] = LazySummary
+    
+    return LazySummary
+
+def prepare_summary(instance):
+    """
+    Extract the summary now, or arrange for it to happen on first access if 
+    SUMMARY_LAZY is set.
+    """
+    if instance.settings.get('SUMMARY_LAZY'):
+        instance.__class__ = lazy_class(instance.__class__)
+    else:
+        extract_summary(instance)
+
 def run_plugin(generators):
     for generator in generators:
         if isinstance(generator, ArticlesGenerator):
             for article in generator.articles:
-                extract_summary(article)
+                prepare_summary(article)
         elif isinstance(generator, PagesGenerator):
             for page in generator.pages:
-                extract_summary(page)
+                prepare_summary(page)
 
 
 def register():
@@ -0,0 +1,176 @@
+"""
+Write If Changed
+----------------
+
+Pelican rewrites every output file on every build, which bumps the mtime of
+everything and makes anything that runs afterwards (the post-processor, git)
+treat the whole site as new.
+
+This plugin swaps in a writer that renders into memory, hashes the result, and
+only touches the file on disk when the hash differs from the one recorded the
+last time that file was written. Since the comparison is against pelican's own
+output, a page that has since been post-processed is left alone as long as
+pelican would produce the same thing for it.
+
+The paths of the files that were actually written are saved, one per line, to
+WRITE_IF_CHANGED_REPORT so later stages can limit themselves to that set.
+
+Other plugins can add behavior to the writer with register_writer_mixin(),
+since pelican only ever uses one writer class.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+
+from pelican import signals
+from pelican.writers import Writer
+
+logger = logging.getLogger(__name__)
+
+# classes that get mixed into the writer, in MRO order
+WRITER_MIXINS = []
+
+# sha1 of the last thing written to each output path, relative to OUTPUT_PATH
+_hashes = {}
+
+# absolute paths written (or skipped) during this run, cleared after each run
+_changed = set()
+_unchanged = set()
+
+def register_writer_mixin(mixin):
+    """
+    Add a class to be mixed into the writer pelican uses. Mixins registered 
+    first come first in the MRO.
+    """
+    if mixin not in WRITER_MIXINS:
+        WRITER_MIXINS.append(mixin)
+    
+    signals.get_writer.connect(get_writer)
+
+def get_writer(pelican):
+    return type("Writer", tuple(WRITER_MIXINS) + (Writer,), {})
+
+def initialized(pelican):
+    from pelican.settings import DEFAULT_CONFIG
+    
+    cache_path = pelican.settings.get('CACHE_PATH', DEFAULT_CONFIG['CACHE_PATH'])
+    
+    DEFAULT_CONFIG.setdefault('WRITE_IF_CHANGED_MANIFEST',
+                              os.path.join(cache_path, 'output_hashes.json'))
+    DEFAULT_CONFIG.setdefault('WRITE_IF_CHANGED_REPORT', 
+                              os.path.join(cache_path, 'changed_files.txt'))
+    pelican.settings.setdefault('WRITE_IF_CHANGED_MANIFEST',
+                                DEFAULT_CONFIG['WRITE_IF_CHANGED_MANIFEST'])
+    pelican.settings.setdefault('WRITE_IF_CHANGED_REPORT',
+                                DEFAULT_CONFIG['WRITE_IF_CHANGED_REPORT'])
+    
+    _hashes.clear()
+    
+    try:
+        with open(pelican.settings['WRITE_IF_CHANGED_MANIFEST']) as fp:
+            _hashes.update(json.load(fp))
+    except (OSError, ValueError):
+        logger.debug("No usable output hash manifest, all files will be compared")
+
+def finalized(pelican):
+    manifest = pelican.settings['WRITE_IF_CHANGED_MANIFEST']
+    report = pelican.settings['WRITE_IF_CHANGED_REPORT']
+    
+    for path in (manifest, report):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+    
+    with open(manifest, "w") as fp:
+        json.dump(_hashes, fp, indent=1, sort_keys=True)
+    
+    with open(report, "w") as fp:
+        for path in sorted(_changed):
+            fp.write(f"{path}\n")
+    
+    logger.info(f"{len(_changed)} output files changed, "
+                f"{len(_unchanged)} unchanged. List saved to {report}")
+    
+    _changed.clear()
+    _unchanged.clear()
+
+class ChangedOutput(io.StringIO):
+    """
+    Collects output in memory, and writes it to path when closed, if it 
+    differs from what was written there last time.
+    """
+    def __init__(self, path, key, encoding):
+        super().__init__()
+        self.path = path
+        self.key = key
+        self.output_encoding = encoding
+        self.discard = False
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # don't leave half-rendered output behind
+            self.discard = True
+        return super().__exit__(exc_type, exc_value, traceback)
+    
+    def close(self):
+        if not self.closed and not self.discard:
+            self.commit(self.getvalue().encode(self.output_encoding))
+        super().close()
+    
+    def commit(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        
+        if os.path.exists(self.path):
+            previous = _hashes.get(self.key)
+            
+            if previous is None:
+                # nothing on record, compare against what's on disk
+                with open(self.path, "rb") as fp:
+                    if hashlib.sha1(fp.read()).hexdigest() == digest:
+                        previous = digest
+                        
+            if previous == digest:
+                logger.debug(f"{self.path} is unchanged, not writing")
+                _hashes[self.key] = digest
+                _unchanged.add(os.path.abspath(self.path))
+                return
+        
+        with open(self.path, "wb") as fp:
+            fp.write(data)
+        
+        _hashes[self.key] = digest
+        _changed.add(os.path.abspath(self.path))
+        _unchanged.discard(os.path.abspath(self.path))
+
+class ChangedOnlyMixin:
+    """
+    Writer mixin that routes every file write through ChangedOutput.
+    """
+    def _open_w(self, filename, encoding, override=False):
+        # same bookkeeping as pelican's own _open_w, which we can't call since
+        # it truncates the file
+        if filename in self._overridden_files:
+            if override:
+                raise RuntimeError(f'File {filename} is set to be overridden twice')
+            else:
+                logger.info(f'Skipping {filename}')
+                return open(os.devnull, 'w', encoding=encoding)
+        elif filename in self._written_files:
+            if override:
+                logger.info(f'Overwriting {filename}')
+            else:
+                raise RuntimeError(f'File {filename} is to be overwritten')
+        if override:
+            self._overridden_files.add(filename)
+        self._written_files.add(filename)
+        
+        key = os.path.relpath(filename, self.output_path)
+        
+        return ChangedOutput(filename, key, encoding)
+
+def register():
+    signals.initialized.connect(initialized)
+    signals.finalized.connect(finalized)
+    register_writer_mixin(ChangedOnlyMixin)
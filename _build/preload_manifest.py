@@ -0,0 +1,155 @@
+"""
+Preload Manifest
+
+Records the subresources each page needs to start rendering, so the web
+server can tell the browser about them before it's even seen the HTML (see
+DirectoryListingApp in wsgi.py, which sends them as Link: rel=preload headers,
+and as a 103 Early Hints response where the server supports it).
+
+For each page, in this order:
+  - the fonts critical_css.py added preload hints for
+  - its stylesheets
+  - the scripts in its <head>
+  - the first image in the content (the "hero" image), with its srcset and
+    sizes, so the browser can pick the right variant itself
+
+Since most pages share the same stylesheets and fonts, the manifest lists
+each resource once, and each page refers to its resources by index:
+
+    {"resources": [["/theme/css/main.0123456789.css", "style", {}], ...],
+     "pages": {"/index.html": [0, 1, 2], ...}}
+
+It's saved as MANIFEST_NAME in PATH. Run it last, after fingerprint.py, so the
+manifest has the final (hashed) names, from the _build directory:
+
+$ python preload_manifest.py
+"""
+import os
+import json
+from urllib.parse import urljoin
+from bs4 import BeautifulSoup
+
+from buildprofile import span
+from fingerprint import walk
+
+PATH = os.path.abspath("../") # the path to scan for HTML files
+
+MANIFEST_NAME = "preload.json"
+
+MAX_PRELOADS = 8 # per page, the rest are left for the browser to find
+
+def page_url(path, basepath):
+    return "/" + os.path.relpath(path, basepath).replace(os.path.sep, "/")
+
+def local_url(url, base):
+    """
+    Return url as an absolute path on this site, or None if it's on another
+    site (or isn't a url at all).
+    """
+    if not url or url.startswith(("data:", "#")):
+        return None
+
+    url = urljoin(base, url)
+
+    if not url.startswith("/") or url.startswith("//"):
+        return None
+
+    return url
+
+def page_resources(soup, url):
+    """
+    Yield (url, as, attributes) for the resources a page needs up front, most
+    important first.
+    """
+    head = soup.head or soup
+
+    for link in head.find_all("link", rel="preload"):
+        if link.get("as") == "font":
+            href = local_url(link.get("href"), url)
+            if href:
+                yield href, "font", {"type": link.get("type"), "crossorigin": True}
+
+    for link in head.find_all("link"):
+        rel = link.get("rel", [])
+        if "stylesheet" in rel or ("preload" in rel and link.get("as") == "style"):
+            href = local_url(link.get("href"), url)
+            if href:
+                yield href, "style", {}
+
+    for script in head.find_all("script", src=True):
+        src = local_url(script["src"], url)
+        if src:
+            yield src, "script", {}
+
+    hero = soup.select_one("section img")
+
+    if hero is not None and hero.parent.name != "picture":
+        src = local_url(hero.get("src"), url)
+
+        if src:
+            attributes = {}
+
+            if hero.get("srcset"):
+                # make the variants' urls absolute, they're resolved against
+                # the page in the html but against nothing in a header
+                candidates = []
+                for candidate in hero["srcset"].split(","):
+                    parts = candidate.split()
+                    if parts:
+                        parts[0] = local_url(parts[0], url) or parts[0]
+                        candidates.append(" ".join(parts))
+                attributes["imagesrcset"] = ", ".join(candidates)
+                attributes["imagesizes"] = hero.get("sizes")
+
+            yield src, "image", attributes
+
+def build_manifest(basepath):
+    resources = []
+    indexes = {}
+    pages = {}
+
+    for path in sorted(walk(basepath)):
+        if not path.endswith(".html"):
+            continue
+
+        url = page_url(path, basepath)
+
+        with open(path) as fp:
+            soup = BeautifulSoup(fp, "lxml")
+
+        found = []
+
+        for href, kind, attributes in page_resources(soup, url):
+            attributes = {key: value for key, value in attributes.items() if value}
+            key = json.dumps([href, kind, attributes], sort_keys=True)
+
+            if key not in indexes:
+                indexes[key] = len(resources)
+                resources.append([href, kind, attributes])
+
+            if indexes[key] not in found:
+                found.append(indexes[key])
+
+        if found:
+            pages[url] = found[:MAX_PRELOADS]
+
+    return {"resources": resources, "pages": pages}
+
+def process_dir(basepath):
+    print(f"BUILDING PRELOAD MANIFEST FOR {basepath}...")
+    print("====================================")
+
+    manifest = build_manifest(basepath)
+    manifest_path = os.path.join(basepath, MANIFEST_NAME)
+
+    temp_path = f"{manifest_path}.new"
+    with open(temp_path, "w") as fp:
+        json.dump(manifest, fp, separators=(",", ":"))
+    os.replace(temp_path, manifest_path)
+
+    print(f"{len(manifest['pages'])} pages, {len(manifest['resources'])} "
+          f"distinct resources, {os.path.getsize(manifest_path)} bytes")
+
+if __name__ == "__main__":
+    with span("preload_manifest", "stage"):
+        process_dir(PATH)
@@ -10,9 +10,10 @@ Given ./my-image.png (4032x3024):
 - ./responsive/my-image-40-1613w.jpg (40% of full size)
 - ./responsive/my-image-20-806w.jpg (20% of full size)
 - ./responsive/my-image-thumbnail.jpg (400px wide)
-- ./responsive/my-image-square.jpg (400px wide square, seam carving)
+- ./responsive/my-image-square.jpg (400px wide square, smart cropped)
 
-Each image will have its exif data wiped, and replaced with a copyright notice.
+Each image will have its exif data wiped, and replaced with a copyright notice,
+as it's made (see strip_metadata.strip_variant()).
 
 The script runs in two passes, first it collects all of the potential images, 
 and sees what sizes aready exist, then it processes each one.
@@ -21,7 +22,6 @@ Set DRY_RUN to True to simply print out the actions that would happen.
 
 TODO
 ====
-* edit exif data on images to strip anything weird and add in copyright info.
 * repackage into a self-contained repo and egg
 * add command-line options via argparse instead of globals 
 * add buildout to (try to) build ImageMagick from source
@@ -30,7 +30,6 @@ TODO
 * use multiprocessing to parallelize scanning for images and generating 
   thumbnails
 * progress bar
-* try smart cropping for square thumbnails: https://github.com/epixelic/python-smart-crop
 * keep a record of some sort of what images were already processed so we don't 
   have to rescan every time
 * remember last time we ran, have a mode where we only process files with a mod time since then.
@@ -39,6 +38,10 @@ TODO
 
 NOTES
 =====
+Square thumbnails are made by cropping to the most "interesting" square (see
+imagetools.smart_square()) and resizing. Set SQUARE_MODE to "liquid" to use 
+seam carving (liquid rescale) instead, which is much slower.
+
 To get Wand working with liquid rescale, I had to install imagemagick via 
 macports using the "variants" feature:
 
@@ -55,6 +58,10 @@ import mimetypes
 import math
 import pprint
 
+from imagetools import (apply_resource_limits, cached_variant, get_manifest, 
+                        image_size, jpeg_quality, open_image, smart_square)
+from buildprofile import span
+
 logging.basicConfig(level=logging.DEBUG)
 
 # TODO: replace with argparse cli options
@@ -64,6 +71,7 @@ PATH = "./content/images"
 DEST_SUBDIR = "responsive" 
 THUMBNAIL_WIDTH = 400
 OVERWRITE = False
+SQUARE_MODE = "smart"  # or "liquid", for seam carving
 
 TYPES = ['image/gif', 'image/jpeg', 'image/png'] 
 
@@ -154,7 +162,8 @@ def link_to_simpler_name(path, overwrite=False):
             raise ImageExists()
             
     if not DRY_RUN:
-        os.symlink(path, link_path)
+        with span("symlink", "images", file=link_path):
+            os.symlink(path, link_path)
     else:
         logging.info("DRY RUN: skipping creation of symlink {link_path}")
     
@@ -168,6 +177,9 @@ def make_thumbnail(source, dest, width, square=False, overwrite=False):
     If overwrite is True, the image will be deleted before it's regenerated, if 
     it already exists.
     
+    Thumbnails are shared between copies of the same image (see
+    imagetools.cached_variant()).
+    
     Returns True if the image was created sucessfully. False if not.
     """
     logging.debug(f"Generating {dest}, {width}w, square? {square}") 
@@ -179,16 +191,40 @@ def make_thumbnail(source, dest, width, square=False, overwrite=False):
                 logging.debug(f"{dest} already exists, and overwrite is False")
                 raise ImageExists()
         
-        with Image(filename=source) as image:
-            with image.clone() as thumbnail:
-                if not square:
-                    thumbnail.transform(resize=f'{width}x{width}>')
-                else:
-                    thumbnail.liquid_rescale(width, width)
-                
-                thumbnail.format = "jpg"
-                thumbnail.save(filename=dest)
-        logging.debug(f"{dest} generated successfully.")
+        # squares are cropped (differently, depending on the mode), so 
+        # they're a different variant, with their own quality
+        kind = f"{width}-square-{SQUARE_MODE}" if square else str(width)
+        
+        def render(path):
+            with span("decode", "images", file=source, width=width):
+                image = open_image(source, width)
+            
+            with image:
+                with image.clone() as thumbnail:
+                    with span("resize", "images", file=source, width=width, square=square):
+                        if not square:
+                            thumbnail.transform(resize=f'{width}x{width}>')
+                        elif SQUARE_MODE == "liquid":
+                            thumbnail.liquid_rescale(width, width)
+                        else:
+                            smart_square(thumbnail, width)
+                    
+                    thumbnail.format = "jpg"
+                    
+                    with span("quality", "images", file=source, width=width):
+                        quality = jpeg_quality(source, kind, thumbnail)
+                    if quality is not None:
+                        thumbnail.compression_quality = quality
+                    
+                    with span("encode", "images", file=dest):
+                        thumbnail.save(filename=path)
+        
+        made = cached_variant(source, kind, dest, render, force=overwrite)
+        
+        if made:
+            logging.debug(f"{dest} generated successfully.")
+        else:
+            logging.debug(f"{dest} linked from an identical image.")
         
         return True
             
@@ -226,27 +262,28 @@ def scan_image(path):
             prefix, suffix = os.path.splitext(os.path.basename(path))
             
             if mime in TYPES:
-                with Image(filename=path) as image:
-                    info['width'] = image.width
-                    info['height'] = image.height
-                    
-                    if image.width < SIZE_THRESHOLD and image.height < SIZE_THRESHOLD:
-                        if image.width > THUMBNAIL_WIDTH:
-                            pass
-                        else:
-                            logging.debug(f"{path} is below {SIZE_THRESHOLD} pixels wide/high")
-                            raise TooSmall()
+                # only the header is needed here, don't decode the whole thing
+                image_width, image_height = image_size(path)
+                
+                info['width'] = image_width
+                info['height'] = image_height
+                
+                if image_width < SIZE_THRESHOLD and image_height < SIZE_THRESHOLD:
+                    if image_width > THUMBNAIL_WIDTH:
+                        pass
+                    else:
+                        logging.debug(f"{path} is below {SIZE_THRESHOLD} pixels wide/high")
+                        raise TooSmall()
+                
+                for name, width in variations(image_width).items():
+                    variant = f"{prefix}-{name}.jpg"
+                    variant_dest = os.path.join(dest, variant)
+                    logging.debug(f"Processing {variant_dest}")
                     
-                    for name, width in variations(image.width).items():
-                        variant = f"{prefix}-{name}.jpg"
-                        variant_dest = os.path.join(dest, variant)
-                        logging.debug(f"Processing {variant_dest}")
-                        
-                        # if not os.path.exists(variant_dest):
-                        info[f"make_{name}"] = (width, variant_dest)
-                        #else:
-                        #    info[f"make_{name}"] = None
-                        
+                    # if not os.path.exists(variant_dest):
+                    info[f"make_{name}"] = (width, variant_dest)
+                    #else:
+                    #    info[f"make_{name}"] = None
                     
                 return info
             else:
@@ -260,6 +297,8 @@ def scan_image(path):
         logging.error(e)
         return False
 
+apply_resource_limits()
+
 logging.info(f"Scanning {PATH} for images...")
 
 images = 0
@@ -316,5 +355,8 @@ for path in links_to_make:
         link_to_simpler_name(path, overwrite=OVERWRITE)
     except ImageExists:
         pass
+
+if not DRY_RUN:
+    get_manifest().save()
                 
                 
\ No newline at end of file
@@ -8,17 +8,31 @@ Parses all .html files in a given directory, and performs the following:
   - the relevant img tags are replaced with new img tags with srcset and
     sizes attributes to make the image responsive, linking to the correct
     variants
-  - the new html file is written
+  - a tiny blurred placeholder of the image is inlined as the tag's 
+    background, so there's something to see while the image loads
+  - the image's aspect ratio is added, so the browser can lay out the page 
+    before it loads, and all but the first image in each article are loaded
+    lazily
+  - the new html file is written to a staging tree
+
+Once every page has been processed, the staged pages are published together
+(see publish()), so the live site never serves a mix of processed and 
+unprocessed pages while the script runs. If PATH is a symlink to the real 
+directory, publishing is a single atomic swap of the symlink. Otherwise each 
+page is moved into place in a quick pass at the end, which isn't atomic: a 
+request during that pass can still get a mix of old and new pages.
 
 """
 import os, shutil
 from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
-from wand.image import Image
-import piexif
-import tempfile
 import re
 
+from imagetools import (apply_resource_limits, cached_variant, get_manifest, 
+                        image_dimensions, image_size, jpeg_quality, open_image, 
+                        placeholder)
+from buildprofile import profiled, span
+
 PATH = os.path.abspath("../") # the path to scan for HTML files
 DOCUMENT_ROOT = PATH          # the physical path that maps to / for absolute
                               # paths
@@ -60,8 +74,20 @@ SIZES = (None, 2500, 2000, 1800, 1600, 1200, 1000, 800, 400, 200)
 # Average ratio is 1.058
 CONTENT_WIDTH_RATIO = 1.06      # used for guessing the viewport slot size
 
+# inline styles that already size an image
+SIZED_STYLE = re.compile(r"(^|;)\s*(max-)?(width|height)\s*:")
+
 CHANGE_WINDOW = timedelta(minutes=30)
 
+# when True, only the HTML files pelican actually rewrote on its last run (as 
+# listed by the write_if_changed plugin) are processed
+ONLY_CHANGED = False
+CHANGED_FILES_REPORT = os.path.abspath("cache/changed_files.txt")
+
+# processed pages are written here (inside the real directory behind PATH, so
+# files can be hard linked and renamed between the two) until they're published
+STAGING_NAME = ".staging"
+
 def extract_width_from_inline_style(tag):
     """
     Given a image tag, extract the width from an inline style.
@@ -122,6 +148,47 @@ def calculate_width(image_tag, variant_width):
     
     
 
+def variant_location(source, width=None, ext=".jpg"):
+    """
+    Return the path of the variant of source at width (None for full size), 
+    with the given extension.
+    """
+    directory, image_name = os.path.split(source)
+    
+    name, _ = os.path.splitext(image_name)
+    
+    if width is not None:
+        return os.path.join(directory, "responsive", f"{name}-{width}{ext}")
+    else:
+        return os.path.join(directory, "fullsize", f"{name}{ext}")
+
+def render_variant(source, width, path):
+    """
+    Save a jpeg of the image at source, resized to width (None for full size),
+    to path.
+    """
+    with span("decode", "images", file=source, width=width):
+        image = open_image(source, width)
+    
+    # the metadata (bar the orientation) is stripped by cached_variant(), 
+    # before the variant is stored
+    with image:
+        with image.clone() as variant:
+            image.auto_orient()
+            if width is not None:
+                with span("resize", "images", file=source, width=width):
+                    variant.transform(resize=f'{width}x{width}>')
+        
+            variant.format = "jpg"
+        
+            with span("quality", "images", file=source, width=width):
+                quality = jpeg_quality(source, width, variant)
+            if quality is not None:
+                variant.compression_quality = quality
+        
+            with span("encode", "images", file=path):
+                variant.save(filename=path)
+
 def make_variant(source, width=None, force=False):
     """
     Create a jpeg variant of the image at path, with the given width.
@@ -139,17 +206,13 @@ def make_variant(source, width=None, force=False):
     
     If you pass None for the width, the new image is placed in the fullsize 
     subdirectory, the width is not added to the name. 
-    """
-    directory, image_name = os.path.split(source)
     
-    name, ext = os.path.splitext(image_name)
-    
-    if width is not None:
-        dest = os.path.join(directory, "responsive")
-        variant_path = os.path.join(dest, f"{name}-{width}.jpg")
-    else:
-        dest = os.path.join(directory, "fullsize")
-        variant_path = os.path.join(dest, f"{name}.jpg")
+    Variants are shared between copies of the same image (see 
+    imagetools.cached_variant()), so a copy that's been seen before is just
+    linked into place.
+    """
+    variant_path = variant_location(source, width, ".jpg")
+    dest = os.path.dirname(variant_path)
     
     if not os.path.exists(dest):
         os.makedirs(dest)
@@ -158,43 +221,75 @@ def make_variant(source, width=None, force=False):
         print("\t\t\tAlready exists, force=False")
         return variant_path
     
-    with Image(filename=source) as image:
-        if width and image.width < width:
-            return None
-        
-        # preserve orientation but otherwise remove all exif data after resize
-        # TODO: is this standard across all image types?
-        orientation = image.metadata.get("exif:Orientation")
-        mime = image.mimetype
-        
-        with image.clone() as variant:
-            image.auto_orient()
-            if width is not None:
-                variant.transform(resize=f'{width}x{width}>')
-            
-            variant.format = "jpg"
-            variant.save(filename=variant_path)
-            
-    # year = datetime.today().year
-    # exif = {'0th': {33432: f"(c){year} Josh Johnson. All Rights Reserved.\0"}}
-    # if orientation and mime != "image/png":
-    #     exif['0th'][274] = orientation
-        
-    # piexif.remove(variant_path)
-    # piexif.insert(piexif.dump(exif), variant_path)
-            
+    # check the real size up front, the image may be decoded at a reduced 
+    # size below
+    source_width, source_height = image_size(source)
+    
+    if width and source_width < width:
+        return None
+    
+    # the store is keyed on the source's contents, so it's safe to use even
+    # when force is set because the source changed recently
+    cached_variant(source, str(width or "full"), variant_path, 
+                   lambda path: render_variant(source, width, path))
+    
     return variant_path 
     
-def process_file(path, force=False):
+def set_dimensions(image, width, height):
+    """
+    Give the img tag the image's intrinsic size as width and height 
+    attributes, so its space is reserved before it loads even when nothing
+    else gives it a width (aspect-ratio alone doesn't, outside of figures).
+    The theme scales it down to fit (max-width:100%;height:auto).
+    
+    Images the content has already sized are left alone, since a width 
+    without the matching height would stretch them.
+    """
+    if image.get("width") or image.get("height"):
+        return
+    
+    if SIZED_STYLE.search(image.get("style", "")):
+        return
+    
+    image["width"] = str(width)
+    image["height"] = str(height)
+    
+def source_path(page, src):
+    """
+    Return the physical path of the image src refers to, from the HTML file 
+    at page.
+    """
+    parent = os.path.dirname(page)
+    
+    if src.startswith("/"):
+        parent = DOCUMENT_ROOT
+        src = src[1:]
+    
+    return os.path.normpath(os.path.join(parent, src))
+
+@profiled("process_file", "postprocess", lambda path, *args, **kwargs: {"file": path})
+def process_file(path, staging=None, force=False):
     base, ext = os.path.splitext(path)
     
     print(f"Parsing {path}..")
     print("----------------------------------")
     with open(path) as fp:
-        soup = BeautifulSoup(fp, 'lxml')
+        with span("parse", "html", file=path):
+            soup = BeautifulSoup(fp, 'lxml')
         images = soup.select("section img")
         
+        # articles (or sections) we've seen an image in already
+        seen_containers = set()
+        
         for image in images:
+            # the first image in each article is likely to be on screen when
+            # the page loads, the rest can wait
+            container = image.find_parent(["article", "section"])
+            if id(container) in seen_containers:
+                image["loading"] = "lazy"
+                image["decoding"] = "async"
+            seen_containers.add(id(container))
+            
             src_path = image["src"]
             
             print(f"\tProcessing {src_path}...")
@@ -204,7 +299,7 @@ def process_file(path, force=False):
                 print(f"\t\tWARNING: unsupported image type {src_ext}")
                 continue
             
-            if image.get("srcset"):
+            if image.get("srcset") or image.parent.name == "picture":
                 print("\t\tWARNING: IMAGE ALREADY PROCESSED?")
                 continue
             
@@ -212,14 +307,8 @@ def process_file(path, force=False):
                 print("\t\tEXTERNAL LINK. Skipping")
                 continue
             
-            parent = os.path.dirname(path)
             is_absolute = os.path.isabs(src_path)
-            
-            if src_path.startswith("/"):
-                parent = DOCUMENT_ROOT
-                src_path = src_path[1:]
-            
-            image_path = os.path.normpath(os.path.join(parent, src_path))
+            image_path = source_path(path, src_path)
             
             variants = {}
             
@@ -270,6 +359,22 @@ def process_file(path, force=False):
             image["srcset"]= ",".join(srcset)
             image["sizes"] = ",".join(sizes)
             
+            style = image.get("style", "").strip()
+            if style and not style.endswith(";"):
+                style += ";"
+            
+            # reserve the image's space before it loads
+            width, height = image_dimensions(image_path)
+            style += f"aspect-ratio:{width}/{height};"
+            set_dimensions(image, width, height)
+            
+            # show a blurry preview until the image itself loads
+            preview = placeholder(image_path)
+            if preview is not None:
+                style += f"background-image:url({preview});background-size:cover;"
+            
+            image["style"] = style
+            
             print(fullsize_link)
             print("-----------------------")
             print("SRCSET:")
@@ -312,15 +417,22 @@ def process_file(path, force=False):
             
             header.replace_with(h2)
     
-    temp_path = f"{base}.new{ext}"
+    if staging is None:
+        output_path = path
+    else:
+        output_path = staged_path(path, staging)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    
+    temp_path = f"{output_path}.new"
     
-    shutil.copy(path, temp_path)
+    with span("serialize", "html", file=path):
+        output = soup.encode(formatter="html")
     with open(temp_path, "wb") as new_html:
-        new_html.write(soup.encode(formatter="html"))
+        new_html.write(output)
         
-    shutil.move(temp_path, path)
+    os.replace(temp_path, output_path)
     
-def process_dir(basepath):
+def process_dir(basepath, staging=None):
     print(f"PROCESSING {basepath}...")
     print("====================================")
     print()
@@ -333,11 +445,147 @@ def process_dir(basepath):
         
         if os.path.isdir(path) and not name.startswith(("_", ".")):
             if path not in IGNORE_PATHS:
-                process_dir(path)
+                process_dir(path, staging)
         
         if ext == ".html":
-            process_file(path)
+            process_file(path, staging)
+
+def new_staging(basepath=PATH):
+    """
+    Return an empty staging directory for basepath.
+    
+    It's made inside the real directory basepath points to, so it's on the 
+    same filesystem. process_dir() skips it, since it starts with a '.'. 
+    Anything left over from a run that failed is thrown away.
+    """
+    staging = os.path.join(os.path.realpath(basepath), STAGING_NAME)
+    
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    
+    os.makedirs(staging)
+    
+    return staging
+
+def staged_path(path, staging):
+    """
+    Return where the processed copy of path (an HTML file under PATH) goes.
+    """
+    live = os.path.dirname(staging)
+    directory = os.path.realpath(os.path.dirname(path))
+    
+    return os.path.join(staging, os.path.relpath(directory, live), 
+                        os.path.basename(path))
+
+def link_tree(source, staging):
+    """
+    Hard link every file under source that isn't in staging yet into staging,
+    so staging becomes a complete copy of the site without copying anything.
+    Symlinks are recreated as they are.
+    """
+    for directory, dirs, names in os.walk(source):
+        if directory == source and STAGING_NAME in dirs:
+            dirs.remove(STAGING_NAME)
+        
+        target_directory = os.path.join(staging, os.path.relpath(directory, source))
+        os.makedirs(target_directory, exist_ok=True)
+        
+        # os.walk() lists symlinks to directories in dirs, and won't follow them
+        for name in names + [name for name in dirs 
+                             if os.path.islink(os.path.join(directory, name))]:
+            path = os.path.join(directory, name)
+            target = os.path.join(target_directory, name)
+            
+            if os.path.lexists(target):
+                continue
+            
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+            else:
+                os.link(path, target)
+
+def swap_tree(staging, basepath):
+    """
+    Turn staging into a full copy of the site, and atomically point the 
+    basepath symlink at it. The old tree is removed afterwards.
+    """
+    live = os.path.realpath(basepath)
+    parent = os.path.dirname(os.path.abspath(basepath))
+    
+    link_tree(live, staging)
+    
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    new_tree = os.path.join(os.path.dirname(live), 
+                            f"{os.path.basename(basepath)}.{stamp}")
+    os.rename(staging, new_tree)
+    
+    temp_link = os.path.join(parent, f".{os.path.basename(basepath)}.{stamp}")
+    os.symlink(os.path.relpath(new_tree, parent), temp_link)
+    os.replace(temp_link, basepath)
+    
+    shutil.rmtree(live)
+
+def replace_files(staging, basepath):
+    """
+    Move each staged page over the live one. Each page is replaced 
+    atomically, and since they're all ready, the pass is quick, but the pass 
+    as a whole isn't atomic.
+    """
+    live = os.path.dirname(staging)
+    
+    for directory, dirs, names in os.walk(staging):
+        for name in names:
+            path = os.path.join(directory, name)
+            os.replace(path, os.path.join(live, os.path.relpath(path, staging)))
+    
+    shutil.rmtree(staging)
+
+def publish(staging, basepath=PATH):
+    """
+    Make the pages in staging live.
+    
+    When basepath is a symlink, the whole site is swapped at once. Otherwise
+    (the root of this repository, say, which also holds _build and .git and 
+    can't be swapped out) the pages are replaced one by one, which isn't 
+    atomic.
+    """
+    with span("publish", "postprocess"):
+        if os.path.islink(basepath):
+            swap_tree(staging, basepath)
+        else:
+            print(f"WARNING: {basepath} isn't a symlink, so its pages are "
+                  "replaced one by one, not atomically")
+            replace_files(staging, basepath)
 
 
+def changed_files(report=CHANGED_FILES_REPORT, basepath=None):
+    """
+    Return the HTML files listed in the write_if_changed plugin's report that 
+    are under basepath (PATH by default).
+    """
+    basepath = basepath or PATH
+    
+    with open(report) as fp:
+        paths = [line.strip() for line in fp if line.strip()]
+    
+    return [
+        path for path in paths 
+        if path.endswith(".html") and 
+           os.path.abspath(path).startswith(basepath) and
+           os.path.exists(path)]
+
 if __name__ == "__main__":
-    process_dir(PATH)
\ No newline at end of file
+    apply_resource_limits()
+    
+    with span("responsive_postprocess", "stage"):
+        staging = new_staging(PATH)
+        
+        if ONLY_CHANGED:
+            for path in changed_files():
+                process_file(os.path.abspath(path), staging)
+        else:
+            process_dir(PATH, staging)
+        
+        get_manifest().save()
+        
+        publish(staging, PATH)
\ No newline at end of file
@@ -0,0 +1,342 @@
+"""
+Metadata Stripper
+
+Removes the metadata that cameras and editors leave in the published JPEG and
+PNG images (EXIF with its embedded thumbnail, XMP, IPTC, comments, text
+chunks...), and stamps each image with a copyright notice. It's done by
+rewriting the files' segments and chunks directly, so the pixels are never
+decoded or re-encoded, and the result is lossless.
+
+What's kept:
+
+  - JPEG: the JFIF header, ICC colour profiles (APP2), the Adobe segment
+    (APP14, it says how to decode the colours), and everything the image
+    data needs. The EXIF segment is replaced with a minimal one holding just
+    the orientation (if there was one) and the copyright.
+  - PNG: every critical chunk, and the ancillary chunks that change how the
+    image looks (transparency, gamma, colour profiles, animation...). A
+    Copyright tEXt chunk is added, and an eXIf chunk with just the
+    orientation if the image had one.
+
+Variants (anything in a responsive/ or fullsize/ directory) are stripped as
+they're made, by strip_variant(), before imagetools.cached_variant() adds
+them to the variant store. Published variants are hard links to the store, so
+stripping them here would leave the store with the unstripped copies; this
+pass skips them, and only strips the published originals.
+
+Stripping is idempotent, so files that are already stripped are left alone.
+Changed files are written to a new file and os.replace()'d into place, since
+published images can be hard links to the sources in content/images.
+
+This replaces the piexif code that used to be in
+responsive_postprocess.make_variant(). Run it after responsive_postprocess.py,
+and before fingerprint.py (so the hashed copies are made from the stripped
+files), from the _build directory:
+
+$ python strip_metadata.py
+"""
+import os
+import multiprocessing
+import struct
+import zlib
+from datetime import datetime
+
+from buildprofile import profiled, span
+from fingerprint import HASHED_NAME, VARIANT_DIRS, walk
+
+PATH = os.path.abspath("../") # the path to scan for images
+
+COPYRIGHT = "(c){year} Josh Johnson. All Rights Reserved."
+
+WORKERS = None  # None means one per CPU
+
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+PNG_EXTENSIONS = (".png",)
+
+# EXIF tags
+ORIENTATION = 274
+COPYRIGHT_TAG = 33432
+
+# markers without a length (SOI, EOI, TEM and the restart markers)
+STANDALONE_MARKERS = {0xd8, 0xd9, 0x01} | set(range(0xd0, 0xd8))
+
+SOS = 0xda
+APP0, APP1, APP2, APP14 = 0xe0, 0xe1, 0xe2, 0xee
+COM = 0xfe
+
+EXIF_HEADER = b"Exif\0\0"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# ancillary chunks that affect how the image is displayed, the rest go
+PNG_KEEP = {b"tRNS", b"gAMA", b"cHRM", b"sRGB", b"iCCP", b"sBIT", b"bKGD",
+            b"pHYs", b"acTL", b"fcTL", b"fdAT", b"cICP"}
+
+def copyright_notice(year=None):
+    return COPYRIGHT.format(year=year or datetime.today().year)
+
+def exif_orientation(tiff):
+    """
+    Return the orientation in the TIFF structure of an EXIF block, or None if
+    it doesn't have one (or can't be read).
+    """
+    try:
+        order = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        offset, = struct.unpack(order + "I", tiff[4:8])
+        count, = struct.unpack(order + "H", tiff[offset:offset+2])
+
+        for entry in range(count):
+            start = offset + 2 + entry * 12
+            tag, kind, number = struct.unpack(order + "HHI", tiff[start:start+8])
+
+            if tag == ORIENTATION and kind == 3:
+                value, = struct.unpack(order + "H", tiff[start+8:start+10])
+                return value
+    except (KeyError, struct.error):
+        pass
+
+    return None
+
+def make_exif(orientation=None, copyright=None):
+    """
+    Return the TIFF structure of an EXIF block with just the given
+    orientation and copyright.
+    """
+    entries = []
+
+    if orientation is not None:
+        entries.append(struct.pack(">HHIHH", ORIENTATION, 3, 1, orientation, 0))
+
+    data = b""
+
+    if copyright is not None:
+        text = copyright.encode("ascii", "replace") + b"\0"
+        # the text goes after the IFD: header, entry count, entries and the
+        # next IFD offset
+        offset = 8 + 2 + 12 * (len(entries) + 1) + 4
+        entries.append(struct.pack(">HHII", COPYRIGHT_TAG, 2, len(text), offset))
+        data = text
+
+    return (b"MM\0\x2a" + struct.pack(">IH", 8, len(entries)) + b"".join(entries) +
+            struct.pack(">I", 0) + data)
+
+def jpeg_segments(data):
+    """
+    Yield (marker, segment) for each segment in a JPEG, up to and including
+    the image data (which is returned in one piece with the SOS marker).
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("not a JPEG")
+
+    pos = 2
+
+    while pos < len(data):
+        if data[pos] != 0xff:
+            raise ValueError(f"bad marker at {pos}")
+
+        # markers can be padded with any number of 0xff
+        while pos < len(data) and data[pos] == 0xff:
+            pos += 1
+
+        if pos == len(data):
+            raise ValueError("truncated marker at the end")
+
+        marker = data[pos]
+        start = pos - 1
+        pos += 1
+
+        if marker in STANDALONE_MARKERS:
+            yield marker, data[start:pos]
+            continue
+
+        if pos + 2 > len(data):
+            raise ValueError(f"truncated segment at {start}")
+
+        length, = struct.unpack(">H", data[pos:pos+2])
+
+        if marker == SOS:
+            # everything else is image data, and whatever trails it
+            yield marker, data[start:]
+            return
+
+        if length < 2 or pos + length > len(data):
+            raise ValueError(f"bad segment length at {start}")
+
+        yield marker, data[start:pos+length]
+        pos += length
+
+    raise ValueError("no image data")
+
+def jpeg_segment(marker, payload):
+    return struct.pack(">BBH", 0xff, marker, len(payload) + 2) + payload
+
+def strip_jpeg(data, copyright):
+    """
+    Return the JPEG in data without its metadata, stamped with copyright.
+    """
+    header = []
+    kept = []
+    orientation = None
+
+    for marker, segment in jpeg_segments(data):
+        payload = segment[4:]
+
+        if marker == 0xd8:
+            continue
+        elif marker == APP0 and payload.startswith(b"JFIF\0"):
+            header.append(segment)
+        elif marker == APP1 and payload.startswith(EXIF_HEADER):
+            orientation = exif_orientation(payload[len(EXIF_HEADER):])
+        elif marker == APP2 and payload.startswith(b"ICC_PROFILE\0"):
+            kept.append(segment)
+        elif marker == APP14 and payload.startswith(b"Adobe"):
+            kept.append(segment)
+        elif APP0 <= marker <= 0xef or marker == COM:
+            continue
+        else:
+            kept.append(segment)
+
+    exif = jpeg_segment(APP1, EXIF_HEADER + make_exif(orientation, copyright))
+
+    return b"".join([b"\xff\xd8"] + header + [exif] + kept)
+
+def png_chunks(data):
+    """
+    Yield (type, chunk) for each chunk in a PNG.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("not a PNG")
+
+    pos = len(PNG_SIGNATURE)
+
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos+8])
+        end = pos + 12 + length
+
+        if end > len(data):
+            raise ValueError(f"truncated {kind} chunk at {pos}")
+
+        yield kind, data[pos:end]
+        pos = end
+
+        if kind == b"IEND":
+            return
+
+    raise ValueError("no IEND chunk")
+
+def png_chunk(kind, payload):
+    return (struct.pack(">I", len(payload)) + kind + payload +
+            struct.pack(">I", zlib.crc32(kind + payload)))
+
+def strip_png(data, copyright):
+    """
+    Return the PNG in data without its metadata, stamped with copyright.
+    """
+    chunks = []
+    orientation = None
+
+    for kind, chunk in png_chunks(data):
+        if kind == b"eXIf":
+            orientation = exif_orientation(chunk[8:-4])
+        elif kind[0:1].isupper() or kind in PNG_KEEP:
+            chunks.append(chunk)
+
+    added = []
+
+    if orientation is not None:
+        added.append(png_chunk(b"eXIf", make_exif(orientation)))
+
+    added.append(png_chunk(b"tEXt", b"Copyright\0" +
+                           copyright.encode("latin-1", "replace")))
+
+    # right after IHDR, eXIf has to come before the image data
+    return b"".join([PNG_SIGNATURE, chunks[0]] + added + chunks[1:])
+
+STRIPPERS = {}
+STRIPPERS.update((ext, strip_jpeg) for ext in JPEG_EXTENSIONS)
+STRIPPERS.update((ext, strip_png) for ext in PNG_EXTENSIONS)
+
+def wanted(path, basepath):
+    """
+    Decide if the image at path should be stripped.
+    """
+    name = os.path.basename(path)
+    ext = os.path.splitext(name)[1].lower()
+    directories = os.path.dirname(os.path.relpath(path, basepath)).split(os.sep)
+
+    # symlinks point to a file that's stripped in its own right, and variants
+    # were stripped when they were made
+    return (ext in STRIPPERS and not HASHED_NAME.match(name) and
+            not os.path.islink(path) and
+            not any(part in VARIANT_DIRS for part in directories))
+
+@profiled("strip", "images", lambda args: {"file": args[0]})
+def strip_file(args):
+    """
+    Strip the metadata from the image at path, in place.
+
+    Returns (path, extension, bytes before, bytes after), with None for the
+    sizes if the file was already stripped, or couldn't be read.
+    """
+    path, copyright = args
+    ext = os.path.splitext(path)[1].lower()
+
+    with open(path, "rb") as fp:
+        data = fp.read()
+
+    try:
+        stripped = STRIPPERS[ext](data, copyright)
+    except (ValueError, struct.error) as error:
+        print(f"\tSkipping {path}: {error}")
+        return path, ext, None, None
+
+    if stripped == data:
+        return path, ext, None, None
+
+    temp_path = f"{path}.new"
+    with open(temp_path, "wb") as fp:
+        fp.write(stripped)
+    os.replace(temp_path, path)
+
+    return path, ext, len(data), len(stripped)
+
+def strip_variant(path):
+    """
+    Strip the metadata from a variant that's just been written to path, if
+    it's a JPEG or PNG, so it goes in the variant store without it.
+    """
+    if os.path.splitext(path)[1].lower() in STRIPPERS:
+        strip_file((path, copyright_notice()))
+
+def process_dir(basepath):
+    print(f"STRIPPING IMAGE METADATA IN {basepath}...")
+    print("====================================")
+
+    notice = copyright_notice()
+
+    jobs = [(path, notice) for path in walk(basepath) if wanted(path, basepath)]
+
+    with multiprocessing.Pool(WORKERS) as pool:
+        results = pool.map(strip_file, jobs, chunksize=8)
+
+    totals = {}
+
+    for path, ext, before, after in results:
+        ext = ".jpg" if ext in JPEG_EXTENSIONS else ext
+        files, skipped, total_before, total_after = totals.get(ext, (0, 0, 0, 0))
+
+        if before is None:
+            totals[ext] = (files, skipped + 1, total_before, total_after)
+        else:
+            totals[ext] = (files + 1, skipped, total_before + before, total_after + after)
+
+    print(f"{'type':<6} {'files':>7} {'skipped':>8} {'before':>12} {'after':>12} {'saved':>12}")
+
+    for ext, (files, skipped, before, after) in sorted(totals.items()):
+        saved = before - after
+        percent = (saved / before * 100) if before else 0
+        print(f"{ext:<6} {files:>7} {skipped:>8} {before:>12} {after:>12} {saved:>12} ({percent:.1f}%)")
+
+if __name__ == "__main__":
+    with span("strip_metadata", "stage"):
+        process_dir(PATH)
@@ -0,0 +1,99 @@
+"""
+Tests for the preview server in wsgi.py.
+
+Run from the _build directory:
+
+$ python -m pytest tests
+"""
+import gzip
+import importlib
+import os, sys
+from wsgiref.validate import validator
+
+import pytest
+from webob import Request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def wsgi(tmp_path, monkeypatch):
+    # the module makes apps for ./output and ../ when it's imported
+    (tmp_path / "build" / "output").mkdir(parents=True)
+    monkeypatch.chdir(tmp_path / "build")
+
+    module = importlib.import_module("wsgi")
+    monkeypatch.setattr(module, "CACHE_DIR", str(tmp_path))
+
+    return module
+
+@pytest.fixture
+def site(tmp_path):
+    path = tmp_path / "site"
+    path.mkdir()
+    (path / "page.html").write_text("<p>hello</p>" * 10000)
+    (path / "search.json.gz").write_bytes(gzip.compress(b'{"term": [1, 2]}'))
+
+    return path
+
+def get(app, url, **kw):
+    """
+    Request url from app like a WSGI server would (reading the body, then
+    closing it), checking it follows the spec. Returns (status, headers, body).
+    """
+    request = Request.blank(url, **kw)
+    status, headers, app_iter = request.call_application(validator(app))
+
+    try:
+        body = b"".join(app_iter)
+    finally:
+        app_iter.close()
+
+    return int(status.split()[0]), dict(headers), body
+
+def test_cached_file_is_served_again(wsgi, site):
+    app = wsgi.DirectoryListingApp(str(site))
+    body = (site / "page.html").read_bytes()
+
+    # the first request fills the cache, the second is served from it
+    for _ in range(2):
+        status, headers, response = get(app, "/page.html")
+        assert status == 200
+        assert response == body
+
+    assert not app.cache().readers
+
+def test_conditional_and_range_requests_release_the_slot(wsgi, site):
+    app = wsgi.DirectoryListingApp(str(site))
+    body = (site / "page.html").read_bytes()
+    get(app, "/page.html")
+
+    status, headers, response = get(app, "/page.html", range=(10, 20))
+    assert status == 206
+    assert response == body[10:20]
+    assert not app.cache().readers
+
+    last_modified = os.stat(site / "page.html").st_mtime
+    status, headers, response = get(app, "/page.html",
+                                    if_modified_since=last_modified + 1)
+    assert status == 304
+    assert not app.cache().readers
+
+    status, headers, response = get(app, "/page.html", method="HEAD")
+    assert status == 200
+    assert response == b""
+    assert not app.cache().readers
+
+def test_compressed_files_are_sent_as_they_are(wsgi, site):
+    app = wsgi.DirectoryListingApp(str(site))
+
+    for _ in range(2):
+        status, headers, response = get(app, "/search.json.gz")
+        assert status == 200
+        assert headers["Content-Type"] == "application/gzip"
+        assert "Content-Encoding" not in headers
+        assert response == (site / "search.json.gz").read_bytes()
+
+    app = wsgi.DirectoryListingApp(str(site), shared_cache=False)
+    status, headers, response = get(app, "/search.json.gz")
+    assert headers["Content-Type"] == "application/gzip"
+    assert "Content-Encoding" not in headers
@@ -0,0 +1,180 @@
+'use strict';
+/* 
+ * Client side search, using the sharded index built by the search_index 
+ * plugin. Only the shards for the words being searched for are downloaded.
+ *
+ * The script tag needs a data-index attribute with the url of the index
+ * directory.
+ */
+var search_root = document.currentScript.getAttribute("data-index");
+var search_manifest = null;
+var search_files = {};
+
+var fetch_json = function(url, compressed){
+    if (!(url in search_files)) {
+        search_files[url] = fetch(url).then(function(response){
+            if (!response.ok) {
+                throw new Error("Could not load " + url);
+            }
+            if (!compressed) {
+                return response.json();
+            }
+            return response.arrayBuffer().then(function(buffer){
+                var bytes = new Uint8Array(buffer);
+                
+                // a server that sends the shards with Content-Encoding: gzip
+                // has had them decompressed by the browser already
+                if (bytes[0] !== 0x1f || bytes[1] !== 0x8b) {
+                    return JSON.parse(new TextDecoder().decode(bytes));
+                }
+                
+                var stream = new Blob([bytes]).stream().pipeThrough(
+                    new DecompressionStream("gzip"));
+                return new Response(stream).json();
+            });
+        });
+    }
+    return search_files[url];
+};
+
+var load_manifest = function(){
+    if (search_manifest === null) {
+        search_manifest = fetch_json(search_root + "/index.json", false);
+    }
+    return search_manifest;
+};
+
+var search_terms = function(query, manifest){
+    var words = query.toLowerCase().split(/[^\p{L}\p{N}]+/u);
+    
+    return words.filter(function(word){
+        return word.length >= manifest.min_term_length && 
+               manifest.stopwords.indexOf(word) === -1;
+    });
+};
+
+/* 
+ * Score every document that matches all of the words in query. Each word 
+ * matches any term that starts with it, so partial words work as you type.
+ * Resolves to a list of [document, score], best first.
+ */
+var search = function(query){
+    return load_manifest().then(function(manifest){
+        var words = search_terms(query, manifest);
+        
+        var shards = words.map(function(word){
+            var name = manifest.shards[word.slice(0, manifest.prefix_length)];
+            if (name === undefined) {
+                return Promise.resolve({});
+            }
+            return fetch_json(search_root + "/" + name, true);
+        });
+        
+        var documents = fetch_json(search_root + "/" + manifest.documents, true);
+        
+        return Promise.all([documents].concat(shards)).then(function(loaded){
+            var docs = loaded[0];
+            var totals = null;
+            
+            words.forEach(function(word, index){
+                var shard = loaded[index + 1];
+                var scores = {};
+                
+                Object.keys(shard).forEach(function(term){
+                    if (term.lastIndexOf(word, 0) !== 0) {
+                        return;
+                    }
+                    var postings = shard[term];
+                    for (var i = 0; i < postings.length; i += 2) {
+                        scores[postings[i]] = (scores[postings[i]] || 0) + postings[i + 1];
+                    }
+                });
+                
+                if (totals === null) {
+                    totals = scores;
+                    return;
+                }
+                
+                // every word has to match
+                var combined = {};
+                Object.keys(totals).forEach(function(id){
+                    if (id in scores) {
+                        combined[id] = totals[id] + scores[id];
+                    }
+                });
+                totals = combined;
+            });
+            
+            return Object.keys(totals || {}).map(function(id){
+                return [docs[id], totals[id]];
+            }).sort(function(a, b){
+                return b[1] - a[1];
+            });
+        });
+    });
+};
+
+var show_results = function(query, results){
+    var list = document.getElementById("search-results");
+    var status = document.getElementById("search-status");
+    
+    list.innerHTML = "";
+    
+    if (!query.trim()) {
+        status.textContent = "";
+        return;
+    }
+    
+    status.textContent = results.length === 1 ? "One article found." : 
+                         results.length + " articles found.";
+    
+    results.slice(0, 50).forEach(function(result){
+        var doc = result[0];
+        var item = document.createElement("li");
+        var link = document.createElement("a");
+        var date = document.createElement("time");
+        var summary = document.createElement("p");
+        
+        link.href = doc.url; // relative to search.html, at the root
+        link.textContent = doc.title;
+        date.textContent = doc.date;
+        date.setAttribute("datetime", doc.date);
+        summary.textContent = doc.summary;
+        
+        item.appendChild(link);
+        item.appendChild(document.createTextNode(" "));
+        item.appendChild(date);
+        item.appendChild(summary);
+        list.appendChild(item);
+    });
+};
+
+var run_search = function(){
+    var query = document.getElementById("search-input").value;
+    
+    search(query).then(function(results){
+        // ignore results for a query that's since been changed
+        if (document.getElementById("search-input").value === query) {
+            show_results(query, results);
+        }
+    }).catch(function(error){
+        document.getElementById("search-status").textContent = 
+            "Search isn't available right now.";
+        console.log(error);
+    });
+};
+
+if (!window.DecompressionStream) {
+    document.getElementById("search-status").textContent = 
+        "Sorry, search isn't supported by this browser.";
+} else {
+    var input = document.getElementById("search-input");
+    var initial = new URLSearchParams(window.location.search).get("q");
+    
+    input.addEventListener("input", run_search);
+    
+    if (initial) {
+        input.value = initial;
+        run_search();
+    }
+}
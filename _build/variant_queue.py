@@ -0,0 +1,477 @@
+"""
+Variant Job Queue
+
+Spreads the rendering of image variants (the slowest part of the
+post-processor) across worker processes, on this machine or others, over
+ZeroMQ.
+
+The coordinator works out which variants the site's pages need, the same way
+responsive_postprocess.py does, and makes a job for each one that isn't in
+the variant store yet. A job is (source hash, width, format). Workers connect
+to the coordinator and ask for jobs one at a time; the coordinator sends the
+job, along with the source image's bytes if that worker hasn't been sent
+them already, and the worker renders the variant and sends the bytes back.
+The coordinator adds each result to the store and the image manifest (see
+imagetools.cached_variant()), so when responsive_postprocess.py runs next,
+every variant is just linked into place.
+
+  - copies of the same image are one job, and a job that's queued or in
+    flight isn't queued again
+  - a job that fails, or that a worker doesn't finish within JOB_TIMEOUT
+    seconds (the worker died, say), is handed to another worker, up to
+    MAX_ATTEMPTS times. If a slow worker finishes it later, the extra result
+    is ignored, as is a failure it reports
+  - workers that are waiting for a job re-announce themselves every
+    READY_INTERVAL seconds, so long-running workers pick up a coordinator
+    that's started after them
+
+Run from the _build directory. Everything on this machine, with 4 workers:
+
+$ python variant_queue.py local 4
+$ python variant_queue.py local 4 --force    # re-render every variant
+
+Or with workers elsewhere (run the coordinator, then start the workers, in
+any order):
+
+$ python variant_queue.py coordinator
+$ python variant_queue.py worker tcp://build-machine:5560
+
+Workers need the same code and dependencies (Wand and ImageMagick), but not
+the site: sources are sent to them, and kept in WORKER_CACHE by hash. The
+worker watcher in circus.ini runs workers against a coordinator on this
+machine.
+"""
+import os, sys
+import hashlib
+import json
+import multiprocessing
+import socket
+import time
+from collections import deque
+
+import zmq
+from bs4 import BeautifulSoup
+
+import imagetools
+from imagetools import Manifest, get_manifest, image_size, store_object
+from buildprofile import span
+from fingerprint import walk
+from strip_metadata import strip_variant
+import responsive_postprocess as postprocess
+
+BIND = "tcp://*:5560"                   # where the coordinator listens
+LOCAL_ENDPOINT = "tcp://127.0.0.1:5560" # where local workers connect
+
+JOB_TIMEOUT = 300    # seconds before a job is given to another worker
+MAX_ATTEMPTS = 3
+READY_INTERVAL = 5   # seconds between a waiting worker's announcements
+POLL_INTERVAL = 1000 # milliseconds
+
+# where workers keep the sources they've been sent
+WORKER_CACHE = os.path.abspath("cache/variant_worker")
+
+class SourceMissing(Exception):
+    """
+    Raised when a worker is given a job without the source, and doesn't have
+    its own copy of it (it was sent to a worker that has since restarted with
+    an empty cache, say).
+    """
+
+def render_jpeg(source, width, path):
+    postprocess.render_variant(source, width, path)
+
+# format: (extension, manifest kind for a width, render(source, width, path))
+FORMATS = {
+    "jpg": (".jpg", lambda width: str(width or "full"), render_jpeg),
+}
+
+def variant_paths(source):
+    """
+    Yield (width, format, variant path) for every variant the post-processor
+    makes of the image at source.
+    """
+    if os.path.splitext(source)[1].lower() not in (".jpg", ".png"):
+        return
+
+    source_width, source_height = image_size(source)
+
+    for width in postprocess.SIZES:
+        if not width or source_width >= width:
+            yield width, "jpg", postprocess.variant_location(source, width, ".jpg")
+
+def page_images(basepath):
+    """
+    Yield the path of every local image the pages under basepath would have
+    variants made of.
+    """
+    for path in walk(basepath):
+        if not path.endswith(".html"):
+            continue
+
+        with open(path) as fp:
+            soup = BeautifulSoup(fp, "lxml")
+
+        for image in soup.select("section img"):
+            src = image.get("src", "")
+
+            if (not src or src.startswith(("http://", "https://")) or
+                image.get("srcset") or image.parent.name == "picture"):
+                continue
+
+            image_path = postprocess.source_path(path, src)
+
+            if os.path.exists(image_path):
+                yield image_path
+
+def needed_jobs(basepath, force=False):
+    """
+    Return {(source hash, width, format): source path} for the variants the
+    pages under basepath need that aren't in the store yet.
+    """
+    manifest = get_manifest()
+    jobs = {}
+    seen = set()
+
+    for source in page_images(basepath):
+        digest = manifest.file_hash(source)
+
+        if digest in seen:
+            continue
+        seen.add(digest)
+
+        variants = manifest.entry(source).get("variants", {})
+
+        for width, format, path in variant_paths(source):
+            ext, kind, render = FORMATS[format]
+
+            stored = variants.get(kind(width))
+            if not force and (os.path.exists(path) or
+                              stored and os.path.exists(store_object(stored, ext))):
+                continue
+
+            jobs[(digest, width, format)] = source
+
+    return jobs
+
+def save_result(source, width, format, data, metadata):
+    """
+    Add a rendered variant to the store, and record it (and anything the
+    worker learned about the source, like JPEG qualities) in the manifest.
+    """
+    ext, kind, render = FORMATS[format]
+    digest = hashlib.sha1(data).hexdigest()
+    path = store_object(digest, ext)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.new"
+        with open(temp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(temp_path, path)
+
+    entry = get_manifest().entry(source)
+
+    for key, value in metadata.items():
+        if isinstance(value, dict):
+            entry.setdefault(key, {}).update(value)
+        else:
+            entry.setdefault(key, value)
+
+    entry.setdefault("variants", {})[kind(width)] = digest
+
+def send(sock, identity, command, header=None, payload=b""):
+    sock.send_multipart([identity, command,
+                         json.dumps(header or {}).encode("utf-8"), payload])
+
+class Coordinator:
+    """
+    Hands out jobs to the workers that ask for them, and collects the results.
+
+    jobs is {(source hash, width, format): source path}.
+    """
+    def __init__(self, jobs, bind=BIND, stop_workers=False):
+        self.sources = dict(jobs)
+        self.queue = deque(jobs)
+        self.attempts = dict.fromkeys(jobs, 0)
+        self.in_flight = {}      # job: (worker, deadline, source was sent)
+        self.idle = {}           # workers waiting for a job, in order
+        self.sent = {}           # worker: hashes of the sources it has
+        self.done = set()
+        self.failed = {}         # job: last error
+        self.stop_workers = stop_workers
+
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(bind)
+
+    def finished(self):
+        return not self.queue and not self.in_flight
+
+    def retry(self, job, error):
+        """
+        Put job back in the queue, unless it's out of attempts.
+        """
+        self.in_flight.pop(job, None)
+
+        if job in self.done or job in self.queue:
+            return
+
+        if self.attempts[job] >= MAX_ATTEMPTS:
+            self.failed[job] = error
+            print(f"FAILED {self.sources[job]} {job[1:]}: {error}")
+        else:
+            print(f"Retrying {self.sources[job]} {job[1:]}: {error}")
+            self.queue.append(job)
+
+    def dispatch(self):
+        while self.queue and self.idle:
+            worker = next(iter(self.idle))
+            del self.idle[worker]
+
+            job = self.queue.popleft()
+            digest, width, format = job
+            source = self.sources[job]
+
+            # only send the source to workers that don't have it yet
+            known = self.sent.setdefault(worker, set())
+            payload = b""
+
+            if digest not in known:
+                with open(source, "rb") as fp:
+                    payload = fp.read()
+                known.add(digest)
+
+            header = {"job": job, "ext": os.path.splitext(source)[1].lower()}
+            send(self.socket, worker, b"job", header, payload)
+
+            self.attempts[job] += 1
+            self.in_flight[job] = (worker, time.monotonic() + JOB_TIMEOUT,
+                                   bool(payload))
+
+    def receive(self):
+        worker, command, header, payload = self.socket.recv_multipart()
+        header = json.loads(header)
+
+        if command in (b"done", b"failed"):
+            job = tuple(header["job"])
+
+            if self.in_flight.get(job, (None,))[0] != worker:
+                # a worker that timed out (or a job that isn't ours), the job
+                # has been retried or is running somewhere else now
+                pass
+            elif command == b"done":
+                if job not in self.done:
+                    save_result(self.sources[job], job[1], job[2], payload,
+                                header.get("metadata", {}))
+                    self.done.add(job)
+                    print(f"Rendered {self.sources[job]} {job[1:]} "
+                          f"({len(payload)} bytes, {worker.decode()})")
+
+                self.in_flight.pop(job, None)
+                if job in self.queue:
+                    self.queue.remove(job)
+            else:
+                if header.get("missing"):
+                    # the worker lost its copy of the source, send it again
+                    # (which doesn't use up an attempt, unless it was sent
+                    # this time too)
+                    self.sent.get(worker, set()).discard(job[0])
+                    if not self.in_flight[job][2]:
+                        self.attempts[job] -= 1
+
+                self.retry(job, header.get("error"))
+
+        # every message from a worker means it's ready for another job
+        if self.finished() and self.stop_workers:
+            send(self.socket, worker, b"stop")
+        else:
+            self.idle[worker] = True
+
+    def expire(self):
+        now = time.monotonic()
+
+        for job, (worker, deadline, sent) in list(self.in_flight.items()):
+            if deadline < now:
+                # don't give it anything else until it shows up again
+                self.idle.pop(worker, None)
+                self.retry(job, f"timed out on {worker.decode()}")
+
+    def run(self):
+        print(f"{len(self.queue)} variants to render")
+
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+
+        while not self.finished():
+            self.dispatch()
+
+            if poller.poll(POLL_INTERVAL):
+                self.receive()
+
+            self.expire()
+
+        if self.stop_workers:
+            for worker in self.idle:
+                send(self.socket, worker, b"stop")
+
+        print(f"{len(self.done)} variants rendered, {len(self.failed)} failed")
+
+        return not self.failed
+
+    def close(self):
+        self.socket.close(linger=1000)
+
+def cached_source(digest, ext, payload):
+    """
+    Return the path of the worker's copy of a source, saving payload to it
+    if one was sent.
+    """
+    path = os.path.join(WORKER_CACHE, "sources", digest[:2], f"{digest}{ext}")
+
+    if payload:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}"
+        with open(temp_path, "wb") as fp:
+            fp.write(payload)
+        os.replace(temp_path, path)
+
+    return path
+
+def render(job, ext, payload):
+    """
+    Render a job, and return (variant bytes, metadata about the source).
+    """
+    digest, width, format = job
+    variant_ext, kind, make = FORMATS[format]
+
+    source = cached_source(digest, ext, payload)
+
+    if not os.path.exists(source):
+        raise SourceMissing(source)
+
+    output = os.path.join(WORKER_CACHE, "output",
+                          f"{digest}-{width or 'full'}-{format}.{os.getpid()}{variant_ext}")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    try:
+        with span("render", "queue", file=source, width=width, format=format):
+            make(source, width, output)
+            # like cached_variant() does, so the store only has stripped copies
+            strip_variant(output)
+
+        with open(output, "rb") as fp:
+            data = fp.read()
+    finally:
+        if os.path.exists(output):
+            os.remove(output)
+
+    metadata = {key: value for key, value in get_manifest().entry(source).items()
+                if key != "variants"}
+
+    return data, metadata
+
+def worker(endpoint=LOCAL_ENDPOINT):
+    """
+    Render jobs from the coordinator at endpoint, until it says to stop.
+    """
+    imagetools.apply_resource_limits()
+
+    # what's learned about each source is sent back with the result, so the
+    # worker's manifest only needs to live in memory (and local workers
+    # don't fight over the coordinator's file)
+    imagetools._manifest = Manifest(os.devnull)
+
+    context = zmq.Context.instance()
+    sock = context.socket(zmq.DEALER)
+    sock.setsockopt(zmq.IDENTITY, f"{socket.gethostname()}-{os.getpid()}".encode())
+    sock.connect(endpoint)
+
+    poller = zmq.Poller()
+    poller.register(sock, zmq.POLLIN)
+
+    message = [b"ready", b"{}", b""]
+
+    while True:
+        sock.send_multipart(message)
+
+        while not poller.poll(READY_INTERVAL * 1000):
+            sock.send_multipart([b"ready", b"{}", b""])
+
+        command, header, payload = sock.recv_multipart()
+
+        if command == b"stop":
+            break
+
+        header = json.loads(header)
+        job = tuple(header["job"])
+
+        try:
+            data, metadata = render(job, header["ext"], payload)
+        except SourceMissing as error:
+            message = [b"failed", json.dumps(
+                {"job": job, "error": str(error), "missing": True}).encode(), b""]
+        except Exception as error:
+            message = [b"failed", json.dumps(
+                {"job": job, "error": repr(error)}).encode(), b""]
+        else:
+            message = [b"done", json.dumps(
+                {"job": job, "metadata": metadata}).encode(), data]
+
+    sock.close(linger=1000)
+
+def coordinate(bind=BIND, force=False, local_workers=0):
+    """
+    Queue up the variants the site needs, and hand them out until they're
+    all done. With local_workers, that many workers are started on this
+    machine (and stopped at the end). Returns True if every job succeeded.
+    """
+    with span("plan", "queue"):
+        jobs = needed_jobs(postprocess.PATH, force)
+
+    if not jobs:
+        print("All variants are up to date")
+        return True
+
+    # fork the workers before there are any sockets for them to inherit
+    processes = [multiprocessing.Process(target=worker, args=(LOCAL_ENDPOINT,))
+                 for _ in range(local_workers)]
+
+    for process in processes:
+        process.start()
+
+    coordinator = Coordinator(jobs, bind, stop_workers=bool(processes))
+
+    try:
+        with span("variant_queue", "stage"):
+            succeeded = coordinator.run()
+    finally:
+        get_manifest().save()
+        coordinator.close()
+
+        for process in processes:
+            process.join(READY_INTERVAL * 2)
+            if process.is_alive():
+                process.terminate()
+
+    return succeeded
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "local"
+    force = "--force" in sys.argv
+    args = [arg for arg in sys.argv[2:] if not arg.startswith("--")]
+
+    if mode == "worker":
+        worker(args[0] if args else LOCAL_ENDPOINT)
+
+    elif mode == "coordinator":
+        succeeded = coordinate(args[0] if args else BIND, force)
+        sys.exit(0 if succeeded else 1)
+
+    elif mode == "local":
+        count = int(args[0]) if args else multiprocessing.cpu_count()
+        succeeded = coordinate(LOCAL_ENDPOINT, force, local_workers=count)
+        sys.exit(0 if succeeded else 1)
+
+    else:
+        sys.exit(f"usage: {sys.argv[0]} local [WORKERS] [--force] | "
+                 f"coordinator [BIND] [--force] | worker [ENDPOINT]")
@@ -3,19 +3,300 @@ Simple web server for static content - uses WebOb.
 
 Run this under a WSGI server like waitress, gunicorn or whatever.
 
+Files are served out of a cache shared by every worker process (see 
+SharedFileCache), so running more workers doesn't mean more copies of the hot
+pages and images in memory.
+
+Pages listed in the preload manifest (see preload_manifest.py) are sent with
+Link: rel=preload headers for the fonts, stylesheets, scripts and hero image
+they need. If the server offers a way to send a 103 Early Hints response 
+(environ['wsgi.early_hints'], a function taking a list of headers), the same
+headers are sent that way too, before the page is read.
+
 TODO: integrate the webserver into this so it's a self-contained unit
 """
 
 from webob import Request, Response
 from webob.static import FileApp
+from collections import Counter
+import fcntl
+import hashlib
+import json
+import mimetypes
+import mmap
 import os
+import re
+import struct
+import threading
+
+# file names with a content hash in them (see fingerprint.py), which can be 
+# cached forever
+FINGERPRINTED = re.compile(r"\.[0-9a-f]{10}\.[^./]+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# the shared cache is split into CACHE_SLOTS slots of CACHE_SLOT_SIZE bytes, 
+# files too big for a slot are served straight from disk. The cache file is 
+# sparse, so only the parts actually used take up memory. If CACHE_DIR is 
+# small (a container's /dev/shm is often only 64MB), there are only as many 
+# slots as fit in CACHE_SPACE of the space free there
+CACHE_SLOTS = 1024
+CACHE_SLOT_SIZE = 1024 * 1024
+CACHE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else os.path.abspath("cache")
+CACHE_SPACE = 0.5
+
+BLOCK_SIZE = 64 * 1024
+
+PRELOAD_MANIFEST = "preload.json" # in the root of the site
+
+# compressed files (like the search index shards) are sent as they are, with
+# these types, rather than as an encoding of what's in them, which browsers 
+# would decompress before scripts got to them
+ENCODED_TYPES = {
+    "gzip": "application/gzip",
+    "bzip2": "application/x-bzip2",
+    "xz": "application/x-xz",
+    "br": "application/octet-stream",
+    "compress": "application/x-compress",
+}
+
+def link_header(href, kind, attributes):
+    """
+    Format a preload manifest entry as a Link header value.
+    """
+    parts = [f"<{href}>", "rel=preload", f"as={kind}"]
+    
+    for name, value in attributes.items():
+        if value is True:
+            parts.append(name)
+        else:
+            parts.append(f'{name}="{value}"')
+    
+    return "; ".join(parts)
+
+def content_type(path):
+    """
+    Return the Content-Type to send the file at path with.
+    """
+    content_type, content_encoding = mimetypes.guess_type(path)
+    
+    if content_encoding is not None:
+        return ENCODED_TYPES.get(content_encoding, "application/octet-stream")
+    
+    return content_type
+
+def with_headers(start_response, headers):
+    """
+    Wrap start_response to add headers to the response.
+    """
+    def wrapped(status, response_headers, exc_info=None):
+        return start_response(status, response_headers + headers, exc_info)
+    
+    return wrapped
+
+def cache_slots(directory, slot_size=CACHE_SLOT_SIZE):
+    """
+    Return how many slots a new shared cache in directory should have: 
+    CACHE_SLOTS, or fewer if they wouldn't fit in CACHE_SPACE of the free 
+    space there.
+    """
+    stat = os.statvfs(directory)
+    free = stat.f_bavail * stat.f_frsize
+    
+    return min(CACHE_SLOTS, int(free * CACHE_SPACE) // slot_size)
+
+class SharedFileCache:
+    """
+    A cache of file contents in a memory-mapped file, shared by every process
+    that opens it.
+    
+    Each file goes in the slot its path hashes to (replacing whatever was 
+    there). A slot starts with a header recording the file's path (hashed), 
+    mtime, size and inode, followed by its contents. Entries are checked 
+    against a fresh stat() of the file on every lookup, so a changed file is
+    never served from the cache.
+    
+    Slots are locked with fcntl record locks: readers hold a shared lock on
+    the slot for as long as they're sending from it, and a writer only 
+    replaces a slot if it can get an exclusive lock right away. Otherwise the
+    file is served from disk this time, and cached later.
+    
+    fcntl locks belong to the process, so readers in the same process share
+    one lock, counted in readers.
+    
+    The first process to open the cache file decides how many slots it has,
+    the rest go by its size. Since the file is sparse, the space for a slot is
+    only allocated when it's written: put() allocates it first, and doesn't
+    cache the file if there's no room, rather than writing to the map and 
+    being killed with SIGBUS.
+    """
+    HEADER = struct.Struct("<qQQ20s") # mtime_ns, size, inode, sha1 of the path
+    HEADER_SIZE = mmap.PAGESIZE        # so contents start on a page boundary
+    
+    def __init__(self, path, slots=CACHE_SLOTS, slot_size=CACHE_SLOT_SIZE):
+        self.path = path
+        self.slot_size = slot_size
+        self.capacity = slot_size - self.HEADER_SIZE
+        
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        
+        try:
+            # so processes starting together agree on the size
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            size = os.fstat(self.fd).st_size
+            
+            if size < slot_size:
+                if slots < 1:
+                    raise ValueError(f"no room for a cache in {path}")
+                
+                size = slots * slot_size
+                os.ftruncate(self.fd, size)
+            
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(self.fd)
+            raise
+        
+        self.slots = size // slot_size
+        self.map = mmap.mmap(self.fd, self.slots * slot_size)
+        self.readers = Counter()
+        self.lock = threading.Lock()
+    
+    def slot(self, key):
+        return int.from_bytes(key[:8], "little") % self.slots
+    
+    def header(self, path, stat):
+        key = hashlib.sha1(path.encode("utf-8", "surrogateescape")).digest()
+        return key, self.HEADER.pack(stat.st_mtime_ns, stat.st_size, stat.st_ino, key)
+    
+    def lock_slot(self, slot, operation):
+        fcntl.lockf(self.fd, operation, self.slot_size, slot * self.slot_size)
+    
+    def acquire(self, slot):
+        with self.lock:
+            if not self.readers[slot]:
+                self.lock_slot(slot, fcntl.LOCK_SH)
+            self.readers[slot] += 1
+    
+    def release(self, slot):
+        with self.lock:
+            self.readers[slot] -= 1
+            if not self.readers[slot]:
+                del self.readers[slot]
+                self.lock_slot(slot, fcntl.LOCK_UN)
+    
+    def get(self, path, stat):
+        """
+        Return a SharedBody for the cached contents of path, or None if they 
+        aren't cached (or are out of date).
+        """
+        key, header = self.header(path, stat)
+        slot = self.slot(key)
+        start = slot * self.slot_size
+        
+        self.acquire(slot)
+        
+        if self.map[start:start + self.HEADER.size] != header:
+            self.release(slot)
+            return None
+        
+        data_start = start + self.HEADER_SIZE
+        view = memoryview(self.map)[data_start:data_start + stat.st_size]
+        
+        return SharedBody(view, lambda: self.release(slot))
+    
+    def allocate(self, start, length):
+        """
+        Make sure the space for part of the cache file is allocated, so 
+        writing to it can't fail. Returns False if there's no room.
+        """
+        if not hasattr(os, "posix_fallocate"):
+            return True
+        
+        try:
+            os.posix_fallocate(self.fd, start, length)
+        except OSError:
+            return False
+        
+        return True
+    
+    def put(self, path, stat, data):
+        """
+        Cache data as the contents of path. Returns False if it couldn't be 
+        (it's too big, the slot is being read, or there's no room).
+        """
+        if len(data) > self.capacity:
+            return False
+        
+        key, header = self.header(path, stat)
+        slot = self.slot(key)
+        start = slot * self.slot_size
+        
+        with self.lock:
+            # this process's own shared lock would just be upgraded
+            if self.readers[slot]:
+                return False
+            
+            try:
+                self.lock_slot(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            
+            try:
+                if not self.allocate(start, self.HEADER_SIZE + len(data)):
+                    return False
+                
+                # the header goes in last, so a half written slot never matches
+                self.map[start:start + self.HEADER.size] = bytes(self.HEADER.size)
+                data_start = start + self.HEADER_SIZE
+                self.map[data_start:data_start + len(data)] = data
+                self.map[start:start + self.HEADER.size] = header
+            finally:
+                self.lock_slot(slot, fcntl.LOCK_UN)
+        
+        return True
+
+class SharedBody:
+    """
+    Response body that sends a file's contents straight out of the shared 
+    cache, and releases its slot when the server closes it.
+    
+    WSGI servers only take bytes, so it's sent in BLOCK_SIZE copies. Range 
+    requests get a SharedBody of just the range (see app_iter_range()), which
+    takes over releasing the slot; webob's own range wrapper wouldn't pass 
+    close() on to this one. Not modified responses and HEAD requests close it
+    without reading it.
+    """
+    def __init__(self, view, release):
+        self.view = view
+        self._release = release
+    
+    def __iter__(self):
+        for start in range(0, len(self.view), BLOCK_SIZE):
+            yield bytes(self.view[start:start + BLOCK_SIZE])
+    
+    def app_iter_range(self, start, stop):
+        body = SharedBody(self.view[start:stop], self._release)
+        
+        self.view.release()
+        self._release = None
+        
+        return body
+    
+    def close(self):
+        if self._release is not None:
+            self.view.release()
+            self._release()
+            self._release = None
+    
+    __del__ = close
 
 class DirectoryListingApp:
     """
     Similar to webob.static.DirectoryApp, but it displays a listing, ala Apache,
     when the index file isn't found.
     """
-    def __init__(self, path, index_page="index.html", **fileapp_kw):
+    def __init__(self, path, index_page="index.html", shared_cache=True, 
+                 **fileapp_kw):
         self.path = os.path.abspath(path)
         
         if not self.path.endswith(os.path.sep):
@@ -27,16 +308,135 @@ class DirectoryListingApp:
         self.index_page = index_page
         self.fileapp_kw = fileapp_kw
         
+        self.shared_cache = shared_cache
+        self._cache = None
+        self._cache_pid = None
+        
+        self.preload_path = os.path.join(self.path, PRELOAD_MANIFEST)
+        self._preloads = {}
+        self._preloads_mtime = None
+    
+    def preloads(self, url):
+        """
+        Return the Link header value for the page at url, or None.
+        
+        The manifest is read once, then again only if it's been rebuilt.
+        """
+        try:
+            mtime = os.stat(self.preload_path).st_mtime_ns
+        except OSError:
+            self._preloads = {}
+            self._preloads_mtime = None
+            return None
+        
+        if mtime != self._preloads_mtime:
+            try:
+                with open(self.preload_path) as fp:
+                    manifest = json.load(fp)
+                
+                resources = [link_header(*resource) for resource in manifest["resources"]]
+                self._preloads = {
+                    page: ", ".join(resources[index] for index in indexes)
+                    for page, indexes in manifest["pages"].items()}
+            except (OSError, ValueError, KeyError, TypeError):
+                self._preloads = {}
+            
+            self._preloads_mtime = mtime
+        
+        return self._preloads.get(url)
+    
+    def cache(self):
+        """
+        Return this process's handle on the shared cache, opening it on first 
+        use (after any forking the server does).
+        """
+        if not self.shared_cache:
+            return None
+        
+        if self._cache_pid != os.getpid():
+            name = hashlib.sha1(self.path.encode("utf-8")).hexdigest()[:10]
+            
+            try:
+                self._cache = SharedFileCache(
+                    os.path.join(CACHE_DIR, f"wsgi-{name}-{CACHE_SLOT_SIZE}.cache"),
+                    cache_slots(CACHE_DIR))
+            except (OSError, ValueError):
+                # files are served straight from disk
+                self._cache = None
+            
+            self._cache_pid = os.getpid()
+        
+        return self._cache
+    
+    def file_app(self, request, path, **kw):
+        """
+        Return a WSGI app that serves the file at path, from the shared cache 
+        if possible, falling back to FileApp (which also handles errors).
+        """
+        kw = dict(self.fileapp_kw, **kw)
+        kw.setdefault('content_type', content_type(path))
+        kw.setdefault('content_encoding', None)
+        cache = self.cache()
+        
+        if cache is None or request.method not in ("GET", "HEAD"):
+            return FileApp(path, **kw)
+        
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return FileApp(path, **kw)
+        
+        if stat.st_size > cache.capacity:
+            return FileApp(path, **kw)
+        
+        body = cache.get(path, stat)
+        
+        if body is None:
+            try:
+                with open(path, "rb") as fp:
+                    # the stat has to match what was read
+                    stat = os.fstat(fp.fileno())
+                    data = fp.read()
+            except OSError:
+                return FileApp(path, **kw)
+            
+            cache.put(path, stat, data)
+            body = [data]
+        
+        kw.setdefault('accept_ranges', 'bytes')
+        
+        return Response(
+            app_iter=body,
+            content_length=stat.st_size,
+            last_modified=stat.st_mtime,
+            **kw
+        ).conditional_response_app
+        
     def __call__(self, environ, start_response):
         request = Request(environ)
         
         path = os.path.join(self.path, request.path_info.lstrip('/'))
         
         
+        if request.method in ("GET", "HEAD"):
+            page = os.path.join(path, self.index_page) if os.path.isdir(path) else path
+            links = self.preloads("/" + os.path.relpath(page, self.path))
+            
+            if links:
+                headers = [("Link", links)]
+                
+                early_hints = environ.get("wsgi.early_hints")
+                if early_hints is not None:
+                    early_hints(headers)
+                
+                start_response = with_headers(start_response, headers)
+        
         if os.path.isdir(path):
             response = self.index(request, path)
+        elif FINGERPRINTED.search(path):
+            response = self.file_app(request, path, cache_control=IMMUTABLE)
         else:
-            response = FileApp(path, **self.fileapp_kw)
+            response = self.file_app(request, path)
             
         return response(environ, start_response)
             
@@ -44,7 +444,7 @@ class DirectoryListingApp:
         index_path = os.path.join(path, self.index_page)
         
         if os.path.exists(index_path):
-            return FileApp(index_path, **self.fileapp_kw)
+            return self.file_app(request, index_path)
         
         folders = []
         files = []